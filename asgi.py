@@ -0,0 +1,177 @@
+"""ASGI entry point: ``uvicorn asgi:app --host 0.0.0.0 --port 8080``.
+
+Serves the same routes as the Flask app in ``main`` but handles webhook
+messages on the event loop: replies go out through the awaitable
+``whatsapp.AsyncSendQueue`` (httpx, sharing the sync queue's rate limit), so
+a reply waiting on the Cloud API holds no thread and one process can keep
+hundreds of conversations in flight. pymongo has no asyncio API, so Mongo
+lookups run in the default thread pool. Media files are only registered
+here; downloading them, SAIA and OneDrive stay on the background job
+pipeline from ``main``, which persists, retries and deduplicates them.
+"""
+import asyncio
+import json
+import logging
+import os
+from urllib.parse import parse_qs
+
+import main
+from config import Config
+from services import whatsapp
+from services.dispatcher import AsyncKeyedDispatcher, iter_webhook_events
+from utils import helpers
+from utils.async_transport import async_transport
+from utils.log import correlation
+from utils.metrics import PROMETHEUS_CONTENT_TYPE, tracer
+
+logger = logging.getLogger("app.asgi")
+
+dispatcher = AsyncKeyedDispatcher(max_inflight=Config.ASYNC_MAX_INFLIGHT)
+tracer.register('dispatch_async', lambda: dispatcher.metrics, 'Per-phone webhook dispatcher (ASGI).')
+tracer.register('send_queue_async', lambda: whatsapp.get_async_send_queue().stats(), 'Awaitable WhatsApp send queue (ASGI).')
+tracer.register('http_async', async_transport.stats, 'Outbound httpx requests and clients (one pool per event loop).')
+
+
+async def wsp_handle_message_async(messages: dict):
+    typeMsg = messages.get('type')
+    logger.info("mensaje recibido", extra={'event': 'message_received', 'message_id': messages.get('id'), 'type': typeMsg})
+    phone = messages.get('from')
+    text = helpers.get_text_user(messages)
+
+    if typeMsg in ['image', 'document']:
+        text = typeMsg  # Para informar al flujo de respuesta
+        await asyncio.to_thread(main.wsp_register_media, typeMsg, phone, messages.get(typeMsg) or {})
+
+    replies = await asyncio.to_thread(main.wsp_build_replies, text, phone)
+    # Awaited in order; the dispatcher already serializes messages per sender
+    await whatsapp.get_async_send_queue().send_many(replies)
+
+
+async def wsp_dispatch_message_async(messages: dict):
+    """Handle a dispatched message; on failure forget its id so a redelivery is processed again."""
+    try:
+        await wsp_handle_message_async(messages)
+    except Exception:
+        await asyncio.to_thread(main.deduplicator.forget, messages.get('id'))
+        raise
+
+
+async def wsp_handle_status_async(status: dict):
+    await asyncio.to_thread(main.wsp_handle_status, status)
+
+
+async def _is_duplicate(message_id):
+    if main.deduplicator.collection_getter is None:
+        return main.deduplicator.is_duplicate(message_id)
+    return await asyncio.to_thread(main.deduplicator.is_duplicate, message_id)
+
+
+async def _read_body(receive, limit: int):
+    """Read the request body; stops early and returns ``(None, size)`` once it exceeds ``limit`` bytes."""
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return None, size
+        chunks.append(chunk)
+        more_body = message.get('more_body', False)
+    return b''.join(chunks), size
+
+
+def _header(scope, name: bytes):
+    for key, value in scope.get('headers') or []:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def _respond(send, status: int, body: str = '', content_type: str = 'text/html; charset=utf-8') -> None:
+    payload = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')),
+                    (b'content-length', str(len(payload)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def wsp_verify_token(scope, send):
+    query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    token = (query.get('hub.verify_token') or [None])[0]
+    challenge = (query.get('hub.challenge') or [None])[0]
+    if token is not None and challenge is not None and token == os.getenv('WSP_API_VERIFY_TOKEN'):
+        await _respond(send, 200, challenge)
+    else:
+        await _respond(send, 400)
+
+
+async def wsp_received_message(scope, receive, send):
+    verifier = main.webhook_verifier
+    content_length = _header(scope, b'content-length')
+    if verifier.precheck(int(content_length) if content_length and content_length.isdigit() else None):
+        await _respond(send, 413)
+        return
+    raw, size = await _read_body(receive, verifier.max_body)
+    if raw is None:
+        rejected = verifier.precheck(size)
+    else:
+        rejected = verifier.verify(raw, _header(scope, b'x-hub-signature-256'))
+    if rejected:
+        await _respond(send, 413 if rejected == 'too_large' else 401)
+        return
+    # Tasks created below copy the context, so they keep this request's correlation id
+    with correlation():
+        try:
+            try:
+                with tracer.span('parse'):
+                    body = json.loads(raw) if raw else {}
+            except ValueError:
+                body = {}
+            for kind, value, item in iter_webhook_events(body):
+                if kind == 'message':
+                    if await _is_duplicate(item.get('id')):
+                        continue
+                    dispatcher.submit(item.get('from'), wsp_dispatch_message_async, item)
+                else:
+                    dispatcher.submit(item.get('recipient_id'), wsp_handle_status_async, item)
+        except Exception as e:
+            logger.exception("Error en wsp_received_message: %s", e)
+    await _respond(send, 200, 'EVENT_RECEIVED')
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await dispatcher.drain()
+            await asyncio.to_thread(main.sessions.flush)
+            await async_transport.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path, method = scope['path'], scope['method']
+    if path == '/welcome' and method == 'GET':
+        await _respond(send, 200, 'method: welcome')
+    elif path == '/metrics' and method == 'GET' and tracer.enabled:
+        await _respond(send, 200, tracer.render_prometheus(), PROMETHEUS_CONTENT_TYPE)
+    elif path == '/whatsapp' and method == 'GET':
+        await wsp_verify_token(scope, send)
+    elif path == '/whatsapp' and method == 'POST':
+        await wsp_received_message(scope, receive, send)
+    else:
+        await _respond(send, 404)
@@ -0,0 +1,95 @@
+"""Response extraction cost: recursive walk + fence regex vs utils.extraction.
+
+Replays the recorded SAIA responses in ``example/saia-*.json`` (plus a
+large synthetic one whose text sits behind thousands of empty values)
+through the extraction both ``AIProcessor`` and the media pipeline used to
+inline (recursive ``find_string``, fenced-code regex, ``json.loads``) and
+through ``extraction.assistant_text`` + ``extraction.parse_json_text``.
+Checks both agree on the recorded payloads and prints per-response cost.
+
+    python bench/bench_extraction.py --number 20000
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils import extraction  # noqa: E402
+
+
+def legacy_find_string(o):
+    if isinstance(o, str):
+        return o
+    if isinstance(o, list):
+        for v in o:
+            s = legacy_find_string(v)
+            if s:
+                return s
+        return None
+    if isinstance(o, dict):
+        for v in o.values():
+            s = legacy_find_string(v)
+            if s:
+                return s
+        return None
+    return None
+
+
+def legacy_extract(data):
+    raw = None
+    choices = data.get('choices') if isinstance(data, dict) else None
+    if isinstance(choices, list) and choices and isinstance(choices[0], dict):
+        msg = choices[0].get('message') or choices[0].get('delta') or choices[0]
+        if isinstance(msg, dict):
+            raw = msg.get('content') or msg.get('text') or msg.get('payload')
+    if raw is None:
+        raw = legacy_find_string(data)
+    m = re.search(r"```(?:json)?\s*(.*?)\s*```", raw.strip(), flags=re.DOTALL | re.IGNORECASE)
+    candidate = m.group(1).strip() if m else raw.strip()
+    try:
+        return json.loads(candidate)
+    except ValueError:
+        return candidate
+
+
+def new_extract(data):
+    ok, value = extraction.parse_json_text(extraction.assistant_text(data))
+    return value
+
+
+def load_cases():
+    cases = []
+    for path in sorted(glob.glob(os.path.join(ROOT, 'example', 'saia-*.json'))):
+        with open(path, encoding='utf-8') as fh:
+            cases.append((os.path.basename(path)[:-5], json.load(fh)))
+    with open(os.path.join(ROOT, 'example', 'saia-chat.json'), encoding='utf-8') as fh:
+        content = json.load(fh)['choices'][0]['message']['content']
+    padding = [{'id': '', 'tags': ['', ''], 'score': 0} for _ in range(1000)]
+    cases.append(('synthetic-deep', {'trace': padding, 'result': {'output': [{'text': content}]}}))
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"orjson: {'yes' if extraction.orjson is not None else 'no'}")
+    print(f"{'response':>22} {'legacy':>14} {'extraction':>14} {'speedup':>8}")
+    for name, data in load_cases():
+        assert legacy_extract(data) == new_extract(data), name
+        number = max(1, args.number // 100) if name.startswith('synthetic') else args.number
+        old = min(timeit.repeat(lambda: legacy_extract(data), number=number, repeat=args.repeat)) / number
+        new = min(timeit.repeat(lambda: new_extract(data), number=number, repeat=args.repeat)) / number
+        print(f'{name:>22} {old * 1e6:9.2f} us/op {new * 1e6:9.2f} us/op {old / new:7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Per-message cost of intent matching: compiled router vs the old any() chain.
+
+Both classify the same corpus of short chat messages; the legacy chain is
+the substring if/elif from ``wsp_build_replies`` before the router, kept here
+only for comparison. Also reports how many messages the two disagree on
+(mostly substring false positives such as 'hi' inside 'archivo').
+
+    python bench/bench_intents.py --rounds 200
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.intents import DEFAULT_RULES, IntentRouter  # noqa: E402
+
+CORPUS = [
+    'hola', 'Hola, buenas tardes', 'hi', 'Buenás noches!', 'gracias!!', 'thank you so much',
+    'te envío el archivo', 'adjunto el documento de la obra', 'where is your agency?',
+    'necesito el contacto del supervisor', 'quiero hacer login', 'log in por favor',
+    'register', 'necesito registrarme en el sistema de contratistas', 'buy', 'sell',
+    'cuál es el estado de mi solicitud de acceso a faena', 'ok', '👍', 'this is a test message',
+    'Necesito ayuda con la plataforma, no puedo ingresar desde ayer en la tarde y '
+    'tengo que subir la documentación de mis trabajadores antes del viernes',
+]
+
+
+def legacy_route(message: str):
+    message = message.lower()
+    if any(p in message for p in ['hi', 'hello', 'hola', 'buenas']):
+        return 'greeting'
+    elif any(p in message for p in ['thanks', 'thank', 'thank you', 'gracias']):
+        return 'thanks'
+    elif any(p in message for p in ['image', 'document']):
+        return 'media'
+    elif any(p in message for p in ['agency']):
+        return 'agency'
+    elif any(p in message for p in ['contact']):
+        return 'contact'
+    elif any(p in message for p in ['buy']):
+        return 'buy'
+    elif any(p in message for p in ['sell']):
+        return 'sell'
+    elif any(p in message for p in ['register']):
+        return 'register'
+    elif any(p in message for p in ['login', 'log in']):
+        return 'login'
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=200, help='passes over the corpus per timing')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    router = IntentRouter(DEFAULT_RULES)
+    n = len(CORPUS) * args.rounds
+    for name, route in (('legacy any() chain', legacy_route), ('compiled router', router.route)):
+        best = min(timeit.repeat(lambda: [route(m) for m in CORPUS], number=args.rounds, repeat=args.repeat))
+        print(f'{name:>20}: {best / n * 1e6:6.2f} us/message')
+
+    print('\ndisagreements (legacy -> router):')
+    for m in CORPUS:
+        old, new = legacy_route(m), router.route(m)
+        if old != new:
+            print(f'  {m[:50]!r}: {old} -> {new}')
+
+
+if __name__ == '__main__':
+    main()
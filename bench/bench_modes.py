@@ -0,0 +1,160 @@
+"""Compare webhook throughput of the sync (Flask) and async (ASGI) modes.
+
+Both apps run in-process against a local WhatsApp stub that answers every
+call after ``--latency`` seconds. A load generator posts ``--messages``
+"hola" webhooks with ``--concurrency`` in flight and the run ends once the
+stub has received every reply, so the reported rate is end-to-end
+conversations per second, not just webhook acks.
+
+    python bench/bench_modes.py --messages 500 --concurrency 50 --latency 0.05
+
+Mongo is disabled for the run (the lookups return no persona).
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.stubs import StubServer  # noqa: E402
+
+REPLIES_PER_MESSAGE = 2  # el saludo responde con dos mensajes
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _webhook_body(template: dict, run: str, i: int, phones: int) -> bytes:
+    body = copy.deepcopy(template)
+    message = body['entry'][0]['changes'][0]['value']['messages'][0]
+    message['id'] = f'wamid.bench.{run}.{i}'
+    message['from'] = f'5690000{i % phones:04d}'
+    message['text'] = {'body': 'hola'}
+    return json.dumps(body).encode()
+
+
+def _start_sync(app, port: int):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+
+def _start_async(app, port: int):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join(5)
+    return stop
+
+
+async def _load(url: str, bodies, concurrency: int):
+    import httpx
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def post(body):
+            async with semaphore:
+                started = time.perf_counter()
+                r = await client.post(url, content=body, headers={'Content-Type': 'application/json'})
+                r.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(post(b) for b in bodies))
+    return latencies
+
+
+def run_mode(name: str, start, app, stub: StubServer, args, template: dict) -> dict:
+    port = _free_port()
+    stop = start(app, port)
+    stub.reset()
+    bodies = [_webhook_body(template, name, i, args.phones) for i in range(args.messages)]
+    expected = args.messages * REPLIES_PER_MESSAGE
+    try:
+        started = time.perf_counter()
+        latencies = asyncio.run(_load(f'http://127.0.0.1:{port}/whatsapp', bodies, args.concurrency))
+        acked = time.perf_counter() - started
+        deadline = time.monotonic() + args.timeout
+        while stub.count < expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+    finally:
+        stop()
+    latencies.sort()
+    return {
+        'mode': name,
+        'messages': args.messages,
+        'replies_delivered': stub.count,
+        'ack_p50_ms': statistics.median(latencies) * 1000,
+        'ack_p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        'ack_seconds': acked,
+        'end_to_end_seconds': elapsed,
+        'conversations_per_second': args.messages / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--phones', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05, help='stub latency in seconds')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--modes', default='sync,async')
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    stub = StubServer(latency=args.latency).start()
+    os.environ.update({
+        'WSP_API_URL': stub.url,
+        'WSP_API_VERSION': 'v0',
+        'WSP_API_PHONE_ID': 'bench',
+        'JOB_WORKERS': '0',
+    })
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as flask_main
+        import asgi
+    flask_main.mongo._db = None
+
+    with open(os.path.join(ROOT, 'example', 'send-text.json'), encoding='utf-8') as fh:
+        template = json.load(fh)
+
+    modes = {'sync': (_start_sync, flask_main.app), 'async': (_start_async, asgi.app)}
+    results = []
+    for name in args.modes.split(','):
+        start, app = modes[name]
+        with contextlib.redirect_stdout(io.StringIO()):
+            results.append(run_mode(name, start, app, stub, args, template))
+
+    stub.stop()
+    for r in results:
+        print(f"{r['mode']:>5}: {r['conversations_per_second']:8.1f} conv/s  "
+              f"ack p50 {r['ack_p50_ms']:7.1f} ms  p95 {r['ack_p95_ms']:7.1f} ms  "
+              f"end-to-end {r['end_to_end_seconds']:6.2f} s  "
+              f"replies {r['replies_delivered']}/{r['messages'] * REPLIES_PER_MESSAGE}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Reply payload cost: build dict + json.dumps vs pre-serialized templates.
+
+For each reply type used by the bot, times building the payload the old way
+(``helpers.*_message`` then ``json.dumps`` as ``services.whatsapp`` did)
+against ``helpers.render`` / ``helpers.text_payload``, which only encode
+``to`` and the variable text. Prints per-payload cost and payloads/second.
+
+    python bench/bench_payloads.py --number 20000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import helpers  # noqa: E402
+
+PHONE = '56912345678'
+TEXT = 'Hola Camila, espero te encuentres bien. Para continuar envíame la foto de tu cédula de identidad'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cases = [
+        ('text', lambda: json.dumps(helpers.text_message(TEXT, PHONE)),
+         lambda: helpers.text_payload(TEXT, PHONE)),
+        ('location', lambda: json.dumps(helpers.location_message(PHONE)),
+         lambda: helpers.render('location', PHONE)),
+        ('buttons', lambda: json.dumps(helpers.buttons_message(PHONE)),
+         lambda: helpers.render('buttons', PHONE)),
+        ('list', lambda: json.dumps(helpers.list_message(PHONE)),
+         lambda: helpers.render('list', PHONE)),
+    ]
+    print(f"{'payload':>10} {'dict+dumps':>14} {'template':>14} {'speedup':>8}")
+    for name, legacy, template in cases:
+        old = min(timeit.repeat(legacy, number=args.number, repeat=args.repeat)) / args.number
+        new = min(timeit.repeat(template, number=args.number, repeat=args.repeat)) / args.number
+        print(f'{name:>10} {old * 1e6:9.2f} us/op {new * 1e6:9.2f} us/op {old / new:7.1f}x'
+              f'   ({1 / new:,.0f} payloads/s)')
+
+
+if __name__ == '__main__':
+    main()
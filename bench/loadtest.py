@@ -0,0 +1,411 @@
+"""Load-test the Flask app end to end with every external service stubbed.
+
+The app runs in-process behind werkzeug's threaded server, like
+``bench_modes.py``. Each dependency gets its own local ``StubServer`` with
+its own injectable latency and error rate: the WhatsApp Cloud API (messages,
+media metadata and bytes), SAIA (``/v1/files`` and ``/chat``), the Azure AD
+token endpoint and the Graph drive. Mongo is mongomock by default, or a real
+server with ``--mongo mongodb://...``, or ``--mongo off``.
+
+Each scenario replays webhook bodies at ``--rate`` messages per second (open
+loop; latency counts from the scheduled send time, so a stalled server is not
+hidden by a stalled client) or, with ``--rate 0``, as fast as ``--concurrency``
+requests in flight allow. A scenario ends once every dispatched message was
+handled, every media job finished and the send queue is empty.
+
+    python bench/loadtest.py --scenarios text,document,mixed --messages 300 --rate 50
+    python bench/loadtest.py --latency saia=1.5,graph=0.3 --errors saia=0.2 --out base.json
+    python bench/loadtest.py --replay webhooks.jsonl --compare base.json
+
+Scenarios: ``text`` ("hola" messages), ``document`` (PDF documents through the
+media pipeline), ``mixed`` (one document every ``--doc-every`` messages) and
+``replay`` (the bodies in ``--replay``: one JSON body, a list, or one per line, with
+message ids rewritten so deduplication lets them through).
+
+Reported per scenario: webhook ack latency p50/p95/p99, throughput (acks and
+fully handled messages per second), RSS now and peak, the p95 of every
+pipeline stage and the calls each stub received. ``--out`` saves the results
+with the current commit, ``--compare`` prints the change against a saved file
+(e.g. one taken on another commit). RSS includes the load generator and the
+stubs, which share the process.
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import itertools
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.bench_modes import _free_port, _start_sync  # noqa: E402
+from bench.stubs import StubServer, media_bytes, whatsapp_sha256  # noqa: E402
+
+SERVICES = ('whatsapp', 'saia', 'login', 'graph')
+MEDIA_TYPES = ('image', 'document')
+# Métricas comparables entre corridas y si un valor mayor es mejor
+COMPARED = (
+    ('ack_p50_ms', False), ('ack_p95_ms', False), ('ack_p99_ms', False),
+    ('acks_per_second', True), ('handled_per_second', True), ('rss_peak_mb', False),
+)
+
+
+def _parse_map(spec: str, default: float) -> dict:
+    """'saia=0.8,graph=0.2' -> {service: value}, unspecified services get ``default``."""
+    values = dict.fromkeys(SERVICES, default)
+    for item in (spec or '').split(','):
+        name, sep, value = item.partition('=')
+        if not sep:
+            continue
+        if name.strip() not in values:
+            raise SystemExit(f'unknown service {name.strip()!r}, expected one of {", ".join(SERVICES)}')
+        values[name.strip()] = float(value)
+    return values
+
+
+def _quantile(sorted_values, q: float):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def _rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return float('nan')
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa KiB, macOS bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+def _commit() -> str:
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, timeout=10)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True, timeout=10).stdout.strip()
+        return out.stdout.strip() + ('-dirty' if dirty else '') if out.returncode == 0 else 'unknown'
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+
+# ---------------------------------------------------------------- webhooks
+def _load_template(name: str) -> dict:
+    with open(os.path.join(ROOT, 'example', name), encoding='utf-8') as fh:
+        return json.load(fh)
+
+
+def _messages(body: dict):
+    for entry in body.get('entry') or []:
+        for change in entry.get('changes') or []:
+            yield from (change.get('value') or {}).get('messages') or []
+
+
+def _text_body(template: dict, run: str, i: int, phones: int) -> dict:
+    body = copy.deepcopy(template)
+    message = next(_messages(body))
+    message['id'] = f'wamid.load.{run}.{i}'
+    message['from'] = f'5690000{i % phones:04d}'
+    message['text'] = {'body': 'hola'}
+    return body
+
+
+def _document_body(template: dict, run: str, i: int, phones: int, media_size: int) -> dict:
+    body = copy.deepcopy(template)
+    message = next(_messages(body))
+    message['id'] = f'wamid.load.{run}.{i}'
+    message['from'] = f'5690000{i % phones:04d}'
+    media_id = f'load{run}{i}'
+    message['document'] = dict(message['document'], id=media_id, filename=f'bench-{i}.pdf',
+                               sha256=whatsapp_sha256(media_bytes(media_id, media_size)))
+    return body
+
+
+def _replayed(bodies: list, run: str, count: int) -> list:
+    out = []
+    for i, body in zip(range(count), itertools.cycle(bodies)):
+        body = copy.deepcopy(body)
+        for n, message in enumerate(_messages(body)):
+            message['id'] = f"{message.get('id', 'wamid')}.{run}.{i}.{n}"
+        out.append(body)
+    return out
+
+
+def _read_replay(path: str) -> list:
+    with open(path, encoding='utf-8') as fh:
+        text = fh.read().strip()
+    try:
+        bodies = json.loads(text)
+        bodies = bodies if isinstance(bodies, list) else [bodies]
+    except ValueError:
+        bodies = [json.loads(line) for line in text.splitlines() if line.strip()]
+    bodies = [b for b in bodies if isinstance(b, dict) and any(True for _ in _messages(b))]
+    if not bodies:
+        raise SystemExit(f'{path}: no webhook bodies with messages')
+    return bodies
+
+
+def build_bodies(scenario: str, args, run: str) -> list:
+    text = _load_template('send-text.json')
+    document = _load_template('send-document.json')
+    if scenario == 'text':
+        return [_text_body(text, run, i, args.phones) for i in range(args.messages)]
+    if scenario == 'document':
+        return [_document_body(document, run, i, args.phones, args.media_size) for i in range(args.messages)]
+    if scenario == 'mixed':
+        return [
+            _document_body(document, run, i, args.phones, args.media_size) if i % args.doc_every == 0
+            else _text_body(text, run, i, args.phones)
+            for i in range(args.messages)
+        ]
+    if scenario == 'replay':
+        if not args.replay:
+            raise SystemExit('the replay scenario needs --replay FILE')
+        return _replayed(_read_replay(args.replay), run, args.messages)
+    raise SystemExit(f'unknown scenario {scenario!r}')
+
+
+# -------------------------------------------------------------------- load
+async def _load(url: str, bodies, rate: float, concurrency: int):
+    """POST every body; returns (latencies in seconds, failed requests, seconds until the last ack)."""
+    import httpx
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, failures = [], []
+    started = time.perf_counter()
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=concurrency), timeout=60) as client:
+        async def post(i, body):
+            scheduled = started + i / rate if rate > 0 else None
+            if scheduled is not None:
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            async with semaphore:
+                sent = time.perf_counter()
+                try:
+                    r = await client.post(url, content=body, headers={'Content-Type': 'application/json'})
+                    ok = r.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append(time.perf_counter() - (scheduled if scheduled is not None else sent))
+                if not ok:
+                    failures.append(i)
+
+        await asyncio.gather(*(post(i, b) for i, b in enumerate(bodies)))
+    return latencies, len(failures), time.perf_counter() - started
+
+
+def _settled(app_main) -> bool:
+    dispatch = app_main.dispatcher.metrics
+    jobs = app_main.media_pipeline.metrics
+    sends = app_main.whatsapp.get_send_queue().stats()
+    return (dispatch['completed'] + dispatch['errors'] >= dispatch['submitted']
+            and jobs['completed'] + jobs['failed'] + jobs['halted'] >= jobs['submitted']
+            and jobs.get('parked', 0) == 0
+            and sends['pending'] <= 0)
+
+
+def _delta(after: dict, before: dict) -> dict:
+    return {k: v - (before.get(k) or 0) for k, v in after.items() if isinstance(v, (int, float)) and not isinstance(v, bool)}
+
+
+def run_scenario(name: str, app_main, stubs: dict, port: int, args) -> dict:
+    from utils.metrics import tracer
+    run = f'{name}{int(time.time() * 1000) % 10 ** 8}'
+    bodies = [json.dumps(b).encode() for b in build_bodies(name, args, run)]
+    documents = sum(1 for raw in bodies for m in _messages(json.loads(raw)) if m.get('type') in MEDIA_TYPES)
+    for stub in stubs.values():
+        stub.reset()
+    tracer.reset()
+    jobs_before = dict(app_main.media_pipeline.metrics)
+    sends_before = dict(app_main.whatsapp.get_send_queue().stats())
+
+    started = time.perf_counter()
+    latencies, failed, acked = asyncio.run(_load(f'http://127.0.0.1:{port}/whatsapp', bodies, args.rate, args.concurrency))
+    deadline = time.monotonic() + args.timeout
+    while not _settled(app_main) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    elapsed = time.perf_counter() - started
+    settled = _settled(app_main)
+
+    latencies.sort()
+    jobs = _delta(app_main.media_pipeline.metrics, jobs_before)
+    sends = _delta(app_main.whatsapp.get_send_queue().stats(), sends_before)
+    stages = {
+        stage: round(histogram.quantiles((0.95,))[0.95] * 1000, 1)
+        for stage, histogram in sorted(tracer.histograms().items())
+        if histogram.quantiles((0.95,))[0.95] is not None
+    }
+    return {
+        'scenario': name,
+        'messages': len(bodies),
+        'documents': documents,
+        'rate': args.rate,
+        'failed_requests': failed,
+        'settled': settled,
+        'ack_p50_ms': _quantile(latencies, 0.50) * 1000,
+        'ack_p95_ms': _quantile(latencies, 0.95) * 1000,
+        'ack_p99_ms': _quantile(latencies, 0.99) * 1000,
+        'ack_seconds': acked,
+        'end_to_end_seconds': elapsed,
+        'acks_per_second': len(bodies) / acked,
+        'handled_per_second': len(bodies) / elapsed,
+        'rss_mb': _rss_mb(),
+        'rss_peak_mb': _peak_rss_mb(),
+        'jobs': {k: jobs.get(k, 0) for k in ('completed', 'failed', 'halted', 'deferred', 'stage_retries')},
+        'replies_sent': sends.get('sent', 0),
+        'replies_failed': sends.get('failed', 0),
+        'stage_p95_ms': stages,
+        'stub_calls': {service: stub.count for service, stub in stubs.items()},
+    }
+
+
+# ----------------------------------------------------------------- reports
+def _print_results(results: list) -> None:
+    for r in results:
+        jobs = r['jobs']
+        print(f"{r['scenario']:>8}: {r['handled_per_second']:8.1f} msg/s handled  {r['acks_per_second']:8.1f} acks/s  "
+              f"ack p50 {r['ack_p50_ms']:7.1f} ms  p95 {r['ack_p95_ms']:7.1f} ms  p99 {r['ack_p99_ms']:7.1f} ms  "
+              f"rss {r['rss_mb']:6.1f} MB (peak {r['rss_peak_mb']:6.1f})"
+              + ('' if r['settled'] else '  NOT SETTLED'))
+        print(f"{'':>10}requests failed {r['failed_requests']}  replies {r['replies_sent']} sent / {r['replies_failed']} failed  "
+              f"jobs {jobs['completed']} ok / {jobs['failed']} failed / {jobs['deferred']} deferred  "
+              f"stubs {' '.join(f'{k}={v}' for k, v in r['stub_calls'].items())}")
+        if r['stage_p95_ms']:
+            print(f"{'':>10}stage p95 ms: {' '.join(f'{k}={v}' for k, v in r['stage_p95_ms'].items())}")
+
+
+def _print_comparison(results: list, baseline: dict) -> None:
+    base = {r['scenario']: r for r in baseline.get('results', [])}
+    print(f"\ncompared with {baseline.get('commit', '?')} ({baseline.get('timestamp', '?')}):")
+    for r in results:
+        old = base.get(r['scenario'])
+        if old is None:
+            print(f"{r['scenario']:>8}: not in baseline")
+            continue
+        parts = []
+        for metric, higher_is_better in COMPARED:
+            before, now = old.get(metric), r.get(metric)
+            if not before or now is None:
+                continue
+            change = (now - before) / before * 100
+            better = change > 0 if higher_is_better else change < 0
+            mark = '+' if better else '-' if abs(change) >= 0.5 else ' '
+            parts.append(f"{metric} {before:.1f}->{now:.1f} ({change:+.1f}%{mark})")
+        print(f"{r['scenario']:>8}: " + '  '.join(parts))
+
+
+# -------------------------------------------------------------------- setup
+def _configure_env(stubs: dict, args) -> None:
+    os.environ.update({
+        'WSP_API_URL': stubs['whatsapp'].url,
+        'WSP_API_VERSION': 'v0',
+        'WSP_API_PHONE_ID': 'bench',
+        'WSP_API_TOKEN': 'bench',
+        'WSP_APP_SECRET': '',
+        'GEAI_API_TOKEN': 'bench',
+        'ORGANIZATION_ID': 'bench',
+        'PROJECT_ID': 'bench',
+        'ASSISTANT_ID': 'bench',
+        'SAIA_BASE_URL': stubs['saia'].url,
+        'GRAPH_LOGIN_URL': stubs['login'].url,
+        'GRAPH_API_URL': stubs['graph'].url,
+        'GRAPH_TENANT_ID': 'bench',
+        'GRAPH_CLIENT_ID': 'bench',
+        'GRAPH_CLIENT_SECRET': 'bench',
+        'GRAPH_TOKEN_STORE': 'memory',
+        'ONEDRIVE_USER': 'bench',
+        'JOB_WORKERS': str(args.job_workers),
+        'LOG_LEVEL': args.log_level,
+    })
+    if args.mongo.startswith('mongodb'):
+        os.environ['MONGO_URI'] = args.mongo
+        os.environ.setdefault('MONGO_DATABASE', 'flask-wsp-loadtest')
+
+
+def _configure_mongo(app_main, mode: str) -> None:
+    mongo = app_main.mongo
+    if mode == 'off':
+        mongo._db = None
+    elif mode == 'mock':
+        import mongomock
+        from config import Config
+        mongo._client = mongomock.MongoClient()
+        mongo._db = mongo._client[Config.MONGO_DATABASE]
+        mongo._collections = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default='text,document,mixed')
+    parser.add_argument('--messages', type=int, default=200, help='webhooks per scenario')
+    parser.add_argument('--rate', type=float, default=50.0, help='webhooks per second (0 = closed loop)')
+    parser.add_argument('--concurrency', type=int, default=50, help='max requests in flight')
+    parser.add_argument('--phones', type=int, default=100)
+    parser.add_argument('--doc-every', type=int, default=5, help='mixed: one document every N messages')
+    parser.add_argument('--media-size', type=int, default=64 * 1024, help='bytes per stub media file')
+    parser.add_argument('--latency', default='', help='per-service stub latency in seconds, e.g. saia=0.8,graph=0.2')
+    parser.add_argument('--default-latency', type=float, default=0.05)
+    parser.add_argument('--errors', default='', help='per-service 503 rate, e.g. saia=0.1')
+    parser.add_argument('--mongo', default='mock', help="'mock' (mongomock), 'off' or a mongodb:// URI")
+    parser.add_argument('--job-workers', type=int, default=4)
+    parser.add_argument('--replay', help='webhook bodies for the replay scenario (JSON body, list or JSONL)')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds to wait for a scenario to settle')
+    parser.add_argument('--log-level', default='ERROR')
+    parser.add_argument('--out', help='save the results (JSON) here')
+    parser.add_argument('--compare', help='results file from an earlier run to compare against')
+    args = parser.parse_args()
+
+    latency = _parse_map(args.latency, args.default_latency)
+    errors = _parse_map(args.errors, 0.0)
+    stubs = {
+        service: StubServer(latency=latency[service], error_rate=errors[service], media_size=args.media_size).start()
+        for service in SERVICES
+    }
+    _configure_env(stubs, args)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as app_main
+    _configure_mongo(app_main, args.mongo)
+
+    port = _free_port()
+    stop = _start_sync(app_main.app, port)
+    results = []
+    try:
+        for name in args.scenarios.split(','):
+            results.append(run_scenario(name.strip(), app_main, stubs, port, args))
+    finally:
+        stop()
+        for stub in stubs.values():
+            stub.stop()
+
+    _print_results(results)
+    report = {
+        'commit': _commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'args': vars(args),
+        'latency': latency,
+        'errors': errors,
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as fh:
+            _print_comparison(results, json.load(fh))
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""Local stand-ins for the external APIs used by the benchmarks.
+
+``StubServer`` is a threaded HTTP server whose handlers sleep for a
+configurable latency before answering, so the app under test spends its time
+waiting on I/O exactly like it does against the real services. One server
+answers every surface the app talks to, routed by path:
+
+- WhatsApp Cloud API: ``POST /{version}/{phone_id}/messages``, media
+  metadata ``GET /{version}/{media_id}`` and the media bytes ``GET /media/{id}``
+  (point ``WSP_API_URL`` here)
+- SAIA: ``POST /v1/files`` and ``POST /chat``, JSON or SSE (``SAIA_BASE_URL``)
+- Azure AD token: ``POST /{tenant}/oauth2/v2.0/token`` (``GRAPH_LOGIN_URL``)
+- Graph drive: ``PUT ...:/content``, ``createUploadSession`` and its ranged
+  PUTs (``GRAPH_API_URL``)
+
+Run one instance per dependency to give each its own latency and error rate.
+"""
+import base64
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.streams import QuickXorHash  # noqa: E402
+
+# Respuesta del asistente: JSON válido para el esquema 'otro', así no hay reintento de validación
+CHAT_ANSWER = json.dumps({
+    'tipo_documento': 'otro',
+    'resumen': 'Documento de prueba generado por el benchmark.',
+    'message': 'Recibimos tu documento de prueba.',
+}, ensure_ascii=False)
+
+
+def media_bytes(media_id: str, size: int) -> bytes:
+    """Deterministic content for ``media_id``: every id is a distinct file, same id same bytes."""
+    seed = hashlib.sha256(media_id.encode()).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def whatsapp_sha256(content: bytes) -> str:
+    """SHA-256 the way WhatsApp reports it in webhooks and media metadata (base64)."""
+    return base64.b64encode(hashlib.sha256(content).digest()).decode()
+
+
+def _sse(text: str, pieces: int = 4) -> bytes:
+    step = max(1, len(text) // pieces)
+    events = [
+        json.dumps({'choices': [{'delta': {'content': text[i:i + step]}}]}, ensure_ascii=False)
+        for i in range(0, len(text), step)
+    ]
+    return ''.join(f'data: {event}\n\n' for event in events + ['[DONE]']).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes, content_type: str = 'application/json') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _dispatch(self, method: str) -> None:
+        server: StubServer = self.server.stub
+        body = self._read_body()
+        time.sleep(server.latency)
+        server.record(method, self.path, body)
+        if server.error_rate and random.random() < server.error_rate:
+            self._reply(503, b'{"error": "injected"}')
+            return
+        path = self.path.split('?', 1)[0]
+        if path.endswith(':/createUploadSession') or path.startswith('/upload/'):
+            status, payload = server.graph_upload(method, path, self.headers, body)
+            self._reply(status, json.dumps(payload).encode())
+            return
+        if method == 'PUT' and path.endswith(':/content'):
+            self._reply(201, json.dumps(server.drive_item(path, body)).encode())
+        elif method == 'POST' and path.endswith('/messages'):
+            payload = {'messaging_product': 'whatsapp', 'messages': [{'id': f'wamid.stub{server.count}'}]}
+            self._reply(200, json.dumps(payload).encode())
+        elif method == 'POST' and path.endswith('/oauth2/v2.0/token'):
+            self._reply(200, json.dumps({'token_type': 'Bearer', 'access_token': 'stub-token', 'expires_in': 3599}).encode())
+        elif method == 'POST' and path == '/v1/files':
+            name = self.headers.get('fileName') or 'file'
+            self._reply(200, json.dumps({'id': uuid.uuid4().hex, 'name': name, 'size': len(body)}).encode())
+        elif method == 'POST' and path == '/chat':
+            if json.loads(body or b'{}').get('stream'):
+                self._reply(200, _sse(CHAT_ANSWER), 'text/event-stream')
+            else:
+                payload = {'choices': [{'message': {'role': 'assistant', 'content': CHAT_ANSWER}}]}
+                self._reply(200, json.dumps(payload, ensure_ascii=False).encode())
+        elif method == 'GET' and path.startswith('/media/'):
+            self._reply(200, media_bytes(path[len('/media/'):], server.media_size), 'application/pdf')
+        elif method == 'GET' and path.count('/') == 2:
+            # /{version}/{media_id}: metadatos del archivo, como la Cloud API
+            media_id = path.rsplit('/', 1)[-1]
+            content = media_bytes(media_id, server.media_size)
+            self._reply(200, json.dumps({
+                'messaging_product': 'whatsapp',
+                'id': media_id,
+                'url': f'{server.url}/media/{media_id}',
+                'mime_type': 'application/pdf',
+                'sha256': whatsapp_sha256(content),
+                'file_size': len(content),
+            }).encode())
+        else:
+            self._reply(200, b'{}')
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubServer:
+    """Serve the WhatsApp, SAIA, Azure token and Graph surfaces on ``127.0.0.1``.
+
+    Every call waits ``latency`` seconds and fails with 503 with probability
+    ``error_rate``; both can be changed while the server runs. Media files
+    are ``media_size`` bytes.
+    """
+
+    def __init__(self, latency: float = 0.05, port: int = 0, error_rate: float = 0.0, media_size: int = 64 * 1024):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.media_size = media_size
+        self.uploads: Dict[str, bytearray] = {}
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.stub = self
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.count = 0
+        self.paths: Dict[str, int] = {}
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def record(self, method: str, path: str, body: bytes) -> None:
+        with self._lock:
+            self.count += 1
+            key = f'{method} {path}'
+            self.paths[key] = self.paths.get(key, 0) + 1
+
+    def graph_upload(self, method: str, path: str, headers, body: bytes):
+        """Emulate Graph ``createUploadSession`` and its ranged PUTs."""
+        if path.endswith(':/createUploadSession'):
+            upload_id = uuid.uuid4().hex
+            name = path.split(':/')[-2].rsplit('/', 1)[-1]
+            with self._lock:
+                self.uploads[upload_id] = bytearray()
+                self.uploads[upload_id + ':name'] = bytearray(name.encode())
+            return 200, {'uploadUrl': f'{self.url}/upload/{upload_id}', 'nextExpectedRanges': ['0-']}
+        upload_id = path.split('/')[2]
+        data = self.uploads.get(upload_id)
+        if data is None:
+            return 404, {'error': {'code': 'itemNotFound'}}
+        if method == 'GET':
+            return 200, {'nextExpectedRanges': [f'{len(data)}-']}
+        # Content-Range: bytes start-end/total
+        start_end, total = headers.get('Content-Range', '').split(' ')[-1].split('/')
+        start, end = (int(x) for x in start_end.split('-'))
+        if start != len(data) or end - start + 1 != len(body):
+            return 416, {'nextExpectedRanges': [f'{len(data)}-']}
+        data.extend(body)
+        if len(data) < int(total):
+            return 202, {'nextExpectedRanges': [f'{len(data)}-']}
+        quickxor = QuickXorHash()
+        quickxor.update(bytes(data))
+        name = self.uploads.get(upload_id + ':name', bytearray()).decode()
+        return 201, {
+            'id': upload_id,
+            'name': name,
+            'size': len(data),
+            'file': {'hashes': {'quickXorHash': quickxor.b64digest()}},
+            '@microsoft.graph.downloadUrl': f'{self.url}/download/{upload_id}',
+        }
+
+    def drive_item(self, path: str, body: bytes) -> dict:
+        """DriveItem for a small-file ``PUT .../root:/{path}:/content``."""
+        item_id = uuid.uuid4().hex
+        quickxor = QuickXorHash()
+        quickxor.update(body)
+        return {
+            'id': item_id,
+            'name': path.split(':/')[-2].rsplit('/', 1)[-1],
+            'size': len(body),
+            'file': {'hashes': {'quickXorHash': quickxor.b64digest()}},
+            '@microsoft.graph.downloadUrl': f'{self.url}/download/{item_id}',
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.count = 0
+            self.paths = {}
+
+    def start(self) -> 'StubServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
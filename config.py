@@ -1,10 +1,143 @@
 from pymongo import MongoClient
+import logging
 import os
+import threading
+import time
+
+logger = logging.getLogger("app.config")
 
 class Config:
     # Configuración de MongoDB - Leer desde variables de entorno
     MONGO_URI = os.getenv('MONGO_URI')
     MONGO_DATABASE = os.getenv('MONGO_DATABASE', 'flask-wsp-api')
+    # Pool de conexiones y fail-fast cuando el cluster no responde
+    MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '50'))
+    MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '0'))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', '2000'))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '3000'))
+    # Heartbeat en segundo plano: tras N pings fallidos el circuito se abre y get_collection devuelve None
+    MONGO_HEARTBEAT_SECONDS = float(os.getenv('MONGO_HEARTBEAT_SECONDS', '10'))
+    MONGO_BREAKER_THRESHOLD = int(os.getenv('MONGO_BREAKER_THRESHOLD', '2'))
+
+    # Pipeline de jobs para archivos (descarga, SAIA, OneDrive, respuesta)
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+    JOB_MAX_RETRIES = int(os.getenv('JOB_MAX_RETRIES', '2'))
+    JOB_RETRY_BACKOFF = float(os.getenv('JOB_RETRY_BACKOFF', '1.0'))
+    # SAIA y OneDrive corren en paralelo; tiempo máximo por rama en segundos (0 = sin límite)
+    JOB_SAIA_TIMEOUT = float(os.getenv('JOB_SAIA_TIMEOUT', '180')) or None
+    JOB_ONEDRIVE_TIMEOUT = float(os.getenv('JOB_ONEDRIVE_TIMEOUT', '600')) or None
+    # Jobs sin cambios por más de N segundos (proceso caído) se retoman desde el inicio; 0 = no retomar
+    JOB_RECOVER_AFTER = float(os.getenv('JOB_RECOVER_AFTER', '1800')) or None
+    # API de SAIA (archivos y chat); apuntar a un stub local para pruebas de carga
+    SAIA_BASE_URL = os.getenv('SAIA_BASE_URL', 'https://api.saia.ai').rstrip('/')
+    # Chat de SAIA por streaming (SSE): aviso de progreso al usuario apenas llegan los primeros tokens
+    SAIA_STREAM = os.getenv('SAIA_STREAM', 'true').lower() in ('1', 'true', 'yes')
+    SAIA_STREAM_MAX_LINE = int(os.getenv('SAIA_STREAM_MAX_LINE', str(1024 * 1024)))
+    SAIA_PROGRESS_MIN_CHARS = int(os.getenv('SAIA_PROGRESS_MIN_CHARS', '20'))
+    SAIA_PROGRESS_MESSAGE = os.getenv('SAIA_PROGRESS_MESSAGE', 'Estamos leyendo tu documento, en unos segundos te enviamos lo que encontramos.')
+    # Extracción estructurada: JSON validado por tipo de documento, cacheado por sha256 + versión del esquema
+    SAIA_STRUCTURED_OUTPUT = os.getenv('SAIA_STRUCTURED_OUTPUT', 'true').lower() in ('1', 'true', 'yes')
+    # Bulkhead y circuito por dependencia: llamadas simultáneas, espera máxima por un cupo (s), fallos seguidos
+    # que abren el circuito y segundos hasta la llamada de prueba (half-open). Con el circuito abierto o sin
+    # cupo el job se aplaza y se reencola, hasta JOB_MAX_DEFERRALS veces
+    SAIA_MAX_CONCURRENT = int(os.getenv('SAIA_MAX_CONCURRENT', '4'))
+    SAIA_QUEUE_TIMEOUT = float(os.getenv('SAIA_QUEUE_TIMEOUT', '5'))
+    SAIA_BREAKER_THRESHOLD = int(os.getenv('SAIA_BREAKER_THRESHOLD', '5'))
+    SAIA_BREAKER_RESET_SECONDS = float(os.getenv('SAIA_BREAKER_RESET_SECONDS', '30'))
+    GRAPH_MAX_CONCURRENT = int(os.getenv('GRAPH_MAX_CONCURRENT', '4'))
+    GRAPH_QUEUE_TIMEOUT = float(os.getenv('GRAPH_QUEUE_TIMEOUT', '5'))
+    GRAPH_BREAKER_THRESHOLD = int(os.getenv('GRAPH_BREAKER_THRESHOLD', '5'))
+    GRAPH_BREAKER_RESET_SECONDS = float(os.getenv('GRAPH_BREAKER_RESET_SECONDS', '30'))
+    JOB_MAX_DEFERRALS = int(os.getenv('JOB_MAX_DEFERRALS', '10'))
+
+    # Workers para procesar los mensajes de un webhook (orden FIFO por teléfono)
+    DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', '8'))
+
+    # Deduplicación de webhooks por id de mensaje de WhatsApp
+    DEDUP_TTL_SECONDS = int(os.getenv('DEDUP_TTL_SECONDS', str(24 * 3600)))
+    DEDUP_MAX_SIZE = int(os.getenv('DEDUP_MAX_SIZE', '10000'))
+    DEDUP_USE_MONGO = os.getenv('DEDUP_USE_MONGO', 'false').lower() in ('1', 'true', 'yes')
+
+    # Pools HTTP compartidos (keep-alive) para WhatsApp, Graph y SAIA
+    HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', '10'))
+    HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '20'))
+    HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '2'))
+    HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', '0.5'))
+    HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+    HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '60'))
+
+    # Webhook: firma X-Hub-Signature-256 con el App Secret de Meta (sin secreto no se valida) y tamaño máximo
+    WSP_APP_SECRET = os.getenv('WSP_APP_SECRET')
+    WEBHOOK_MAX_BODY_BYTES = int(os.getenv('WEBHOOK_MAX_BODY_BYTES', str(1024 * 1024)))
+
+    # Latencia por etapa (histogramas) y endpoint /metrics en formato Prometheus; desactivado casi no cuesta
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+    # Logging JSON por cola (no bloquea los requests); niveles por módulo y muestreo de eventos frecuentes
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_LEVELS = os.getenv('LOG_LEVELS', 'urllib3=WARNING,httpx=WARNING,pymongo=WARNING')
+    LOG_SAMPLE = os.getenv('LOG_SAMPLE', '')
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+    # Cola de envío a WhatsApp: FIFO por destinatario, token bucket global y reintentos 429/5xx
+    WSP_SEND_WORKERS = int(os.getenv('WSP_SEND_WORKERS', '8'))
+    WSP_SEND_RATE = float(os.getenv('WSP_SEND_RATE', '80'))
+    WSP_SEND_BURST = float(os.getenv('WSP_SEND_BURST', '80'))
+    WSP_SEND_MAX_RETRIES = int(os.getenv('WSP_SEND_MAX_RETRIES', '3'))
+    WSP_SEND_BACKOFF = float(os.getenv('WSP_SEND_BACKOFF', '1.0'))
+
+    # Broadcast masivo: sin BROADCAST_API_TOKEN el endpoint queda deshabilitado
+    BROADCAST_API_TOKEN = os.getenv('BROADCAST_API_TOKEN')
+    BROADCAST_WINDOW = int(os.getenv('BROADCAST_WINDOW', '200'))
+    BROADCAST_CHECKPOINT_EVERY = int(os.getenv('BROADCAST_CHECKPOINT_EVERY', '100'))
+    BROADCAST_LEASE_SECONDS = float(os.getenv('BROADCAST_LEASE_SECONDS', '120'))
+    # Corridas terminadas en error antes de marcar el broadcast como fallido
+    BROADCAST_MAX_ERROR_RUNS = int(os.getenv('BROADCAST_MAX_ERROR_RUNS', '3'))
+
+    # Cache del token de Microsoft Graph: memory | file | mongo
+    GRAPH_TOKEN_STORE = os.getenv('GRAPH_TOKEN_STORE', 'memory')
+    GRAPH_TOKEN_FILE = os.getenv('GRAPH_TOKEN_FILE', '/tmp/graph-token.json')
+    GRAPH_TOKEN_REFRESH_MARGIN = int(os.getenv('GRAPH_TOKEN_REFRESH_MARGIN', '300'))
+
+    # Modo async (asgi.py): conversaciones simultáneas y conexiones HTTP por proceso
+    ASYNC_MAX_INFLIGHT = int(os.getenv('ASYNC_MAX_INFLIGHT', '500'))
+    ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv('ASYNC_HTTP_MAX_CONNECTIONS', '100'))
+
+    # Descarga de media por bloques; sobre MEDIA_SPOOL_MAX_MEMORY bytes se usa un archivo temporal
+    MEDIA_CHUNK_SIZE = int(os.getenv('MEDIA_CHUNK_SIZE', str(64 * 1024)))
+    MEDIA_SPOOL_MAX_MEMORY = int(os.getenv('MEDIA_SPOOL_MAX_MEMORY', str(1024 * 1024)))
+    MEDIA_SPOOL_DIR = os.getenv('MEDIA_SPOOL_DIR') or None
+    MEDIA_MAX_SIZE = int(os.getenv('MEDIA_MAX_SIZE', str(100 * 1024 * 1024)))
+
+    # Store direccionado por contenido (sha256) para no reprocesar archivos idénticos
+    MEDIA_STORE_USE_MONGO = os.getenv('MEDIA_STORE_USE_MONGO', 'true').lower() in ('1', 'true', 'yes')
+    MEDIA_STORE_MAX_SIZE = int(os.getenv('MEDIA_STORE_MAX_SIZE', '1024'))
+    MEDIA_STORE_TTL = float(os.getenv('MEDIA_STORE_TTL', '3600'))
+
+    # Búsqueda de personas por teléfono normalizado a E.164 (users.numero_e164)
+    PHONE_DEFAULT_COUNTRY_CODE = os.getenv('PHONE_DEFAULT_COUNTRY_CODE', '56')
+    PHONE_NATIONAL_LENGTH = int(os.getenv('PHONE_NATIONAL_LENGTH', '9'))
+    PERSONA_CACHE_SIZE = int(os.getenv('PERSONA_CACHE_SIZE', '4096'))
+    PERSONA_CACHE_TTL = float(os.getenv('PERSONA_CACHE_TTL', '300'))
+
+    # Sesiones por teléfono (persona, paso del flujo, último documento): LRU en memoria + write-behind a Mongo
+    SESSION_USE_MONGO = os.getenv('SESSION_USE_MONGO', 'true').lower() in ('1', 'true', 'yes')
+    SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+    SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', '600'))
+    SESSION_TTL_SECONDS = float(os.getenv('SESSION_TTL_SECONDS', str(24 * 3600)))
+    SESSION_FLUSH_SECONDS = float(os.getenv('SESSION_FLUSH_SECONDS', '2'))
+
+    # Reglas de intención: 'default' (en código), 'file' (JSON) o 'mongo' (colección intents); recarga en caliente
+    INTENT_RULES_SOURCE = os.getenv('INTENT_RULES_SOURCE', 'default')
+    INTENT_RULES_FILE = os.getenv('INTENT_RULES_FILE', 'example/intents.json')
+    INTENT_RELOAD_SECONDS = float(os.getenv('INTENT_RELOAD_SECONDS', '30'))
+
+    # Microsoft Graph / OneDrive (URLs configurables para pruebas locales)
+    GRAPH_API_URL = os.getenv('GRAPH_API_URL', 'https://graph.microsoft.com/v1.0').rstrip('/')
+    GRAPH_LOGIN_URL = os.getenv('GRAPH_LOGIN_URL', 'https://login.microsoftonline.com').rstrip('/')
+    GRAPH_UPLOAD_CHUNK_SIZE = int(os.getenv('GRAPH_UPLOAD_CHUNK_SIZE', str(16 * 320 * 1024)))
+    GRAPH_UPLOAD_MAX_RETRIES = int(os.getenv('GRAPH_UPLOAD_MAX_RETRIES', '3'))
 
 class MongoConnection:
     _instance = None
@@ -17,35 +150,107 @@ class MongoConnection:
     def __init__(self):
         if self._client is None:
             try:
-                self._client = MongoClient(Config.MONGO_URI)
+                self._client = MongoClient(
+                    Config.MONGO_URI,
+                    maxPoolSize=Config.MONGO_MAX_POOL_SIZE,
+                    minPoolSize=Config.MONGO_MIN_POOL_SIZE,
+                    waitQueueTimeoutMS=Config.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                    serverSelectionTimeoutMS=Config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                )
                 self._db = self._client[Config.MONGO_DATABASE]
-                print(":marca_de_verificación_blanca: Conexión a MongoDB establecida correctamente")
+                logger.info("Conexión a MongoDB establecida correctamente")
             except Exception as e:
-                print(f":x: Error al conectar a MongoDB: {e}")
+                logger.error("Error al conectar a MongoDB: %s", e)
                 self._client = None
                 self._db = None
+            self._collections = {}
+            self._breaker_open = False
+            self._failures = 0
+            self._heartbeat = None
+            self._heartbeat_pid = None
+            self._heartbeat_lock = threading.Lock()
+            self._stop = threading.Event()
+            # El heartbeat y los hilos de cada request actualizan las métricas a la vez
+            self._metrics_lock = threading.Lock()
+            self.metrics = {"pings": 0, "ping_failures": 0, "breaker_opens": 0, "fast_fails": 0}
+    def _count(self, name):
+        with self._metrics_lock:
+            self.metrics[name] += 1
+    def stats(self):
+        with self._metrics_lock:
+            stats = dict(self.metrics)
+        stats['breaker_open'] = self._breaker_open
+        return stats
     def get_database(self):
         return self._db
-    
+
+    @property
+    def breaker_state(self):
+        return 'open' if self._breaker_open else 'closed'
+
+    def _ensure_heartbeat(self):
+        # Un hilo por proceso (el worker de gunicorn hereda el objeto pero no el hilo)
+        if self._heartbeat_pid == os.getpid() or self._client is None:
+            return
+        # Solo un hilo lo arranca aunque lleguen varias peticiones a la vez
+        with self._heartbeat_lock:
+            if self._heartbeat_pid == os.getpid():
+                return
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='mongo-heartbeat', daemon=True)
+            self._heartbeat.start()
+            self._heartbeat_pid = os.getpid()
+
+    def _heartbeat_loop(self):
+        while True:
+            self.ping()
+            if self._stop.wait(Config.MONGO_HEARTBEAT_SECONDS):
+                return
+
+    def ping(self):
+        """
+        Ping al cluster; actualiza el estado del circuito. Lo llama el heartbeat, nunca el camino de cada mensaje
+        """
+        self._count("pings")
+        try:
+            self._client.admin.command('ping')
+        except Exception as e:
+            self._count("ping_failures")
+            self._failures += 1
+            if not self._breaker_open and self._failures >= Config.MONGO_BREAKER_THRESHOLD:
+                self._breaker_open = True
+                self._count("breaker_opens")
+                logger.error("MongoDB no responde, circuito abierto: %s", e)
+            return False
+        if self._breaker_open:
+            logger.warning("MongoDB disponible nuevamente, circuito cerrado")
+        self._failures = 0
+        self._breaker_open = False
+        return True
+
     def get_collection(self, mongo_collection=None):
-        if self._db is not None:
+        if self._db is None:
+            logger.warning("Base de datos no disponible")
+            return None
+        self._ensure_heartbeat()
+        if self._breaker_open:
+            # Fallar rápido sin esperar el timeout de selección de servidor
+            self._count("fast_fails")
+            return None
+        collection = self._collections.get(mongo_collection)
+        if collection is None:
             try:
-                col_name = mongo_collection
-                collection = self._db[col_name]
-                # Verificar que la colección es accesible haciendo un ping simple
-                collection.find_one()
-                return collection
+                collection = self._db[mongo_collection]
             except Exception as e:
-                print(f"Error al acceder a la colección: {e}")
+                logger.error("Error al acceder a la colección: %s", e)
                 return None
-        else:
-            print("Base de datos no disponible")
-            return None
-        
+            self._collections[mongo_collection] = collection
+        return collection
+
     def close_connection(self):
+        self._stop.set()
         if self._client:
             self._client.close()
-            print(":candado: Conexión a MongoDB cerrada")
+            logger.info("Conexión a MongoDB cerrada")
     def test_connection(self):
         try:
             # Test de conexión
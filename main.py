@@ -1,20 +1,53 @@
+import atexit
+import hmac
+import json
+import logging
 import os
-import requests
-import unicodedata
+from datetime import datetime, timezone
 
-from flask import Flask, request
+from flask import Flask, Response, jsonify, request
 from dotenv import load_dotenv
-from config import MongoConnection
+from config import Config, MongoConnection
 
 from utils import helpers
+from utils.bulkhead import graph_guard, saia_guard
 from services import whatsapp
+from services.broadcast import BroadcastManager, validate_template
+from services.dedup import MessageDeduplicator
+from services.directory import PersonaDirectory
+from services.dispatcher import KeyedDispatcher, iter_webhook_events
+# Los helpers de Graph vivían en main: se reexportan para quien los importe desde aquí
+from services.graph import graph_acquire_token, graph_create_share_link, graph_upload_small_file  # noqa: F401
+from services.media import build_media_pipeline, guess_extension  # noqa: F401
+from services.sessions import SessionStore
+from utils.log import configure_logging, correlation, logging_stats, parse_levels, parse_rates
+from utils.intents import DEFAULT_RULES, IntentRouter, ReloadingIntentRouter, file_rules_loader, mongo_rules_loader
+from utils.media_store import ContentStore, MongoBackend
+from utils.metrics import PROMETHEUS_CONTENT_TYPE, tracer
 from utils.saia_console import SAIAConsoleClient
-import json as _json
+from utils.schemas import DEFAULT_REGISTRY
+from utils.signature import WebhookVerifier
+from utils.transport import transport
 load_dotenv()
+configure_logging(
+    Config.LOG_LEVEL,
+    levels=parse_levels(Config.LOG_LEVELS),
+    sample=parse_rates(Config.LOG_SAMPLE),
+    fmt=Config.LOG_FORMAT,
+    queue_size=Config.LOG_QUEUE_SIZE,
+)
+logger = logging.getLogger("app.main")
 
 app = Flask(__name__)
+# Tope global del cuerpo (Content-Length declarado); el webhook además lee con tope propio
+app.config['MAX_CONTENT_LENGTH'] = Config.WEBHOOK_MAX_BODY_BYTES
 mongo = MongoConnection()
 _saia_client = None
+media_store = ContentStore(
+    backend=MongoBackend(lambda: mongo.get_collection('media_store')) if Config.MEDIA_STORE_USE_MONGO else None,
+    max_size=Config.MEDIA_STORE_MAX_SIZE,
+    ttl=Config.MEDIA_STORE_TTL,
+)
 
 def get_saia_client():
     global _saia_client
@@ -24,13 +57,103 @@ def get_saia_client():
         proj = os.getenv('PROJECT_ID')
         assistant = os.getenv('ASSISTANT_ID')
         if token and org and proj and assistant:
-            _saia_client = SAIAConsoleClient(token, org, proj, assistant)
+            _saia_client = SAIAConsoleClient(token, org, proj, assistant, base_url=Config.SAIA_BASE_URL,
+                                             media_store=media_store, stream=Config.SAIA_STREAM,
+                                             max_sse_line=Config.SAIA_STREAM_MAX_LINE)
     return _saia_client
 
+sessions = SessionStore(
+    (lambda: mongo.get_collection('sessions')) if Config.SESSION_USE_MONGO else None,
+    max_size=Config.SESSION_CACHE_SIZE,
+    ttl=Config.SESSION_TTL_SECONDS,
+    cache_ttl=Config.SESSION_CACHE_TTL,
+    flush_interval=Config.SESSION_FLUSH_SECONDS,
+)
+# Escribir las sesiones pendientes al terminar el proceso
+atexit.register(sessions.stop)
+
+media_pipeline = build_media_pipeline(
+    mongo,
+    get_saia_client,
+    workers=Config.JOB_WORKERS,
+    retries=Config.JOB_MAX_RETRIES,
+    backoff=Config.JOB_RETRY_BACKOFF,
+    media_store=media_store,
+    saia_timeout=Config.JOB_SAIA_TIMEOUT,
+    onedrive_timeout=Config.JOB_ONEDRIVE_TIMEOUT,
+    sessions=sessions,
+    progress_message=Config.SAIA_PROGRESS_MESSAGE,
+    progress_min_chars=Config.SAIA_PROGRESS_MIN_CHARS,
+    schemas=DEFAULT_REGISTRY if Config.SAIA_STRUCTURED_OUTPUT else None,
+    max_deferrals=Config.JOB_MAX_DEFERRALS,
+    recover_after=Config.JOB_RECOVER_AFTER,
+)
+media_pipeline.start()
+dispatcher = KeyedDispatcher(workers=Config.DISPATCH_WORKERS)
+directory = PersonaDirectory(
+    lambda: mongo.get_collection('users'),
+    max_size=Config.PERSONA_CACHE_SIZE,
+    ttl=Config.PERSONA_CACHE_TTL,
+    default_country_code=Config.PHONE_DEFAULT_COUNTRY_CODE,
+    national_length=Config.PHONE_NATIONAL_LENGTH,
+)
+webhook_verifier = WebhookVerifier(Config.WSP_APP_SECRET, max_body=Config.WEBHOOK_MAX_BODY_BYTES)
+if not webhook_verifier.enabled:
+    logger.warning("WSP_APP_SECRET no configurado: no se valida la firma de los webhooks")
+deduplicator = MessageDeduplicator(
+    ttl=Config.DEDUP_TTL_SECONDS,
+    max_size=Config.DEDUP_MAX_SIZE,
+    collection_getter=(lambda: mongo.get_collection('processed_messages')) if Config.DEDUP_USE_MONGO else None,
+)
+
+if Config.INTENT_RULES_SOURCE == 'file':
+    intent_router = ReloadingIntentRouter(file_rules_loader(Config.INTENT_RULES_FILE), interval=Config.INTENT_RELOAD_SECONDS)
+elif Config.INTENT_RULES_SOURCE == 'mongo':
+    intent_router = ReloadingIntentRouter(mongo_rules_loader(lambda: mongo.get_collection('intents')), interval=Config.INTENT_RELOAD_SECONDS)
+else:
+    intent_router = IntentRouter(DEFAULT_RULES)
+broadcasts = BroadcastManager(
+    lambda: mongo.get_collection('users'),
+    lambda: mongo.get_collection('broadcasts'),
+    whatsapp.get_send_queue,
+    window=Config.BROADCAST_WINDOW,
+    checkpoint_every=Config.BROADCAST_CHECKPOINT_EVERY,
+    lease_seconds=Config.BROADCAST_LEASE_SECONDS,
+    max_error_runs=Config.BROADCAST_MAX_ERROR_RUNS,
+    default_country_code=Config.PHONE_DEFAULT_COUNTRY_CODE,
+    national_length=Config.PHONE_NATIONAL_LENGTH,
+)
+if Config.BROADCAST_API_TOKEN:
+    # Retomar broadcasts que quedaron a medias (worker caído o ejecución con error) desde su último
+    # checkpoint: al arrancar y luego cada BROADCAST_LEASE_SECONDS
+    broadcasts.start_sweeper()
+
+# Contadores de cada componente, exportados como gauges junto a los histogramas de latencia
+tracer.register('dedup', lambda: deduplicator.metrics, 'Webhook message deduplication.')
+tracer.register('dispatch', lambda: dispatcher.metrics, 'Per-phone webhook dispatcher.')
+tracer.register('send_queue', lambda: whatsapp.get_send_queue().stats(), 'Outbound WhatsApp send queue.')
+tracer.register('media_jobs', lambda: media_pipeline.metrics, 'Media processing pipeline.')
+tracer.register('media_store', lambda: media_store.metrics, 'Content-addressed media store.')
+tracer.register('webhook', lambda: dict(webhook_verifier.metrics, **{f'rejected_{k}': v for k, v in webhook_verifier.rejected.items()}),
+                'Webhook signature and size checks.')
+tracer.register('directory', lambda: directory.metrics, 'Persona lookups by phone.')
+tracer.register('sessions', lambda: sessions.metrics, 'Conversation session store.')
+tracer.register('logging', logging_stats, 'Log records waiting in or dropped from the log queue.')
+tracer.register('mongo', mongo.stats, 'MongoDB heartbeat and breaker.')
+tracer.register('saia', saia_guard.stats, 'SAIA bulkhead and circuit breaker (breaker_state: 0 closed, 1 half-open, 2 open).')
+tracer.register('graph', graph_guard.stats, 'Graph bulkhead and circuit breaker (breaker_state: 0 closed, 1 half-open, 2 open).')
+tracer.register('http', transport.stats, 'Outbound HTTP requests, urllib3 retries and connection pool usage per host.', label='host')
+
 @app.route('/welcome', methods=['GET'])
 def welcome():
     return 'method: welcome'
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not tracer.enabled:
+        return '', 404
+    return Response(tracer.render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
+
 @app.route('/whatsapp', methods=['GET'])
 def wsp_verify_token():
     try:
@@ -45,316 +168,202 @@ def wsp_verify_token():
     except:
         return '', 400
 
+def read_body_capped(stream, limit: int) -> bytes:
+    """
+    Lee como máximo limit + 1 bytes: un cuerpo chunked (sin Content-Length) no se carga entero en memoria
+    """
+    chunks = []
+    size = 0
+    while size <= limit:
+        chunk = stream.read(min(64 * 1024, limit + 1 - size))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    return b''.join(chunks)
+
 @app.route('/whatsapp', methods=['POST'])
 def wsp_received_message():
-    try:
-        body = request.get_json(silent=True) or {}
-        entry = (body.get('entry') or [{}])[0]
-        changes = (entry.get('changes') or [{}])[0]
-        value = changes.get('value', {})
-        messages = (value.get('messages') or [{}])[0]
-
-        print(messages)
-
-        typeMsg = messages.get('type')
-        phone = messages.get('from')
-        text = helpers.get_text_user(messages)
-
-        # Guardar y procesar archivos de imagen/documento
-        if typeMsg in ['image', 'document']:
-            text = typeMsg  # Para informar al flujo de respuesta
-            jsonDataFile = messages.get(typeMsg) or {}
-
-            wsp_file_id = jsonDataFile.get('id')
-            collection = mongo.get_collection('files')
-            inserted_id = None
-            if collection is not None:
-                # Avoid duplicate inserts: try to find existing document by WhatsApp file id
-                try:
-                    existing = collection.find_one({'file.id': wsp_file_id})
-                except Exception:
-                    existing = None
-                if existing:
-                    inserted_id = existing.get('_id')
-                else:
-                    data = {"phone": phone, "file": jsonDataFile}
-                    insert_result = collection.insert_one(data)
-                    inserted_id = insert_result.inserted_id
-            status, file_data = whatsapp.get_file(wsp_file_id)
-
-            if status and isinstance(file_data, dict) and collection is not None and inserted_id is not None:
-                media_url = file_data.get('url')
-                mime_type = file_data.get('mime_type')
-                file_size = file_data.get('file_size')
-
-                # Solo small upload (<= 4MB)
-                if file_size and file_size > 4 * 1024 * 1024:
-                    collection.update_one(
-                        {'_id': inserted_id},
-                        {'$set': {'wsp_media': file_data, 'status': 'too_large_for_small_upload'}}
-                    )
-                else:
-                    headers = {'Authorization': f"Bearer {os.getenv('WSP_API_TOKEN', '')}"}
-                    resp = requests.get(media_url, headers=headers, timeout=60)
-                    resp.raise_for_status()
-                    content_bytes = resp.content
-                    #######################################################
-                    # SAIA flow: subir archivo a SAIA y llamar al chat
-                    filename = jsonDataFile.get('filename') if typeMsg == 'document' else None
-                    if not filename:
-                        ext = guess_extension(mime_type)
-                        filename = f"wsp_{file_data.get('id', 'media')}{ext}"
-
-                    # SAIA flow: use utils.saia_console.SAIAConsoleClient when available
-                    alias = os.path.splitext(filename)[0]
-                    saia_folder = os.getenv('SAIA_UPLOAD_FOLDER', 'test1')
-                    saia_upload_result = None
-                    saia_chat_result = None
-
-                    saia_client = get_saia_client()
-                    if saia_client is not None:
-                        try:
-                            saia_upload_result = saia_client.upload_bytes(content_bytes, filename, folder=saia_folder, alias=alias)
-                        except Exception as e:
-                            saia_upload_result = {'error': 'upload_exception', 'detail': str(e)}
-
-
-
-                        try:
-                            if isinstance(saia_upload_result, dict) and 'error' not in saia_upload_result:
-                                prompt = f"Por favor procesa y extrae la información del archivo: {{file:{alias}}}"
-                                saia_chat_result = saia_client.chat_with_file(prompt, alias)
-                        except Exception as e:
-                            saia_chat_result = {'error': 'chat_exception', 'detail': str(e)}
-
-                        # Extract assistant text from IA response
-                        ia_text = None
-                        try:
-                            if isinstance(saia_chat_result, dict):
-                                choices = saia_chat_result.get('choices')
-                                if isinstance(choices, list) and choices:
-                                    choice0 = choices[0]
-                                    msg = None
-                                    if isinstance(choice0, dict):
-                                        msg = choice0.get('message') or choice0.get('delta') or choice0
-                                    if isinstance(msg, dict):
-                                        c = msg.get('content') or msg.get('text')
-                                        if isinstance(c, str) and c.strip():
-                                            ia_text = c
-                                    elif isinstance(msg, str) and msg.strip():
-                                        ia_text = msg
-
-                                # fallback: find first string
-                                if not ia_text:
-                                    def find_string(o):
-                                        if isinstance(o, str):
-                                            return o
-                                        if isinstance(o, list):
-                                            for vv in o:
-                                                s = find_string(vv)
-                                                if s:
-                                                    return s
-                                            return None
-                                        if isinstance(o, dict):
-                                            for vv in o.values():
-                                                s = find_string(vv)
-                                                if s:
-                                                    return s
-                                            return None
-                                        return None
-                                    ia_text = find_string(saia_chat_result)
-                        except Exception:
-                            ia_text = None
-
-                        # Parse IA JSON inside code fences and store parsed object as-is (fields vary)
-                        try:
-                            if isinstance(ia_text, str):
-                                raw = ia_text.strip()
-                                import re, json
-                                m = re.search(r"```(?:json)?\s*(.*?)\s*```", raw, flags=re.DOTALL | re.IGNORECASE)
-                                candidate = m.group(1).strip() if m else raw
-                                try:
-                                    parsed = json.loads(candidate)
-                                    # store parsed JSON (dict or list) directly under ia_text
-                                    collection.update_one({'_id': inserted_id}, {'$set': {'ia_text': parsed}})
-                                except Exception:
-                                    # not valid JSON: store cleaned string
-                                    cleaned = unicodedata.normalize('NFKC', candidate).strip()
-                                    collection.update_one({'_id': inserted_id}, {'$set': {'ia_text': cleaned}})
-                        except Exception:
-                            try:
-                                collection.update_one({'_id': inserted_id}, {'$set': {'ia_text': ia_text}})
-                            except Exception:
-                                pass
-                    else:
-                        # SAIA client not configured: record nothing about uploads/chat to keep DB compact
-                        saia_upload_result = {'error': 'saia_client_not_configured'}
-
-                    graph_token = graph_acquire_token()
-                    if not graph_token:
-                        collection.update_one(
-                            {'_id': inserted_id},
-                            {'$set': {'wsp_media': file_data, 'status': 'graph_token_error'}}
-                        )
-                    else:
-                        onedrive_user = os.getenv('ONEDRIVE_USER')
-                        upload_folder = os.getenv('ONEDRIVE_UPLOAD_FOLDER', '')
-                        upload_result = graph_upload_small_file(
-                            graph_token,
-                            onedrive_user,
-                            upload_folder,
-                            filename,
-                            content_bytes,
-                            mime_type or 'application/octet-stream'
-                        )
-
-                        # Prepare compact OneDrive metadata: keep only essential fields
-                        # Attach OneDrive download_url into wsp_media for downstream usage; do not store separate 'onedrive' field
-                        download_url = None
-                        if isinstance(upload_result, dict):
-                            drive_item = upload_result
-                            download_url = drive_item.get('@microsoft.graph.downloadUrl')
-
-                        try:
-                            media = dict(file_data) if isinstance(file_data, dict) else {}
-                            if download_url:
-                                media['download_url'] = download_url
-                            collection.update_one(
-                                {'_id': inserted_id},
-                                {'$set': {
-                                    'wsp_media': media,
-                                    'status': 'uploaded' if isinstance(upload_result, dict) else 'upload_failed'
-                                }}
-                            )
-                        except Exception:
-                            pass
-
-        wsp_process_message(text, phone)
-
-        # Enviar la respuesta de la IA (si existe) después de los mensajes predeterminados
+    # Rechazo temprano: tamaño por cabecera y firma HMAC sobre los bytes crudos, antes de parsear JSON
+    if webhook_verifier.precheck(request.content_length):
+        return '', 413
+    # Si supera el tope, verify() lo rechaza como too_large
+    raw = read_body_capped(request.stream, webhook_verifier.max_body)
+    rejected = webhook_verifier.verify(raw, request.headers.get('X-Hub-Signature-256'))
+    if rejected:
+        return '', 413 if rejected == 'too_large' else 401
+    # Id de correlación del request; lo heredan los mensajes despachados y sus jobs
+    with correlation():
         try:
-            if 'ia_text' in locals() and ia_text is not None:
-                if isinstance(ia_text, (dict, list)):
-                    ia_msg = _json.dumps(ia_text, ensure_ascii=False, indent=2)
+            try:
+                with tracer.span('parse'):
+                    body = json.loads(raw) if raw else {}
+            except ValueError:
+                body = {}
+            # Un mismo POST puede traer varios entries/changes/messages/statuses
+            for kind, value, item in iter_webhook_events(body):
+                if kind == 'message':
+                    # Meta reintenta los webhooks: descartar mensajes ya procesados
+                    if deduplicator.is_duplicate(item.get('id')):
+                        continue
+                    dispatcher.submit(item.get('from'), wsp_dispatch_message, item)
                 else:
-                    ia_msg = str(ia_text)
-                whatsapp.send_message(helpers.text_message(ia_msg, phone))
-        except Exception as _e:
-            print(f"No se pudo enviar ia_text por WhatsApp: {_e}")
-
-        return 'EVENT_RECEIVED'
-    except Exception as e:
-        print(f"Error en wsp_received_message: {e}")
-        return 'EVENT_RECEIVED'
+                    dispatcher.submit(item.get('recipient_id'), wsp_handle_status, item)
 
+            return 'EVENT_RECEIVED'
+        except Exception as e:
+            logger.exception("Error en wsp_received_message: %s", e)
+            return 'EVENT_RECEIVED'
 
-def graph_acquire_token():
-    """Obtiene token de Microsoft Graph (client credentials)."""
-    tenant_id = os.getenv('GRAPH_TENANT_ID')
-    client_id = os.getenv('GRAPH_CLIENT_ID')
-    client_secret = os.getenv('GRAPH_CLIENT_SECRET')
-    if not all([tenant_id, client_id, client_secret]):
-        print('GRAPH env vars missing')
-        return None
-    url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    data = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'scope': 'https://graph.microsoft.com/.default'
-    }
-    try:
-        r = requests.post(url, data=data, timeout=30)
-        r.raise_for_status()
-        j = r.json()
-        return j.get('access_token')
-    except Exception as e:
-        print(f'Error acquiring Graph token: {e}')
-        return None
 
+def broadcast_authorized():
+    token = Config.BROADCAST_API_TOKEN
+    if not token:
+        return False
+    # Comparación en tiempo constante, como la firma del webhook
+    received = (request.headers.get('Authorization') or '').encode('utf-8')
+    return hmac.compare_digest(received, f'Bearer {token}'.encode('utf-8'))
 
-def graph_upload_small_file(token: str, onedrive_user: str, upload_folder: str, filename: str, content: bytes, mime_type: str):
+@app.route('/broadcast', methods=['POST'])
+def broadcast_create():
     """
-    Sube un archivo <=4MB a OneDrive: PUT /content.
-    upload_folder: ruta relativa dentro de root (puede ser vacía o con subcarpetas tipo Carpeta/Sub).
+    Inicia un envío masivo: {"template": "Hola {primer_nombre}, ...", "filter": {...}}
     """
-    if not onedrive_user:
-        print('ONEDRIVE_USER missing')
-        return None
-    # Asegurar ruta y codificar espacios
-    folder_path = upload_folder.strip('/') if upload_folder else ''
-    if folder_path:
-        path = f"{folder_path}/{filename}"
-    else:
-        path = filename
-    # Construir URL
-    url = f"https://graph.microsoft.com/v1.0/users/{onedrive_user}/drive/root:/{path}:/content"
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': mime_type or 'application/octet-stream'
-    }
+    if not broadcast_authorized():
+        return '', 403
+    body = request.get_json(silent=True) or {}
+    template = body.get('template')
+    user_filter = body.get('filter') or {}
+    if not isinstance(template, str) or not template.strip() or not isinstance(user_filter, dict):
+        return jsonify({'error': 'template requerido'}), 400
+    problem = validate_template(template)
+    if problem:
+        return jsonify({'error': problem}), 400
     try:
-        resp = requests.put(url, headers=headers, data=content, timeout=120)
-        resp.raise_for_status()
-        return resp.json()  # DriveItem
+        broadcast_id = broadcasts.create(template, user_filter)
     except Exception as e:
-        print(f'Error uploading to OneDrive: {e}')
-        try:
-            print('Response:', resp.text)
-        except Exception:
-            pass
-        return None
+        logger.error("Error al crear broadcast: %s", e)
+        return jsonify({'error': 'no se pudo crear el broadcast'}), 503
+    return jsonify({'id': broadcast_id}), 202
+
+@app.route('/broadcast/<broadcast_id>', methods=['GET'])
+def broadcast_status(broadcast_id):
+    if not broadcast_authorized():
+        return '', 403
+    status = broadcasts.status(broadcast_id)
+    if status is None:
+        return '', 404
+    return jsonify(status)
+
+@app.route('/broadcast/<broadcast_id>/cancel', methods=['POST'])
+def broadcast_cancel(broadcast_id):
+    if not broadcast_authorized():
+        return '', 403
+    return jsonify({'cancelled': broadcasts.cancel(broadcast_id)})
+
+
+def wsp_dispatch_message(messages: dict):
+    """
+    Procesa un mensaje despachado. Si falla, olvida su id para que un reenvío de Meta se procese de nuevo.
+    """
+    try:
+        wsp_handle_message(messages)
+    except Exception:
+        deduplicator.forget(messages.get('id'))
+        raise
+
+
+def wsp_handle_message(messages: dict):
+    typeMsg = messages.get('type')
+    logger.info("mensaje recibido", extra={'event': 'message_received', 'message_id': messages.get('id'), 'type': typeMsg})
+    logger.debug("mensaje: %s", messages)
+
+    phone = messages.get('from')
+    text = helpers.get_text_user(messages)
+
+    # Guardar el archivo y encolar su procesamiento (descarga, SAIA, OneDrive, respuesta)
+    if typeMsg in ['image', 'document']:
+        text = typeMsg  # Para informar al flujo de respuesta
+        wsp_register_media(typeMsg, phone, messages.get(typeMsg) or {})
 
+    wsp_process_message(text, phone)
 
-def graph_create_share_link(token: str, onedrive_user: str, item_id: str, link_type: str = 'view', scope: str = 'anonymous'):
+
+def wsp_register_media(typeMsg: str, phone: str, jsonDataFile: dict):
     """
-    Crea un link compartido para un DriveItem usando createLink.
-    Devuelve el objeto link o None.
+    Guarda el archivo en 'files' y encola el job de procesamiento, salvo que ya esté subido.
     """
-    if not token or not onedrive_user or not item_id:
-        return None
-    url = f"https://graph.microsoft.com/v1.0/users/{onedrive_user}/drive/items/{item_id}/createLink"
-    payload = {
-        'type': link_type,
-        'scope': scope
-    }
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
-    try:
-        r = requests.post(url, headers=headers, json=payload, timeout=30)
-        r.raise_for_status()
-        j = r.json()
-        # j contiene { "link": { "webUrl": "...", ... }, ... }
-        return j.get('link')
-    except Exception as e:
-        print(f'Error creating share link: {e}')
+    wsp_file_id = jsonDataFile.get('id')
+    collection = mongo.get_collection('files')
+    inserted_id = None
+    if collection is not None:
+        # Avoid duplicate inserts: try to find existing document by WhatsApp file id
         try:
-            print('Response:', r.text)
+            existing = collection.find_one({'file.id': wsp_file_id})
         except Exception:
-            pass
-        return None
+            existing = None
+        if existing:
+            inserted_id = existing.get('_id')
+            if existing.get('status') == 'uploaded':
+                # Ya descargado, analizado y archivado: no repetir descarga ni subidas
+                return
+        else:
+            data = {"phone": phone, "file": jsonDataFile}
+            insert_result = collection.insert_one(data)
+            inserted_id = insert_result.inserted_id
+
+    sessions.update(phone, step='document_received', last_document={
+        'file_id': wsp_file_id, 'type': typeMsg, 'status': 'processing'
+    })
+    media_pipeline.submit({
+        'phone': phone,
+        'type': typeMsg,
+        'media': jsonDataFile,
+        'file_doc_id': inserted_id,
+    })
+
+
+def wsp_handle_status(status: dict):
+    """
+    Registra el último estado (sent/delivered/read/failed) de un mensaje enviado.
+    """
+    collection = mongo.get_collection('statuses')
+    if collection is None or not status.get('id'):
+        return
+    collection.update_one(
+        {'_id': status.get('id')},
+        {'$set': {
+            'recipient_id': status.get('recipient_id'),
+            'status': status.get('status'),
+            'timestamp': status.get('timestamp'),
+            'errors': status.get('errors'),
+        }},
+        upsert=True
+    )
 
 
-def guess_extension(mime_type: str) -> str:
-    mapping = {
-        'image/jpeg': '.jpg',
-        'image/png': '.png',
-        'image/gif': '.gif',
-        'application/pdf': '.pdf',
-        'image/webp': '.webp'
-    }
-    return mapping.get(mime_type, '')
+def wsp_process_message(message: str, phone: str):
+    # Encolar: la cola mantiene el orden por teléfono y respeta el rate limit de la Cloud API
+    whatsapp.send_many(wsp_build_replies(message, phone), wait=False)
 
 
-def wsp_process_message(message: str, phone: str):
-    message = message.lower()
+def wsp_build_replies(message: str, phone: str) -> list:
+    """
+    Arma las respuestas para un mensaje de texto sin enviarlas (compartido por el modo sync y el async).
+    """
+    # Una sola pasada con todas las palabras clave (con límites de palabra y sin tildes)
+    intent = intent_router.route(message)
     listData = []
 
-    # Buscar a la persona por número de teléfono para personalizar respuestas
-    persona = buscar_persona_por_telefono(phone)
-    nombre_usuario = persona.get('nombre', '') if persona else ''
+    # La sesión guarda la persona: solo se consulta 'users' la primera vez (o al vencer PERSONA_CACHE_TTL)
+    session = sessions.get(phone)
+    persona = session.get('persona')
+    checked_at = session.get('persona_checked_at')
+    if persona is None or checked_at is None or (datetime.now(timezone.utc) - _aware(checked_at)).total_seconds() > Config.PERSONA_CACHE_TTL:
+        encontrada = buscar_persona_por_telefono(phone)
+        persona = {'nombre': encontrada.get('nombre', '')} if encontrada else {}
+        session = sessions.update(phone, persona=persona, persona_checked_at=datetime.now(timezone.utc))
+    nombre_usuario = persona.get('nombre', '')
     
     # Extraer solo el primer nombre si hay varios nombres
     if nombre_usuario:
@@ -362,60 +371,61 @@ def wsp_process_message(message: str, phone: str):
     else:
         primer_nombre = ''
 
-    if any(p in message for p in ['hi', 'hello', 'hola', 'buenas']):
+    if intent == 'greeting':
         # Personalizar el saludo si se encontró el nombre
         if primer_nombre:
             saludo = f'Hola {primer_nombre}, espero te encuentres bien.'
         else:
             saludo = 'Hola, ¿Cómo estás?'
         
-        data = helpers.text_message(saludo, phone)
-        dataMsg2 = helpers.text_message('Para continuar envíame la foto de tu cédula de identidad', phone)
+        data = helpers.text_payload(saludo, phone)
+        dataMsg2 = helpers.text_payload('Para continuar envíame la foto de tu cédula de identidad', phone)
         listData.extend([data, dataMsg2])
+        sessions.update(phone, step='awaiting_cedula')
 
-    elif any(p in message for p in ['thanks', 'thank', 'thank you', 'gracias']):
+    elif intent == 'thanks':
         # Personalizar el agradecimiento si se encontró el nombre
         if primer_nombre:
             agradecimiento = f'Gracias por contactarnos {primer_nombre}'
         else:
             agradecimiento = 'Gracias por contactarnos'
         
-        data = helpers.text_message(agradecimiento, phone)
+        data = helpers.text_payload(agradecimiento, phone)
         listData.extend([data])
 
 
-    elif any(p in message for p in ['image', 'document']):
-        data = helpers.text_message(f'Gracias {primer_nombre} por la información cargada, esta sera procesada y registrada en sistema', phone)
-        data2 = helpers.text_message(f'Espere ⏰ mientras se procesa su documento 📄', phone)
+    elif intent == 'media':
+        data = helpers.text_payload(f'Gracias {primer_nombre} por la información cargada, esta sera procesada y registrada en sistema', phone)
+        data2 = helpers.text_payload(f'Espere ⏰ mientras se procesa su documento 📄', phone)
         # dataLocation = helpers.location_message(phone)
         listData.extend([data, data2])
 
 
 
 
-    elif any(p in message for p in ['agency']):
-        data = helpers.text_message('Esta es nuestra agencia', phone)
-        dataLocation = helpers.location_message(phone)
+    elif intent == 'agency':
+        data = helpers.text_payload('Esta es nuestra agencia', phone)
+        dataLocation = helpers.render('location', phone)
         listData.extend([data, dataLocation])
 
-    elif any(p in message for p in ['contact']):
-        data = helpers.text_message('*Contact Center:*\n56963230969', phone)
+    elif intent == 'contact':
+        data = helpers.text_payload('*Contact Center:*\n56963230969', phone)
         listData.extend([data])
 
-    elif any(p in message for p in ['buy']):
-        data = helpers.buttons_message(phone)
+    elif intent == 'buy':
+        data = helpers.render('buttons', phone)
         listData.extend([data])
 
-    elif any(p in message for p in ['sell']):
-        data = helpers.buttons_message(phone)
+    elif intent == 'sell':
+        data = helpers.render('buttons', phone)
         listData.extend([data])
 
-    elif any(p in message for p in ['register']):
-        data = helpers.text_message('Ingresa al siguiente links para registrar\nhttps://qa-gestioncontratistas.cmp.cl/#/auth/forgot-password', phone)
+    elif intent == 'register':
+        data = helpers.text_payload('Ingresa al siguiente links para registrar\nhttps://qa-gestioncontratistas.cmp.cl/#/auth/forgot-password', phone)
         listData.extend([data])
 
-    elif any(p in message for p in ['login', 'log in']):
-        data = helpers.text_message('Ingresa al siguiente links para login\nhttps://qa-gestioncontratistas.cmp.cl/#/auth/login', phone)
+    elif intent == 'login':
+        data = helpers.text_payload('Ingresa al siguiente links para login\nhttps://qa-gestioncontratistas.cmp.cl/#/auth/login', phone)
         listData.extend([data])
 
     else:
@@ -425,15 +435,23 @@ def wsp_process_message(message: str, phone: str):
         else:
             mensaje_error = 'Lo siento, no entiendo lo que me quieres decir'
         
-        data = helpers.text_message(mensaje_error, phone)
+        data = helpers.text_payload(mensaje_error, phone)
         listData.extend([data])
 
-    for item in listData:
-        whatsapp.send_message(item)
+        # Flujo de varios pasos: recordar lo que falta sin volver a consultar la base
+        if session.get('step') == 'awaiting_cedula':
+            listData.append(helpers.text_payload('Recuerda que para continuar necesito la foto de tu cédula de identidad', phone))
+
+    return listData
 
 
 
 
+def _aware(value: datetime) -> datetime:
+    # Mongo devuelve fechas sin zona horaria (UTC)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
 def buscar_persona_por_telefono(phone: str):
     """
     Busca una persona en la base de datos usando el número de teléfono
@@ -441,31 +459,23 @@ def buscar_persona_por_telefono(phone: str):
     try:
         if not phone:
             return None
-        
-        collection = mongo.get_collection('users')
-        if collection is not None:
-            # Limpiar el número de teléfono para la búsqueda
-            phone_clean = phone.replace('+', '').replace('-', '').replace(' ', '')
-            
-            # Buscar la persona por número de teléfono (búsqueda flexible)
-            persona = collection.find_one({
-                '$or': [
-                    {'numero': phone},
-                    {'numero': phone_clean},
-                    {'numero': f'+{phone_clean}'},
-                    {'numero': {'$regex': phone_clean, '$options': 'i'}}
-                ]
-            })
-            
-            return persona
-        else:
-            print("No se pudo conectar a la base de datos")
-            return None
-            
+
+        # Coincidencia exacta sobre users.numero_e164 (índice único), con caché en memoria
+        with tracer.span('mongo_lookup'):
+            return directory.find_by_phone(phone)
+
     except Exception as e:
-        print(f"Error al buscar persona por teléfono: {e}")
+        logger.error("Error al buscar persona por teléfono: %s", e)
         return None
 
+@app.cli.command('backfill-phones')
+def backfill_phones():
+    """
+    Pobla users.numero_e164 desde users.numero y crea el índice único
+    """
+    counts = directory.backfill()
+    print(', '.join(f'{k}: {v}' for k, v in counts.items()))
+
 # def buscar_rut(rut: str):
 #     try:
 #         if not rut:
@@ -0,0 +1,302 @@
+import logging
+import os
+import socket
+import string
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from pymongo import ASCENDING, ReturnDocument
+
+from utils import helpers
+from utils.phone import normalize_e164
+
+logger = logging.getLogger("app.services.broadcast")
+
+
+class _SafeFields(dict):
+    """Leave unknown ``{placeholders}`` in a template untouched."""
+
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+
+def validate_template(template: str) -> Optional[str]:
+    """None if ``template`` only uses plain ``{name}`` fields, else why it is rejected.
+
+    Positional fields, attribute/index access and format specs or
+    conversions are refused: they fail at render time or let a template
+    reach Python internals or build huge strings for every recipient.
+    """
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError as e:
+        return f'template inválido: {e}'
+    for _, field, spec, conversion in parsed:
+        if field is None:
+            continue
+        if not field or field.isdigit():
+            return 'template inválido: campos posicionales no permitidos'
+        if '.' in field or '[' in field:
+            return f'template inválido: {{{field}}} no puede acceder a atributos ni índices'
+        if spec or conversion:
+            return f'template inválido: {{{field}}} no admite formato ni conversión'
+    return None
+
+
+def render_text(template: str, user: Dict[str, Any]) -> str:
+    nombre = (user.get('nombre') or '').strip()
+    fields = _SafeFields({k: v for k, v in user.items() if isinstance(v, (str, int, float))})
+    fields['nombre'] = nombre
+    fields['primer_nombre'] = nombre.split()[0] if nombre else ''
+    return template.format_map(fields)
+
+
+class BroadcastManager:
+    """Send one templated text message to every matching user, resumably.
+
+    A broadcast is a document in ``broadcasts`` holding the template, the
+    ``users`` filter and its progress. Recipients are streamed from a cursor
+    sorted by ``_id`` and payloads are built one at a time, so memory stays
+    flat whatever the directory size. At most ``window`` messages are in
+    flight in the rate-limited send queue; ``last_id`` is advanced only past
+    users whose send has finished, and checkpointed every
+    ``checkpoint_every`` messages together with a lease. A broadcast left
+    ``running`` with an expired lease (the worker died) is picked up again by
+    ``resume_pending()`` from its last checkpoint; ``start_sweeper()`` calls
+    it every ``lease_seconds`` in the background. A run that ends in an
+    error is retried the same way, and after ``max_error_runs`` of them the
+    broadcast is marked ``failed``.
+    """
+
+    def __init__(self, users_getter: Callable[[], Any], broadcasts_getter: Callable[[], Any],
+                 send_queue_getter: Callable[[], Any], window: int = 200, checkpoint_every: int = 100,
+                 lease_seconds: float = 120, batch_size: int = 500,
+                 default_country_code: str = '56', national_length: int = 9, max_error_runs: int = 3):
+        self.users_getter = users_getter
+        self.broadcasts_getter = broadcasts_getter
+        self.send_queue_getter = send_queue_getter
+        self.window = window
+        self.checkpoint_every = checkpoint_every
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.default_country_code = default_country_code
+        self.national_length = national_length
+        self.max_error_runs = max_error_runs
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._live: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._sweeper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # --------------------------------------------------------------- lifecycle
+    def create(self, template: str, user_filter: Optional[Dict[str, Any]] = None) -> str:
+        """Store and start a broadcast. Raises ValueError if the template is not acceptable."""
+        problem = validate_template(template)
+        if problem:
+            raise ValueError(problem)
+        broadcasts = self.broadcasts_getter()
+        if broadcasts is None:
+            raise RuntimeError('broadcasts collection unavailable')
+        broadcast_id = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        broadcasts.insert_one({
+            '_id': broadcast_id,
+            'template': template,
+            'filter': user_filter or {},
+            'status': 'running',
+            'last_id': None,
+            'sent': 0,
+            'failed': 0,
+            'skipped': 0,
+            'error_runs': 0,
+            'owner': None,
+            'lease_until': now,
+            'created_at': now,
+            'updated_at': now,
+        })
+        self._claim_and_start(broadcast_id)
+        return broadcast_id
+
+    def cancel(self, broadcast_id: str) -> bool:
+        broadcasts = self.broadcasts_getter()
+        if broadcasts is None:
+            return False
+        result = broadcasts.update_one({'_id': broadcast_id, 'status': 'running'},
+                                       {'$set': {'status': 'cancelled', 'updated_at': datetime.now(timezone.utc)}})
+        return result.modified_count == 1
+
+    def resume_pending(self) -> int:
+        """Restart every running broadcast whose lease expired. Returns how many were claimed."""
+        broadcasts = self.broadcasts_getter()
+        if broadcasts is None:
+            return 0
+        with self._lock:
+            # A run of ours that stalled past its lease is still going: don't start it twice
+            running = {k for k, live in self._live.items() if live.get('run') == 'running'}
+        count = 0
+        stale = {'status': 'running', 'lease_until': {'$lt': datetime.now(timezone.utc)}}
+        for doc in broadcasts.find(stale, {'_id': 1}):
+            if doc['_id'] not in running and self._claim_and_start(doc['_id']):
+                count += 1
+        return count
+
+    def start_sweeper(self, interval: Optional[float] = None) -> None:
+        """Run ``resume_pending()`` now and then every ``interval`` seconds (``lease_seconds`` by default)."""
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=self._sweep, args=(interval or self.lease_seconds,),
+                                         name='broadcast-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self) -> None:
+        self._stop.set()
+
+    def _sweep(self, interval: float) -> None:
+        while True:
+            try:
+                resumed = self.resume_pending()
+                if resumed:
+                    logger.info("resumed %d broadcast(s)", resumed)
+            except Exception as e:
+                logger.warning("broadcast sweep failed: %s", e)
+            if self._stop.wait(interval):
+                return
+
+    def _claim_and_start(self, broadcast_id: str) -> bool:
+        broadcasts = self.broadcasts_getter()
+        now = datetime.now(timezone.utc)
+        doc = broadcasts.find_one_and_update(
+            {'_id': broadcast_id, 'status': 'running', 'lease_until': {'$lt': now + timedelta(seconds=1)}},
+            {'$set': {'owner': self.owner, 'lease_until': now + timedelta(seconds=self.lease_seconds)}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc is None:
+            return False
+        live = {'sent': doc.get('sent', 0), 'failed': doc.get('failed', 0), 'skipped': doc.get('skipped', 0),
+                'started': time.monotonic(), 'resumed_from': doc.get('last_id'), 'run': 'running'}
+        with self._lock:
+            self._live[broadcast_id] = live
+        threading.Thread(target=self._run, args=(doc, live), name=f"broadcast-{broadcast_id[:8]}", daemon=True).start()
+        return True
+
+    # ---------------------------------------------------------------- progress
+    def status(self, broadcast_id: str) -> Optional[Dict[str, Any]]:
+        """Persisted progress, overlaid with live counters and rate when this process runs it."""
+        broadcasts = self.broadcasts_getter()
+        doc = broadcasts.find_one({'_id': broadcast_id}, {'template': 0}) if broadcasts is not None else None
+        with self._lock:
+            live = dict(self._live.get(broadcast_id) or {})
+        if doc is None and not live:
+            return None
+        result = dict(doc or {'_id': broadcast_id})
+        if live:
+            elapsed = max(time.monotonic() - live.pop('started'), 1e-6)
+            baseline = live.pop('baseline', 0)
+            result.update(live)
+            result['per_second'] = (live['sent'] + live['failed'] - baseline) / elapsed
+        for key in ('lease_until', 'created_at', 'updated_at', 'finished_at'):
+            if isinstance(result.get(key), datetime):
+                result[key] = result[key].isoformat()
+        for key in ('last_id', 'resumed_from'):
+            if result.get(key) is not None:
+                result[key] = str(result[key])
+        return result
+
+    # --------------------------------------------------------------- execution
+    def _recipients(self, doc: Dict[str, Any]) -> Iterator[Tuple[Any, Optional[dict]]]:
+        """Yield ``(user_id, payload)`` lazily; payload is None for users without a usable number."""
+        query = dict(doc.get('filter') or {})
+        if doc.get('last_id') is not None:
+            query = {'$and': [query, {'_id': {'$gt': doc['last_id']}}]}
+        cursor = (self.users_getter()
+                  .find(query, {'numero': 1, 'numero_e164': 1, 'nombre': 1})
+                  .sort('_id', ASCENDING)
+                  .batch_size(self.batch_size))
+        template = doc['template']
+        try:
+            for user in cursor:
+                phone = user.get('numero_e164') or normalize_e164(
+                    user.get('numero'), self.default_country_code, self.national_length)
+                if not phone:
+                    yield user['_id'], None
+                    continue
+                yield user['_id'], helpers.text_payload(render_text(template, user), phone.lstrip('+'))
+        finally:
+            cursor.close()
+
+    def _checkpoint(self, broadcast_id: str, live: Dict[str, Any], last_id: Any, **extra) -> bool:
+        """Persist progress and renew the lease. Returns False if the broadcast was cancelled or taken over."""
+        now = datetime.now(timezone.utc)
+        fields = {'sent': live['sent'], 'failed': live['failed'], 'skipped': live['skipped'],
+                  'updated_at': now, 'lease_until': now + timedelta(seconds=self.lease_seconds)}
+        if last_id is not None:
+            fields['last_id'] = last_id
+        fields.update(extra)
+        result = self.broadcasts_getter().update_one(
+            {'_id': broadcast_id, 'status': 'running', 'owner': self.owner}, {'$set': fields})
+        return result.matched_count == 1
+
+    def _run(self, doc: Dict[str, Any], live: Dict[str, Any]) -> None:
+        broadcast_id = doc['_id']
+        live['baseline'] = live['sent'] + live['failed']
+        send_queue = self.send_queue_getter()
+        inflight: deque = deque()
+        last_id = doc.get('last_id')
+        since_checkpoint = 0
+        outcome = 'completed'
+
+        def settle(block: bool) -> int:
+            """Pop finished sends from the head so last_id only moves past completed users."""
+            nonlocal last_id
+            settled = 0
+            while inflight and (block or inflight[0][1] is None or inflight[0][1].done()):
+                user_id, future = inflight.popleft()
+                if future is None:
+                    live['skipped'] += 1
+                elif future.result():
+                    live['sent'] += 1
+                else:
+                    live['failed'] += 1
+                last_id = user_id
+                settled += 1
+                block = block and len(inflight) >= self.window
+            return settled
+
+        try:
+            for user_id, payload in self._recipients(doc):
+                inflight.append((user_id, send_queue.send(payload) if payload is not None else None))
+                since_checkpoint += settle(block=len(inflight) >= self.window)
+                if since_checkpoint >= self.checkpoint_every:
+                    since_checkpoint = 0
+                    if not self._checkpoint(broadcast_id, live, last_id):
+                        outcome = 'stopped'
+                        break
+            while inflight:
+                settle(block=True)
+        except Exception as e:
+            logger.exception("[%s] broadcast failed: %s", broadcast_id, e)
+            outcome = 'error'
+            # Record what did finish; the rest is retried when the broadcast is resumed
+            while inflight and (inflight[0][1] is None or inflight[0][1].done()):
+                settle(block=False)
+
+        live['run'] = outcome
+        if outcome == 'completed':
+            self._checkpoint(broadcast_id, live, last_id, status='completed', finished_at=datetime.now(timezone.utc))
+        elif outcome == 'error':
+            error_runs = doc.get('error_runs', 0) + 1
+            if error_runs >= self.max_error_runs:
+                # El mismo error se repetiría en cada reanudación: dejarlo como fallido
+                self._checkpoint(broadcast_id, live, last_id, error_runs=error_runs, status='failed',
+                                 finished_at=datetime.now(timezone.utc))
+            else:
+                # Keep it 'running' with an expired lease so resume_pending() retries from the checkpoint
+                self._checkpoint(broadcast_id, live, last_id, error_runs=error_runs,
+                                 lease_until=datetime.now(timezone.utc))
+        logger.info("[%s] broadcast %s: sent=%d failed=%d skipped=%d", broadcast_id, outcome,
+                    live['sent'], live['failed'], live['skipped'])
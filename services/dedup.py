@@ -0,0 +1,82 @@
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+
+from utils.cache import TTLCache
+
+logger = logging.getLogger("app.services.dedup")
+
+
+class MessageDeduplicator:
+    """Remember WhatsApp message ids so webhook retries are processed once.
+
+    The in-memory LRU answers repeats within this worker; when a collection
+    getter is given, ids are also inserted into a Mongo collection whose
+    ``created_at`` TTL index expires them, so all gunicorn workers share the
+    same view. ``metrics`` counts hits (duplicates), misses (new ids) and
+    ids forgotten after their processing failed.
+    """
+
+    def __init__(self, ttl: float = 24 * 3600, max_size: int = 10000,
+                 collection_getter: Optional[Callable[[], Any]] = None):
+        self.ttl = ttl
+        self.collection_getter = collection_getter
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self._index_ready = False
+        self._index_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "store_errors": 0, "forgotten": 0}
+
+    def _count(self, name: str) -> None:
+        with self._metrics_lock:
+            self.metrics[name] += 1
+
+    def _collection(self):
+        if self.collection_getter is None:
+            return None
+        collection = self.collection_getter()
+        if collection is not None and not self._index_ready:
+            with self._index_lock:
+                if not self._index_ready:
+                    collection.create_index('created_at', expireAfterSeconds=int(self.ttl))
+                    self._index_ready = True
+        return collection
+
+    def is_duplicate(self, message_id: Optional[str]) -> bool:
+        """Mark ``message_id`` as seen; True if it had already been seen."""
+        if not message_id:
+            return False
+        if not self._cache.add(message_id):
+            self._count("hits")
+            return True
+        try:
+            collection = self._collection()
+            if collection is not None:
+                result = collection.update_one(
+                    {'_id': message_id},
+                    {'$setOnInsert': {'created_at': datetime.now(timezone.utc)}},
+                    upsert=True
+                )
+                if result.upserted_id is None:
+                    self._count("hits")
+                    return True
+        except Exception as e:
+            # Si Mongo falla preferimos procesar de nuevo antes que perder el mensaje
+            logger.warning("dedup store unavailable: %s", e)
+            self._count("store_errors")
+        self._count("misses")
+        return False
+
+    def forget(self, message_id: Optional[str]) -> None:
+        """Drop ``message_id`` so a redelivery of it is processed again."""
+        if not message_id:
+            return
+        self._count("forgotten")
+        self._cache.pop(message_id)
+        try:
+            collection = self._collection()
+            if collection is not None:
+                collection.delete_one({'_id': message_id})
+        except Exception as e:
+            logger.warning("dedup store unavailable: %s", e)
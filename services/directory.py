@@ -0,0 +1,171 @@
+import logging
+from typing import Any, Callable, Dict, Optional
+
+from pymongo import ASCENDING, UpdateOne
+
+from utils.cache import TTLCache
+from utils.phone import normalize_e164
+
+logger = logging.getLogger("app.services.directory")
+
+PHONE_KEY = 'numero_e164'
+PHONE_INDEX = 'numero_e164_unique'
+LEGACY_KEY = 'numero'
+
+# Cached for phones with no persona, so unknown senders don't hit Mongo on every message
+_NOT_FOUND: Dict[str, Any] = {}
+
+
+class PersonaDirectory:
+    """Phone → persona lookups on ``users`` through the indexed ``numero_e164`` key.
+
+    Lookups are an exact match on the canonical E.164 key (see
+    ``utils.phone.normalize_e164``) behind a TTL'd LRU; misses are cached too.
+    Until the backfill has built the unique index, a miss on the key falls
+    back to a scan of the legacy ``numero`` field, and the user found gets
+    ``numero_e164`` set on the way. Once the index exists the point lookup
+    is the only query.
+    Call ``invalidate(phone)`` after writing a user so the next message sees
+    the change, or ``invalidate()`` to drop everything.
+    """
+
+    def __init__(self, collection_getter: Callable[[], Any], max_size: int = 4096, ttl: Optional[float] = 300,
+                 default_country_code: str = '56', national_length: int = 9):
+        self.collection_getter = collection_getter
+        self.default_country_code = default_country_code
+        self.national_length = national_length
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self._backfilled = False
+        self.metrics = {"hits": 0, "misses": 0, "lookups": 0, "errors": 0, "legacy_hits": 0}
+
+    def normalize(self, phone: Optional[str]) -> Optional[str]:
+        return normalize_e164(phone, self.default_country_code, self.national_length)
+
+    def find_by_phone(self, phone: Optional[str]) -> Optional[Dict[str, Any]]:
+        key = self.normalize(phone)
+        if key is None:
+            return None
+        cached = self._cache.get(key)
+        if cached is not None:
+            self.metrics["hits"] += 1
+            return dict(cached) if cached is not _NOT_FOUND else None
+        self.metrics["misses"] += 1
+
+        collection = self.collection_getter()
+        if collection is None:
+            return None
+        try:
+            self.metrics["lookups"] += 1
+            persona = collection.find_one({PHONE_KEY: key})
+            if persona is None and not self._backfill_complete(collection):
+                # Unindexed scan: only while users may still lack the key
+                persona = self._find_legacy(collection, key)
+        except Exception as e:
+            logger.warning("persona lookup failed: %s", e)
+            self.metrics["errors"] += 1
+            return None
+        # Both the key and the legacy field were checked: a miss is a miss
+        self._cache.set(key, persona if persona is not None else _NOT_FOUND)
+        return dict(persona) if persona is not None else None
+
+    def _find_legacy(self, collection: Any, key: str) -> Optional[Dict[str, Any]]:
+        """Match ``key`` against users without the E.164 key through their raw ``numero``.
+
+        The national digits, with any separators between them, must end the
+        stored number; candidates are then confirmed by normalizing it, so a
+        number under another country code never matches.
+        """
+        digits = key[1:]
+        if digits.startswith(self.default_country_code):
+            digits = digits[len(self.default_country_code):]
+        pattern = r'\D*'.join(digits) + r'\D*$'
+        candidates = collection.find({PHONE_KEY: {'$exists': False}, LEGACY_KEY: {'$regex': pattern}}).limit(10)
+        for user in candidates:
+            if self.normalize(user.get(LEGACY_KEY)) != key:
+                continue
+            self.metrics["legacy_hits"] += 1
+            try:
+                # Set the key so the next lookup (and the unique index) sees this user
+                collection.update_one({'_id': user['_id'], PHONE_KEY: {'$exists': False}}, {'$set': {PHONE_KEY: key}})
+                user[PHONE_KEY] = key
+            except Exception as e:
+                logger.warning("could not set %s on user %s: %s", PHONE_KEY, user['_id'], e)
+            return user
+        return None
+
+    def _backfill_complete(self, collection: Any) -> bool:
+        """Whether the backfill has run: it builds the unique index as its last step."""
+        if not self._backfilled:
+            try:
+                self._backfilled = PHONE_INDEX in collection.index_information()
+            except Exception as e:
+                logger.warning("could not read users indexes: %s", e)
+        return self._backfilled
+
+    def invalidate(self, phone: Optional[str] = None) -> None:
+        if phone is None:
+            self._cache.clear()
+            return
+        key = self.normalize(phone)
+        if key is not None:
+            self._cache.pop(key)
+
+    def ensure_indexes(self) -> None:
+        """Unique index on the key; users without a usable number are left out of it."""
+        collection = self.collection_getter()
+        if collection is None:
+            return
+        collection.create_index(
+            [(PHONE_KEY, ASCENDING)],
+            name=PHONE_INDEX,
+            unique=True,
+            partialFilterExpression={PHONE_KEY: {'$type': 'string'}},
+        )
+
+    def backfill(self, batch_size: int = 500) -> Dict[str, int]:
+        """Set ``numero_e164`` from ``numero`` on every user, then build the unique index.
+
+        Numbers that can't be normalized lose the key. When several users share
+        a number only the first (by ``_id``) keeps it; the others are reported
+        as conflicts and must be fixed by hand before they can be found.
+        """
+        collection = self.collection_getter()
+        if collection is None:
+            raise RuntimeError('users collection unavailable')
+
+        counts = {"scanned": 0, "updated": 0, "unchanged": 0, "invalid": 0, "conflicts": 0}
+        seen = set()
+        ops = []
+
+        def flush():
+            if ops:
+                collection.bulk_write(ops, ordered=False)
+                ops.clear()
+
+        cursor = collection.find({}, {'numero': 1, PHONE_KEY: 1}).sort('_id', ASCENDING).batch_size(batch_size)
+        for user in cursor:
+            counts["scanned"] += 1
+            key = self.normalize(user.get('numero'))
+            if key is not None and key in seen:
+                logger.warning("phone %s already assigned; user %s left without %s", key, user['_id'], PHONE_KEY)
+                counts["conflicts"] += 1
+                key = None
+            elif key is None:
+                counts["invalid"] += 1
+            else:
+                seen.add(key)
+
+            if user.get(PHONE_KEY) == key:
+                counts["unchanged"] += 1
+                continue
+            update = {'$set': {PHONE_KEY: key}} if key is not None else {'$unset': {PHONE_KEY: ''}}
+            ops.append(UpdateOne({'_id': user['_id']}, update))
+            counts["updated"] += 1
+            if len(ops) >= batch_size:
+                flush()
+        flush()
+
+        self.ensure_indexes()
+        self._backfilled = True
+        self.invalidate()
+        return counts
@@ -0,0 +1,133 @@
+import asyncio
+import contextvars
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger("app.services.dispatcher")
+
+
+def iter_webhook_events(body: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, Any], Dict[str, Any]]]:
+    """Yield every ``('message' | 'status', value, item)`` in a webhook batch.
+
+    Meta may pack several entries, changes, messages and status updates into a
+    single POST; ``value`` is the enclosing change value (metadata, contacts).
+    """
+    if not isinstance(body, dict):
+        return
+    for entry in body.get('entry') or []:
+        if not isinstance(entry, dict):
+            continue
+        for change in entry.get('changes') or []:
+            if not isinstance(change, dict):
+                continue
+            value = change.get('value') or {}
+            for message in value.get('messages') or []:
+                if isinstance(message, dict):
+                    yield 'message', value, message
+            for status in value.get('statuses') or []:
+                if isinstance(status, dict):
+                    yield 'status', value, status
+
+
+class KeyedDispatcher:
+    """Bounded worker pool that keeps FIFO order per key.
+
+    Tasks sharing a key (the sender's phone) run one after another in
+    submission order; tasks for different keys run concurrently on at most
+    ``workers`` threads. With ``workers=0`` tasks run inline in the caller.
+    Each task runs in a copy of the submitter's ``contextvars`` context, so
+    the webhook's correlation id follows it onto the worker thread.
+    """
+
+    def __init__(self, workers: int = 4, name: str = "dispatch"):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name) if workers > 0 else None
+        self._pending: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+        self.metrics = {"submitted": 0, "completed": 0, "errors": 0}
+
+    def submit(self, key: str, func: Callable[..., Any], *args, **kwargs) -> None:
+        with self._lock:
+            self.metrics["submitted"] += 1
+        if self._executor is None:
+            self._call(func, args, kwargs)
+            return
+        key = key or ''
+        task = (contextvars.copy_context(), func, args, kwargs)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                # A drain for this key is already running: it will pick this up
+                pending.append(task)
+                return
+            self._pending[key] = deque([task])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key: str) -> None:
+        while True:
+            with self._lock:
+                pending = self._pending[key]
+                if not pending:
+                    del self._pending[key]
+                    return
+                context, func, args, kwargs = pending.popleft()
+            context.run(self._call, func, args, kwargs)
+
+    def _call(self, func, args, kwargs) -> None:
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            logger.exception("dispatched task failed: %s", e)
+            with self._lock:
+                self.metrics["errors"] += 1
+        finally:
+            with self._lock:
+                self.metrics["completed"] += 1
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+class AsyncKeyedDispatcher:
+    """asyncio counterpart of ``KeyedDispatcher`` for the ASGI entry point.
+
+    Each task for a key awaits the previous one for that key before running,
+    and at most ``max_inflight`` coroutines run at the same time.
+    """
+
+    def __init__(self, max_inflight: int = 500):
+        self.max_inflight = max_inflight
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tails: Dict[str, asyncio.Task] = {}
+        self.metrics = {"submitted": 0, "completed": 0, "errors": 0}
+
+    def submit(self, key: str, func: Callable[..., Awaitable[Any]], *args: Any) -> asyncio.Task:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+        key = key or ''
+        self.metrics["submitted"] += 1
+        previous = self._tails.get(key)
+        task = asyncio.get_running_loop().create_task(self._run(previous, func, args))
+        self._tails[key] = task
+        task.add_done_callback(lambda t, k=key: self._tails.pop(k, None) if self._tails.get(k) is t else None)
+        return task
+
+    async def _run(self, previous: Optional[asyncio.Task], func, args) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            try:
+                await func(*args)
+            except Exception as e:
+                logger.exception("dispatched task failed: %s", e)
+                self.metrics["errors"] += 1
+            finally:
+                self.metrics["completed"] += 1
+
+    async def drain(self) -> None:
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
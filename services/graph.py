@@ -0,0 +1,288 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Optional
+
+from config import Config, MongoConnection
+from services.token_cache import FileTokenStore, MongoTokenStore, TokenCache
+from utils.bulkhead import Unavailable, graph_guard
+from utils.transport import transport
+
+logger = logging.getLogger("app.services.graph")
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def _graph_request_token():
+    """Pide un token nuevo a Azure AD. Devuelve (access_token, expires_in)."""
+    tenant_id = os.getenv('GRAPH_TENANT_ID')
+    client_id = os.getenv('GRAPH_CLIENT_ID')
+    client_secret = os.getenv('GRAPH_CLIENT_SECRET')
+    if not all([tenant_id, client_id, client_secret]):
+        logger.error('GRAPH env vars missing')
+        return None, None
+    url = f"{Config.GRAPH_LOGIN_URL}/{tenant_id}/oauth2/v2.0/token"
+    data = {
+        'grant_type': 'client_credentials',
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'scope': 'https://graph.microsoft.com/.default'
+    }
+    try:
+        r = transport.post(url, data=data, timeout=30)
+        r.raise_for_status()
+        j = r.json()
+        return j.get('access_token'), j.get('expires_in', 3599)
+    except Exception as e:
+        logger.error('Error acquiring Graph token: %s', e)
+        return None, None
+
+
+def get_token_cache() -> TokenCache:
+    global _token_cache
+    if _token_cache is None:
+        with _token_cache_lock:
+            if _token_cache is None:
+                store = None
+                if Config.GRAPH_TOKEN_STORE == 'file':
+                    store = FileTokenStore(Config.GRAPH_TOKEN_FILE)
+                elif Config.GRAPH_TOKEN_STORE == 'mongo':
+                    store = MongoTokenStore(lambda: MongoConnection().get_collection('tokens'), 'graph')
+                _token_cache = TokenCache(
+                    _graph_request_token,
+                    refresh_margin=Config.GRAPH_TOKEN_REFRESH_MARGIN,
+                    store=store,
+                )
+    return _token_cache
+
+
+def graph_acquire_token():
+    """Obtiene token de Microsoft Graph (client credentials), reutilizándolo hasta que expire."""
+    return get_token_cache().get()
+
+
+def _drive_item_path(upload_folder: str, filename: str) -> str:
+    # Asegurar ruta y codificar espacios
+    folder_path = upload_folder.strip('/') if upload_folder else ''
+    if folder_path:
+        return f"{folder_path}/{filename}"
+    return filename
+
+
+def _upload_small_file_request(token: str, onedrive_user: str, upload_folder: str, filename: str, content: bytes, mime_type: str):
+    path = _drive_item_path(upload_folder, filename)
+    # Construir URL
+    url = f"{Config.GRAPH_API_URL}/users/{onedrive_user}/drive/root:/{path}:/content"
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': mime_type or 'application/octet-stream'
+    }
+    return dict(url=url, headers=headers, data=content, timeout=120)
+
+
+def _upload_small_file_result(resp):
+    if resp.status_code == 401:
+        # Token revocado o vencido antes de lo esperado: forzar refresh en el próximo intento
+        get_token_cache().invalidate()
+    resp.raise_for_status()
+    return resp.json()  # DriveItem
+
+
+def graph_upload_small_file(token: str, onedrive_user: str, upload_folder: str, filename: str, content: bytes, mime_type: str):
+    """
+    Sube un archivo <=4MB a OneDrive: PUT /content.
+    content: bytes o un archivo abierto en modo binario (se envía por bloques).
+    upload_folder: ruta relativa dentro de root (puede ser vacía o con subcarpetas tipo Carpeta/Sub).
+    Con el circuito de Graph abierto o sin cupo lanza utils.bulkhead.Unavailable en vez de devolver None.
+    """
+    if not onedrive_user:
+        logger.error('ONEDRIVE_USER missing')
+        return None
+    resp = None
+    try:
+        with graph_guard.slot():
+            resp = transport.put(**_upload_small_file_request(token, onedrive_user, upload_folder, filename, content, mime_type))
+            return _upload_small_file_result(resp)
+    except Unavailable:
+        # Circuito abierto o sin cupo: el llamador decide si reintentar más tarde
+        raise
+    except Exception as e:
+        logger.error('Error uploading to OneDrive: %s', e, extra={'response': resp.text if resp is not None else None})
+        return None
+
+
+UPLOAD_FRAGMENT_UNIT = 320 * 1024  # Graph exige fragmentos múltiplos de 320 KiB
+
+
+def graph_create_upload_session(token: str, onedrive_user: str, upload_folder: str, filename: str):
+    """
+    Crea una sesión de carga (createUploadSession) para archivos > 4MB.
+    Devuelve el objeto con uploadUrl o None.
+    """
+    path = _drive_item_path(upload_folder, filename)
+    url = f"{Config.GRAPH_API_URL}/users/{onedrive_user}/drive/root:/{path}:/createUploadSession"
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json'
+    }
+    payload = {'item': {'@microsoft.graph.conflictBehavior': 'replace'}}
+    r = None
+    try:
+        with graph_guard.slot():
+            r = transport.post(url, headers=headers, json=payload, timeout=30)
+            if r.status_code == 401:
+                get_token_cache().invalidate()
+            r.raise_for_status()
+            return r.json()
+    except Unavailable:
+        raise
+    except Exception as e:
+        logger.error('Error creating upload session: %s', e, extra={'response': r.text if r is not None else None})
+        return None
+
+
+def _next_expected_offset(status: dict, default: int) -> int:
+    ranges = (status or {}).get('nextExpectedRanges') or []
+    try:
+        return int(str(ranges[0]).split('-')[0])
+    except (IndexError, ValueError):
+        return default
+
+
+def graph_upload_large_file(token: str, onedrive_user: str, upload_folder: str, filename: str,
+                            opener: Callable[[], BinaryIO], size: int, expected_quickxor: Optional[str] = None,
+                            chunk_size: Optional[int] = None, session: Optional[dict] = None,
+                            on_session: Optional[Callable[[dict], None]] = None):
+    """
+    Sube un archivo grande a OneDrive con una sesión de carga y PUTs por rangos.
+
+    opener: devuelve un lector binario nuevo del contenido (p. ej. MediaBuffer.open).
+    session: sesión existente para reanudar; on_session recibe la sesión creada.
+    Graph exige que los fragmentos lleguen en orden, así que se suben uno a uno
+    mientras el siguiente se lee en paralelo. Ante un fallo se consulta
+    nextExpectedRanges y se reanuda desde ahí. Si Graph devuelve quickXorHash
+    se compara con expected_quickxor. Devuelve el DriveItem o None.
+    """
+    if not onedrive_user:
+        logger.error('ONEDRIVE_USER missing')
+        return None
+    chunk_size = chunk_size or Config.GRAPH_UPLOAD_CHUNK_SIZE
+    chunk_size = max(UPLOAD_FRAGMENT_UNIT, chunk_size - chunk_size % UPLOAD_FRAGMENT_UNIT)
+
+    if session is None:
+        session = graph_create_upload_session(token, onedrive_user, upload_folder, filename)
+        if not session or not session.get('uploadUrl'):
+            return None
+        if on_session:
+            on_session(session)
+    upload_url = session['uploadUrl']
+    offset = _next_expected_offset(session, 0)
+
+    item = None
+    failures = 0
+    with opener() as reader, ThreadPoolExecutor(max_workers=1) as prefetch:
+        def read_at(pos):
+            reader.seek(pos)
+            return reader.read(min(chunk_size, size - pos))
+
+        pending = prefetch.submit(read_at, offset)
+        while offset < size:
+            chunk = pending.result()
+            end = offset + len(chunk) - 1
+            pending = prefetch.submit(read_at, end + 1) if end + 1 < size else None
+
+            # La uploadUrl ya viene autenticada: no enviar Authorization
+            r = None
+            try:
+                with graph_guard.slot() as slot:
+                    r = transport.put(upload_url, data=chunk, timeout=120, headers={
+                        'Content-Length': str(len(chunk)),
+                        'Content-Range': f'bytes {offset}-{end}/{size}',
+                    })
+                    slot.failed = r.status_code >= 500 or r.status_code == 429
+            except Unavailable:
+                # La sesión sigue viva: un reintento posterior reanuda desde nextExpectedRanges
+                raise
+            except Exception as e:
+                logger.warning('Error uploading fragment %d-%d: %s', offset, end, e)
+
+            if r is not None and r.status_code in (200, 201):
+                item = r.json()
+                break
+            if r is not None and r.status_code == 202:
+                failures = 0
+                next_offset = _next_expected_offset(r.json(), end + 1)
+            else:
+                failures += 1
+                if r is not None:
+                    logger.warning('Error uploading fragment %d-%d: %s %s', offset, end, r.status_code, r.text)
+                if r is not None and r.status_code == 404:
+                    # Sesión expirada o cancelada: el llamador debe crear una nueva
+                    return None
+                if failures > Config.GRAPH_UPLOAD_MAX_RETRIES:
+                    return None
+                time.sleep(min(2 ** failures, 30))
+                try:
+                    next_offset = _next_expected_offset(transport.get(upload_url, timeout=30).json(), offset)
+                except Exception:
+                    next_offset = offset
+
+            if next_offset != end + 1 or pending is None:
+                if pending is not None:
+                    pending.result()
+                pending = prefetch.submit(read_at, next_offset) if next_offset < size else None
+            offset = next_offset
+
+    if item is None:
+        logger.error('Upload session finished without DriveItem')
+        return None
+    if item.get('size') is not None and item.get('size') != size:
+        logger.error('OneDrive size mismatch: %s != %s', item.get('size'), size)
+        return None
+    remote_hash = ((item.get('file') or {}).get('hashes') or {}).get('quickXorHash')
+    if expected_quickxor and remote_hash and remote_hash != expected_quickxor:
+        logger.error('OneDrive checksum mismatch: %s != %s', remote_hash, expected_quickxor)
+        return None
+    return item
+
+
+def _create_share_link_request(token: str, onedrive_user: str, item_id: str, link_type: str, scope: str):
+    url = f"{Config.GRAPH_API_URL}/users/{onedrive_user}/drive/items/{item_id}/createLink"
+    payload = {
+        'type': link_type,
+        'scope': scope
+    }
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Content-Type': 'application/json'
+    }
+    return dict(url=url, headers=headers, json=payload, timeout=30)
+
+
+def _create_share_link_result(r):
+    r.raise_for_status()
+    j = r.json()
+    # j contiene { "link": { "webUrl": "...", ... }, ... }
+    return j.get('link')
+
+
+def graph_create_share_link(token: str, onedrive_user: str, item_id: str, link_type: str = 'view', scope: str = 'anonymous'):
+    """
+    Crea un link compartido para un DriveItem usando createLink.
+    Devuelve el objeto link o None.
+    """
+    if not token or not onedrive_user or not item_id:
+        return None
+    r = None
+    try:
+        with graph_guard.slot():
+            r = transport.post(**_create_share_link_request(token, onedrive_user, item_id, link_type, scope))
+            return _create_share_link_result(r)
+    except Unavailable:
+        raise
+    except Exception as e:
+        logger.error('Error creating share link: %s', e, extra={'response': r.text if r is not None else None})
+        return None
@@ -0,0 +1,535 @@
+import contextvars
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.log import correlation, get_correlation_id
+
+logger = logging.getLogger("app.services.jobs")
+
+
+class JobHalt(Exception):
+    """Raised by a stage to end the job early without marking it as failed."""
+
+
+class StageTimeout(Exception):
+    """A stage did not finish (retries included) within its ``timeout``."""
+
+
+class JobDeferred(Exception):
+    """Raised by a stage whose dependency is unavailable right now (breaker open, bulkhead full).
+
+    The stage is not retried in place: the job is parked, keeping its context
+    and finished stages, and queued again after ``delay`` seconds, when only
+    the stages that did not finish run.
+    """
+
+    def __init__(self, reason: str, delay: float):
+        super().__init__(reason)
+        self.delay = delay
+
+
+class Stage:
+    """A named step of a job pipeline.
+
+    ``func`` receives the job dict and may use ``job['ctx']`` as scratch space
+    shared with later stages. Raising retries the stage up to ``retries``
+    times; once exhausted, an ``optional`` stage is recorded as failed and the
+    pipeline moves on, otherwise the whole job fails.
+
+    ``after`` names the stages this one depends on (by default the previous
+    stage in the list, i.e. a plain sequence). Stages whose dependencies are
+    all resolved run concurrently, so independent branches overlap. A stage
+    still running after ``timeout`` seconds is recorded as ``timeout`` and
+    treated like a failure; its thread is abandoned and makes no more retries,
+    and the pipeline's finalizer waits until that thread returns.
+    """
+
+    def __init__(self, name: str, func: Callable[[Dict[str, Any]], Any], retries: int = 2,
+                 backoff: float = 1.0, optional: bool = False, after: Optional[List[str]] = None,
+                 timeout: Optional[float] = None):
+        self.name = name
+        self.func = func
+        self.retries = retries
+        self.backoff = backoff
+        self.optional = optional
+        self.after = after
+        self.timeout = timeout
+
+
+class InProcessBackend:
+    """Queue backend living in the current process (one per gunicorn worker)."""
+
+    def __init__(self, maxsize: int = 0):
+        self._queue: "queue.Queue[str]" = queue.Queue(maxsize)
+
+    def put(self, job_id: str) -> None:
+        self._queue.put(job_id)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[str]:
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_nowait(self) -> Optional[str]:
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def task_done(self) -> None:
+        self._queue.task_done()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class JobPipeline:
+    """Persist a job record, return immediately, run its stages on a worker pool.
+
+    Job state is mirrored to a Mongo collection (``jobs`` by default) when one
+    is available so the per-stage status can be inspected; the in-memory copy
+    carries the non-serialisable context (downloaded bytes, API results).
+    ``finalizer`` runs once per job when it ends, whatever the outcome, to
+    release resources held in the context (temp files, buffers).
+    With ``workers=0`` nothing runs in the background and ``run_pending()``
+    processes the queue inline, which is what tests use.
+    A stage raising ``JobDeferred`` parks the job instead of failing it; once
+    parked ``max_deferrals`` times it fails like any other stage error.
+    With ``recover_after`` the workers also pick up, every that many seconds,
+    records left unfinished by a process that stopped (see ``recover()``).
+    Threads of timed-out stages keep their slot in the branch pool until
+    they return (``metrics["orphaned_stages"]``); while too few slots are
+    left for a whole job, new jobs are parked for ``saturated_delay`` seconds.
+    """
+
+    def __init__(
+        self,
+        job_type: str,
+        stages: List[Stage],
+        collection_getter: Optional[Callable[[], Any]] = None,
+        backend: Optional[InProcessBackend] = None,
+        workers: int = 2,
+        finalizer: Optional[Callable[[Dict[str, Any]], None]] = None,
+        max_deferrals: int = 10,
+        recover_after: Optional[float] = None,
+        saturated_delay: float = 5.0,
+    ):
+        self.job_type = job_type
+        self.stages = list(stages)
+        self.dependencies: Dict[str, List[str]] = {}
+        for i, stage in enumerate(self.stages):
+            if stage.after is not None:
+                self.dependencies[stage.name] = list(stage.after)
+            else:
+                self.dependencies[stage.name] = [self.stages[i - 1].name] if i else []
+        self.collection_getter = collection_getter
+        self.backend = backend or InProcessBackend()
+        self.workers = workers
+        self.finalizer = finalizer
+        self.max_deferrals = max_deferrals
+        self.recover_after = recover_after
+        self.saturated_delay = saturated_delay
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._finished: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.finished_limit = 1000
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        # Branch threads: every job worker may have all of its stages in flight at once
+        self._branch_capacity = max(1, workers) * len(self.stages)
+        self._branches = ThreadPoolExecutor(max_workers=self._branch_capacity,
+                                            thread_name_prefix=f"{job_type}-stage")
+        self.metrics = {"submitted": 0, "completed": 0, "failed": 0, "halted": 0, "stage_retries": 0,
+                        "stage_timeouts": 0, "deferred": 0, "parked": 0, "recovered": 0, "orphaned_stages": 0}
+
+    # ------------------------------------------------------------------ state
+    def _collection(self):
+        if self.collection_getter is None:
+            return None
+        try:
+            return self.collection_getter()
+        except Exception as e:
+            logger.warning("jobs collection unavailable: %s", e)
+            return None
+
+    def _persist(self, job_id: str, fields: Dict[str, Any]) -> None:
+        collection = self._collection()
+        if collection is None:
+            return
+        try:
+            collection.update_one({'_id': job_id}, {'$set': fields})
+        except Exception as e:
+            logger.warning("[%s] could not persist job state: %s", job_id, e)
+
+    def submit(self, payload: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        record = {
+            '_id': job_id,
+            'type': self.job_type,
+            'payload': payload,
+            'correlation_id': get_correlation_id() or job_id[:8],
+            'status': 'queued',
+            'stages': {s.name: {'status': 'pending', 'attempts': 0} for s in self.stages},
+            'created_at': _now(),
+            'updated_at': _now(),
+        }
+        collection = self._collection()
+        if collection is not None:
+            try:
+                collection.insert_one(dict(record))
+            except Exception as e:
+                logger.warning("[%s] could not insert job record: %s", job_id, e)
+        record['ctx'] = {}
+        with self._lock:
+            self._jobs[job_id] = record
+            self.metrics["submitted"] += 1
+        self.backend.put(job_id)
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._jobs.get(job_id) or self._finished.get(job_id)
+
+    def recover(self, stale_after: float) -> int:
+        """Queue again this type's jobs left queued, running or deferred by a process that stopped.
+
+        Only records not updated for ``stale_after`` seconds are taken, each
+        claimed with a conditional update so two workers never recover the
+        same job. The context was lost with the process, so every stage runs
+        again from the start. Returns how many jobs were queued.
+        """
+        collection = self._collection()
+        if collection is None:
+            return 0
+        stale = {
+            'type': self.job_type,
+            'status': {'$in': ['queued', 'running', 'deferred']},
+            'updated_at': {'$lt': _now() - timedelta(seconds=stale_after)},
+        }
+        try:
+            records = list(collection.find(stale))
+        except Exception as e:
+            logger.warning("could not load unfinished jobs: %s", e)
+            return 0
+        count = 0
+        for record in records:
+            job_id = record['_id']
+            with self._lock:
+                if job_id in self._jobs:
+                    continue
+            stages = {s.name: {'status': 'pending', 'attempts': 0} for s in self.stages}
+            now = _now()
+            try:
+                claimed = collection.update_one(
+                    {'_id': job_id, 'updated_at': record['updated_at']},
+                    {'$set': {'status': 'queued', 'stages': stages, 'updated_at': now}, '$inc': {'recoveries': 1}},
+                )
+            except Exception as e:
+                logger.warning("[%s] could not claim job: %s", job_id, e)
+                continue
+            if claimed.modified_count != 1:
+                continue
+            record.update(status='queued', stages=stages, updated_at=now, ctx={})
+            with self._lock:
+                self._jobs[job_id] = record
+                self.metrics["recovered"] += 1
+            logger.info("[%s] recovered unfinished job", job_id)
+            self.backend.put(job_id)
+            count += 1
+        return count
+
+    # ---------------------------------------------------------------- workers
+    def start(self) -> None:
+        if self._threads or self.workers <= 0:
+            return
+        self._stopping.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker_loop, name=f"{self.job_type}-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        if self.recover_after and self.collection_getter is not None:
+            t = threading.Thread(target=self._recover_loop, name=f"{self.job_type}-recover", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopping.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _recover_loop(self) -> None:
+        while True:
+            try:
+                self.recover(self.recover_after)
+            except Exception as e:
+                logger.warning("job recovery failed: %s", e)
+            if self._stopping.wait(self.recover_after):
+                return
+
+    def _worker_loop(self) -> None:
+        while not self._stopping.is_set():
+            job_id = self.backend.get(timeout=0.5)
+            if job_id is None:
+                continue
+            try:
+                self._run_job(job_id)
+            finally:
+                self.backend.task_done()
+
+    def run_pending(self) -> int:
+        """Process every queued job in the calling thread. Returns the count."""
+        count = 0
+        while True:
+            job_id = self.backend.get_nowait()
+            if job_id is None:
+                return count
+            try:
+                self._run_job(job_id)
+                count += 1
+            finally:
+                self.backend.task_done()
+
+    # -------------------------------------------------------------- execution
+    def _set_stage(self, job: Dict[str, Any], stage: Stage, **fields) -> None:
+        job['stages'][stage.name].update(fields)
+        job['updated_at'] = _now()
+        self._persist(job['_id'], {
+            f"stages.{stage.name}": job['stages'][stage.name],
+            'status': job['status'],
+            'updated_at': job['updated_at'],
+        })
+
+    def _run_stage(self, job: Dict[str, Any], stage: Stage, abandoned: threading.Event) -> None:
+        attempt = 0
+        while True:
+            attempt += 1
+            self._set_stage(job, stage, status='running', attempts=attempt, started_at=_now())
+            try:
+                stage.func(job)
+                if abandoned.is_set():
+                    return
+                job['stages'][stage.name].pop('error', None)
+                self._set_stage(job, stage, status='done', finished_at=_now())
+                return
+            except (JobHalt, JobDeferred):
+                raise
+            except Exception as e:
+                logger.warning("[%s] stage %s attempt %d failed: %s", job['_id'], stage.name, attempt, e)
+                if abandoned.is_set():
+                    return
+                if attempt > stage.retries:
+                    self._set_stage(job, stage, status='failed', error=str(e), finished_at=_now())
+                    raise
+                with self._lock:
+                    self.metrics["stage_retries"] += 1
+                self._set_stage(job, stage, status='retrying', error=str(e))
+                if abandoned.wait(stage.backoff * (2 ** (attempt - 1))):
+                    return
+
+    def _ready(self, job: Dict[str, Any], started: set) -> List[Stage]:
+        """Stages not yet started whose dependencies all finished (optional failures count)."""
+        resolved = ('done', 'failed', 'timeout')
+        return [
+            stage for stage in self.stages
+            if stage.name not in started
+            and all(job['stages'][dep]['status'] in resolved for dep in self.dependencies[stage.name])
+        ]
+
+    def _run_job(self, job_id: str) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            logger.warning("[%s] unknown job id", job_id)
+            return
+        with correlation(job.get('correlation_id')):
+            self._execute(job)
+
+    def _saturated(self) -> bool:
+        """True if abandoned stage threads leave fewer free branch slots than a job has stages."""
+        with self._lock:
+            return self._branch_capacity - self.metrics["orphaned_stages"] < len(self.stages)
+
+    def _orphan(self, future: Future) -> None:
+        """Count an abandoned stage thread against the branch pool until it returns."""
+        with self._lock:
+            self.metrics["orphaned_stages"] += 1
+        future.add_done_callback(self._orphan_done)
+
+    def _orphan_done(self, _future: Future) -> None:
+        with self._lock:
+            self.metrics["orphaned_stages"] -= 1
+
+    def _execute(self, job: Dict[str, Any]) -> None:
+        job_id = job['_id']
+        if self._saturated():
+            deferred = JobDeferred('stage threads held by timed-out stages', self.saturated_delay)
+            if self._park(job, deferred):
+                return
+            job['status'] = 'failed'
+            self._persist(job_id, {'status': 'failed', 'updated_at': _now()})
+            self._finish(job_id, 'failed')
+            return
+        job['status'] = 'running'
+        started = set()
+        for s in self.stages:
+            if job['stages'][s.name]['status'] == 'done':
+                started.add(s.name)
+            else:
+                # Al reanudar un job aplazado, todo lo que no terminó vuelve a correr
+                job['stages'][s.name]['status'] = 'pending'
+        running: Dict[Any, tuple] = {}
+        # Timed-out stages whose threads may still be touching job['ctx']
+        orphans: List[Future] = []
+        outcome = None
+        deferred: Optional[JobDeferred] = None
+        while outcome is None:
+            for stage in self._ready(job, started):
+                started.add(stage.name)
+                abandoned = threading.Event()
+                # Branch threads inherit the job's correlation id
+                future = self._branches.submit(contextvars.copy_context().run, self._run_stage, job, stage, abandoned)
+                deadline = time.monotonic() + stage.timeout if stage.timeout else None
+                running[future] = (stage, abandoned, deadline)
+            if not running:
+                break
+
+            deadlines = [d for _, _, d in running.values() if d is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage, _, _ = running.pop(future)
+                try:
+                    future.result()
+                except JobHalt as halt:
+                    self._set_stage(job, stage, status='halted', reason=str(halt), finished_at=_now())
+                    outcome = 'halted'
+                except JobDeferred as e:
+                    self._set_stage(job, stage, status='deferred', error=str(e))
+                    deferred = e
+                    outcome = outcome or 'deferred'
+                except Exception:
+                    if not stage.optional:
+                        outcome = 'failed'
+            now = time.monotonic()
+            for future, (stage, abandoned, deadline) in list(running.items()):
+                if deadline is not None and deadline <= now and not future.done():
+                    abandoned.set()
+                    del running[future]
+                    orphans.append(future)
+                    self._orphan(future)
+                    with self._lock:
+                        self.metrics["stage_timeouts"] += 1
+                    logger.warning("[%s] stage %s timed out after %ss", job_id, stage.name, stage.timeout)
+                    self._set_stage(job, stage, status='timeout', error=str(StageTimeout(stage.name)),
+                                    finished_at=_now())
+                    if not stage.optional:
+                        outcome = 'failed'
+
+        # Let sibling branches settle before the finalizer releases shared resources
+        for future, (stage, abandoned, deadline) in running.items():
+            remaining = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            wait([future], timeout=remaining)
+            if not future.done():
+                abandoned.set()
+                orphans.append(future)
+                self._orphan(future)
+
+        if outcome == 'deferred' and self._park(job, deferred):
+            return
+
+        outcome = outcome or 'completed'
+        if outcome == 'deferred':
+            outcome = 'failed'
+        job['status'] = outcome
+        if outcome == 'halted':
+            for stage in self.stages:
+                if job['stages'][stage.name]['status'] == 'pending':
+                    job['stages'][stage.name]['status'] = 'skipped'
+            self._persist(job_id, {'stages': job['stages'], 'status': 'halted'})
+        else:
+            self._persist(job_id, {'status': outcome, 'updated_at': _now()})
+        self._finish(job_id, outcome, [f for f in orphans if not f.done()])
+
+    def _park(self, job: Dict[str, Any], deferred: JobDeferred) -> bool:
+        """Queue the job again after ``deferred.delay``; False once it has been parked too often."""
+        job_id = job['_id']
+        job['deferrals'] = job.get('deferrals', 0) + 1
+        if job['deferrals'] > self.max_deferrals:
+            logger.warning("[%s] gave up after %d deferrals: %s", job_id, self.max_deferrals, deferred)
+            for state in job['stages'].values():
+                if state['status'] == 'deferred':
+                    state.update(status='failed', finished_at=_now())
+            self._persist(job_id, {'stages': job['stages']})
+            return False
+        job['status'] = 'deferred'
+        resume_at = _now() + timedelta(seconds=deferred.delay)
+        self._persist(job_id, {'status': 'deferred', 'deferrals': job['deferrals'], 'resume_at': resume_at,
+                               'updated_at': _now()})
+        with self._lock:
+            self.metrics["deferred"] += 1
+            self.metrics["parked"] += 1
+        logger.info("[%s] deferred for %.1fs: %s", job_id, deferred.delay, deferred)
+        # El contexto (archivo descargado, resultados parciales) se conserva: sin finalizer hasta que termine
+        timer = threading.Timer(deferred.delay, self._resume, (job_id,))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _resume(self, job_id: str) -> None:
+        with self._lock:
+            self.metrics["parked"] -= 1
+        self.backend.put(job_id)
+
+    def _finalize(self, job: Dict[str, Any]) -> None:
+        if self.finalizer is not None:
+            try:
+                self.finalizer(job)
+            except Exception as e:
+                logger.warning("[%s] finalizer failed: %s", job['_id'], e)
+        # Context may hold file bytes: release it as soon as the job ends
+        job.pop('ctx', None)
+
+    def _finalize_after(self, job: Dict[str, Any], orphans: List[Future]) -> None:
+        """Run the finalizer once the last abandoned stage thread returns, not under its feet."""
+        logger.warning("[%s] %d timed-out stage(s) still running; finalizer deferred", job['_id'], len(orphans))
+        pending = [len(orphans)]
+        lock = threading.Lock()
+
+        def release(_future) -> None:
+            with lock:
+                pending[0] -= 1
+                last = pending[0] == 0
+            if last:
+                self._finalize(job)
+
+        for future in orphans:
+            future.add_done_callback(release)
+
+    def _finish(self, job_id: str, outcome: str, orphans: Optional[List[Future]] = None) -> None:
+        job = self._jobs.get(job_id)
+        if job is not None:
+            if orphans:
+                self._finalize_after(job, orphans)
+            else:
+                self._finalize(job)
+        with self._lock:
+            self.metrics[outcome] += 1
+            job = self._jobs.pop(job_id, None)
+            if job is not None:
+                self._finished[job_id] = job
+                while len(self._finished) > self.finished_limit:
+                    self._finished.popitem(last=False)
@@ -0,0 +1,372 @@
+import contextlib
+import json
+import os
+import unicodedata
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from config import Config
+from services import graph, whatsapp
+from services.jobs import JobDeferred, JobHalt, JobPipeline, Stage
+from utils import extraction, helpers
+from utils.bulkhead import Unavailable
+from utils.metrics import tracer
+from utils.media_store import ContentStore, whatsapp_sha256_hex
+from utils.schemas import SchemaRegistry
+from utils.streams import MediaBuffer, QuickXorHash
+from utils.transport import transport
+
+SMALL_UPLOAD_LIMIT = 4 * 1024 * 1024
+
+
+def guess_extension(mime_type: str) -> str:
+    mapping = {
+        'image/jpeg': '.jpg',
+        'image/png': '.png',
+        'image/gif': '.gif',
+        'application/pdf': '.pdf',
+        'image/webp': '.webp'
+    }
+    return mapping.get(mime_type, '')
+
+
+def _defer_if_unavailable(result: Any) -> None:
+    # SAIA con el circuito abierto o sin cupo: aplazar el job en vez de gastar reintentos
+    if isinstance(result, dict) and result.get('error') == 'unavailable':
+        raise JobDeferred(result.get('detail') or 'saia unavailable', result.get('retry_after') or 1.0)
+
+
+def extract_ia_text(saia_chat_result: Any) -> Optional[str]:
+    """Return the assistant text from a SAIA chat response, or None."""
+    if not isinstance(saia_chat_result, dict):
+        return None
+    ia_text = extraction.assistant_text(saia_chat_result)
+    if not ia_text or not ia_text.strip():
+        return None
+    return ia_text
+
+
+def parse_ia_text(ia_text: str) -> Any:
+    """Parse IA JSON inside code fences; fall back to the cleaned string (fields vary)."""
+    ok, value = extraction.parse_json_text(ia_text)
+    return value if ok else unicodedata.normalize('NFKC', value).strip()
+
+
+class MediaJobHandler:
+    """Stages of the media pipeline: download, then SAIA (-> reply) alongside OneDrive.
+
+    Each stage reads the job payload (``phone``, ``type``, ``media``,
+    ``file_doc_id``). The SAIA and OneDrive branches run concurrently, each
+    with its own timeout, and leave their ``files`` fields in the job context;
+    the ``record`` stage writes them to the ``files`` document in one update
+    once both branches have finished, failed or timed out. When the SAIA
+    chat is streamed, ``progress_message`` is sent to the user as soon as
+    ``progress_min_chars`` characters of the answer have arrived. With
+    ``schemas`` the answer is requested and validated as one of the
+    registered document types and ``ia_text`` holds the validated fields.
+    """
+
+    def __init__(self, mongo, saia_client_getter: Callable[[], Any], media_store: Optional[ContentStore] = None,
+                 sessions: Any = None, progress_message: Optional[str] = None, progress_min_chars: int = 20,
+                 schemas: Optional[SchemaRegistry] = None):
+        self.mongo = mongo
+        self.saia_client_getter = saia_client_getter
+        self.media_store = media_store if media_store is not None else ContentStore()
+        self.sessions = sessions
+        self.progress_message = progress_message
+        self.progress_min_chars = progress_min_chars
+        self.schemas = schemas
+
+    def _analyzed(self, entry: Dict[str, Any]) -> bool:
+        if self.schemas is not None:
+            return self.schemas.cached(entry) is not None
+        return 'ia_text' in entry
+
+    def _complete(self, entry: Optional[Dict[str, Any]]) -> bool:
+        """True if the stored entry already covers every downstream stage."""
+        if not entry or not entry.get('download_url'):
+            return False
+        return self._analyzed(entry) or self.saia_client_getter() is None
+
+    def _files(self):
+        return self.mongo.get_collection('files')
+
+    def _update_file(self, job: Dict[str, Any], fields: Dict[str, Any]) -> None:
+        file_doc_id = job['payload'].get('file_doc_id')
+        collection = self._files()
+        if collection is None or file_doc_id is None:
+            return
+        collection.update_one({'_id': file_doc_id}, {'$set': fields})
+
+    @staticmethod
+    def _stage_fields(job: Dict[str, Any], stage: str, fields: Dict[str, Any]) -> None:
+        """Queue ``files`` fields from a branch for the combined ``record`` update."""
+        job['ctx'].setdefault('file_fields', {})[stage] = fields
+
+    # ------------------------------------------------------------------ stages
+    def download(self, job: Dict[str, Any]) -> None:
+        payload = job['payload']
+        media = payload.get('media') or {}
+
+        # WhatsApp ya informa el sha256: si esos bytes fueron procesados antes, no descargar
+        known = self.media_store.get(whatsapp_sha256_hex(media.get('sha256')))
+        if self._complete(known):
+            job['ctx'].update({'sha256': known['_id'], 'stored': known, 'file_data': known.get('wsp_media') or {}})
+            return
+
+        with tracer.span('media_metadata'):
+            status, file_data = whatsapp.get_file(media.get('id'))
+        if not status or not isinstance(file_data, dict):
+            raise RuntimeError('media metadata unavailable')
+
+        file_size = file_data.get('file_size')
+        if file_size and file_size > Config.MEDIA_MAX_SIZE:
+            self._update_file(job, {'wsp_media': file_data, 'status': 'too_large'})
+            raise JobHalt('too_large')
+
+        # Leer el CDN de WhatsApp por bloques: hash incremental y spill a disco si es grande
+        headers = {'Authorization': f"Bearer {os.getenv('WSP_API_TOKEN', '')}"}
+        with tracer.span('download'):
+            resp = transport.get(file_data.get('url'), headers=headers, timeout=60, stream=True)
+            try:
+                resp.raise_for_status()
+                buffer = MediaBuffer.from_chunks(
+                    resp.iter_content(chunk_size=Config.MEDIA_CHUNK_SIZE),
+                    max_memory=Config.MEDIA_SPOOL_MAX_MEMORY,
+                    spool_dir=Config.MEDIA_SPOOL_DIR,
+                    hashers={'quickxor': QuickXorHash()},
+                )
+            finally:
+                resp.close()
+
+        filename = media.get('filename') if payload.get('type') == 'document' else None
+        if not filename:
+            ext = guess_extension(file_data.get('mime_type'))
+            filename = f"wsp_{file_data.get('id', 'media')}{ext}"
+
+        job['ctx'].update({
+            'file_data': file_data,
+            'buffer': buffer,
+            'filename': filename,
+            'mime_type': file_data.get('mime_type'),
+            'sha256': buffer.sha256,
+            'stored': self.media_store.get(buffer.sha256) or {},
+        })
+        wsp_media = {k: v for k, v in file_data.items() if k != 'url'}
+        self.media_store.update(buffer.sha256, {'wsp_media': wsp_media})
+
+    def saia(self, job: Dict[str, Any]) -> None:
+        ctx = job['ctx']
+        saia_client = self.saia_client_getter()
+        if saia_client is None:
+            # SAIA client not configured: record nothing about uploads/chat to keep DB compact
+            return
+
+        stored = ctx.get('stored') or {}
+        hit = self.schemas.cached(stored) if self.schemas is not None else None
+        if hit is not None:
+            # Mismo contenido ya extraído con la versión vigente del esquema: sin subir ni llamar al chat
+            schema, data = hit
+            ctx['ia_text'] = data
+            self._stage_fields(job, 'saia', {'ia_text': data, 'ia_schema': schema.key, 'ia_valid': True})
+            return
+        if self.schemas is None and 'ia_text' in stored:
+            # Mismo contenido ya analizado: reutilizar el resultado sin subir ni llamar al chat
+            ctx['ia_text'] = stored['ia_text']
+            if stored['ia_text'] is not None:
+                self._stage_fields(job, 'saia', {'ia_text': stored['ia_text']})
+            return
+
+        filename = ctx['filename']
+        alias = os.path.splitext(filename)[0]
+        saia_folder = os.getenv('SAIA_UPLOAD_FOLDER', 'test1')
+        buffer = ctx['buffer']
+        with tracer.span('saia_upload'), buffer.open() as reader:
+            saia_upload_result = saia_client.upload_file(
+                reader, filename, size=buffer.size, sha256=buffer.sha256, folder=saia_folder, alias=alias
+            )
+        _defer_if_unavailable(saia_upload_result)
+        if not isinstance(saia_upload_result, dict) or 'error' in saia_upload_result:
+            raise RuntimeError(f"SAIA upload failed: {saia_upload_result}")
+        # En un hit del store el archivo puede haberse subido con otro alias
+        alias = saia_upload_result.get('file_alias_used') or alias
+
+        prompt = f"Por favor procesa y extrae la información del archivo: {{file:{alias}}}"
+        with tracer.span('saia_chat'):
+            saia_chat_result = saia_client.chat_with_file(prompt, alias, on_delta=self._progress(job),
+                                                          schemas=self.schemas, sha256=ctx['sha256'])
+        _defer_if_unavailable(saia_chat_result)
+        if isinstance(saia_chat_result, dict) and saia_chat_result.get('error') in ('chat_failed', 'http_error', 'internal_error'):
+            raise RuntimeError(f"SAIA chat failed: {saia_chat_result.get('error')}")
+
+        if self.schemas is not None and isinstance(saia_chat_result, dict) and 'data' in saia_chat_result:
+            # Validado (y cacheado por sha256 + versión) en el cliente; si no pasó la validación se guarda igual, marcado
+            ia_text = saia_chat_result['data'] if saia_chat_result['valid'] else saia_chat_result.get('raw')
+            ctx['ia_text'] = ia_text
+            self._stage_fields(job, 'saia', {'ia_text': ia_text, 'ia_schema': saia_chat_result['schema'],
+                                             'ia_valid': saia_chat_result['valid']})
+            return
+
+        ia_text = extract_ia_text(saia_chat_result)
+        if isinstance(ia_text, str):
+            ia_text = parse_ia_text(ia_text)
+        ctx['ia_text'] = ia_text
+        if ia_text is not None:
+            self._stage_fields(job, 'saia', {'ia_text': ia_text})
+            self.media_store.update(ctx['sha256'], {'ia_text': ia_text})
+
+    def _progress(self, job: Dict[str, Any]) -> Optional[Callable[[str, str], None]]:
+        """on_delta callback that queues the progress message once per job (retries included)."""
+        phone = job['payload'].get('phone')
+        if not self.progress_message or not phone:
+            return None
+        ctx = job['ctx']
+
+        def on_delta(delta: str, text: str) -> None:
+            if ctx.get('progress_sent') or len(text.strip()) < self.progress_min_chars:
+                return
+            ctx['progress_sent'] = True
+            # Sin esperar la entrega: el stream sigue leyéndose
+            whatsapp.get_send_queue().send(helpers.text_payload(self.progress_message, phone))
+
+        return on_delta
+
+    def onedrive(self, job: Dict[str, Any]) -> None:
+        ctx = job['ctx']
+        file_data = ctx['file_data']
+        stored = ctx.get('stored') or {}
+        if stored.get('download_url'):
+            # Mismo contenido ya archivado en OneDrive: reutilizar el enlace
+            self._stage_fields(job, 'onedrive', {
+                'wsp_media': dict(file_data, download_url=stored['download_url']),
+                'status': 'uploaded'
+            })
+            return
+
+        with tracer.span('graph_token'):
+            graph_token = graph.graph_acquire_token()
+        if not graph_token:
+            self._stage_fields(job, 'onedrive', {'wsp_media': file_data, 'status': 'graph_token_error'})
+            raise RuntimeError('graph_token_error')
+
+        buffer = ctx['buffer']
+        onedrive_user = os.getenv('ONEDRIVE_USER')
+        upload_folder = os.getenv('ONEDRIVE_UPLOAD_FOLDER', '')
+        with tracer.span('onedrive_upload'), self._deferring():
+            if buffer.size <= SMALL_UPLOAD_LIMIT:
+                with buffer.open() as reader:
+                    upload_result = graph.graph_upload_small_file(
+                        graph_token,
+                        onedrive_user,
+                        upload_folder,
+                        ctx['filename'],
+                        reader,
+                        ctx['mime_type'] or 'application/octet-stream'
+                    )
+            else:
+                # Sesión de carga por rangos; un reintento del stage reanuda la misma sesión
+                upload_result = graph.graph_upload_large_file(
+                    graph_token,
+                    onedrive_user,
+                    upload_folder,
+                    ctx['filename'],
+                    buffer.open,
+                    buffer.size,
+                    expected_quickxor=buffer.hashers['quickxor'].b64digest(),
+                    session=ctx.get('upload_session'),
+                    on_session=lambda session: ctx.__setitem__('upload_session', session),
+                )
+                if upload_result is None:
+                    ctx.pop('upload_session', None)
+
+        # Attach OneDrive download_url into wsp_media for downstream usage; do not store separate 'onedrive' field
+        media = dict(file_data)
+        if isinstance(upload_result, dict) and upload_result.get('@microsoft.graph.downloadUrl'):
+            media['download_url'] = upload_result.get('@microsoft.graph.downloadUrl')
+            self.media_store.update(ctx['sha256'], {'download_url': media['download_url']})
+        self._stage_fields(job, 'onedrive', {
+            'wsp_media': media,
+            'status': 'uploaded' if isinstance(upload_result, dict) else 'upload_failed'
+        })
+        if not isinstance(upload_result, dict):
+            raise RuntimeError('upload_failed')
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _deferring() -> Iterator[None]:
+        try:
+            yield
+        except Unavailable as e:
+            # Graph con el circuito abierto o sin cupo: la sesión de carga (si hay) se reanuda al volver
+            raise JobDeferred(str(e), e.retry_after) from e
+
+    def reply(self, job: Dict[str, Any]) -> None:
+        ia_text = job['ctx'].get('ia_text')
+        if ia_text is None:
+            return
+        if isinstance(ia_text, (dict, list)):
+            ia_msg = json.dumps(ia_text, ensure_ascii=False, indent=2)
+        else:
+            ia_msg = str(ia_text)
+        if not whatsapp.send_many([helpers.text_payload(ia_msg, job['payload'].get('phone'))])[0]:
+            raise RuntimeError('send_message failed')
+
+    def record(self, job: Dict[str, Any]) -> None:
+        ctx = job['ctx']
+        branches = ctx.get('file_fields') or {}
+        fields: Dict[str, Any] = {}
+        for stage in ('saia', 'onedrive'):
+            fields.update(branches.get(stage) or {})
+        onedrive = job['stages']['onedrive']['status']
+        if onedrive == 'timeout':
+            # The abandoned branch may still finish; its late fields are ignored
+            fields.update({'wsp_media': ctx.get('file_data') or {}, 'status': 'upload_timeout'})
+        elif onedrive == 'failed' and 'status' not in fields:
+            fields.update({'wsp_media': ctx.get('file_data') or {}, 'status': 'upload_failed'})
+        if fields:
+            self._update_file(job, fields)
+        if self.sessions is not None and fields.get('status'):
+            # Keep the sender's session in step with the files document
+            media = job['payload'].get('media') or {}
+            self.sessions.update(job['payload'].get('phone'), last_document={
+                'file_id': media.get('id'), 'type': job['payload'].get('type'), 'status': fields['status'],
+                'has_ia_text': fields.get('ia_text') is not None,
+            })
+
+    def cleanup(self, job: Dict[str, Any]) -> None:
+        buffer = job.get('ctx', {}).get('buffer')
+        if buffer is not None:
+            buffer.close()
+
+    def stages(self, retries: int = 2, backoff: float = 1.0, saia_timeout: Optional[float] = None,
+               onedrive_timeout: Optional[float] = None) -> List[Stage]:
+        return [
+            Stage('download', self.download, retries=retries, backoff=backoff),
+            Stage('saia', self.saia, retries=retries, backoff=backoff, optional=True,
+                  after=['download'], timeout=saia_timeout),
+            Stage('onedrive', self.onedrive, retries=retries, backoff=backoff, optional=True,
+                  after=['download'], timeout=onedrive_timeout),
+            Stage('reply', self.reply, retries=retries, backoff=backoff, optional=True, after=['saia']),
+            Stage('record', self.record, retries=retries, backoff=backoff, after=['saia', 'onedrive']),
+        ]
+
+
+def build_media_pipeline(mongo, saia_client_getter: Callable[[], Any], workers: int = 2,
+                         retries: int = 2, backoff: float = 1.0,
+                         media_store: Optional[ContentStore] = None, saia_timeout: Optional[float] = None,
+                         onedrive_timeout: Optional[float] = None, sessions: Any = None,
+                         progress_message: Optional[str] = None, progress_min_chars: int = 20,
+                         schemas: Optional[SchemaRegistry] = None, max_deferrals: int = 10,
+                         recover_after: Optional[float] = None) -> JobPipeline:
+    handler = MediaJobHandler(mongo, saia_client_getter, media_store=media_store, sessions=sessions,
+                              progress_message=progress_message, progress_min_chars=progress_min_chars,
+                              schemas=schemas)
+    return JobPipeline(
+        'media',
+        handler.stages(retries=retries, backoff=backoff, saia_timeout=saia_timeout,
+                       onedrive_timeout=onedrive_timeout),
+        collection_getter=lambda: mongo.get_collection('jobs'),
+        workers=workers,
+        finalizer=handler.cleanup,
+        max_deferrals=max_deferrals,
+        recover_after=recover_after,
+    )
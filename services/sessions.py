@@ -0,0 +1,162 @@
+import copy
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Optional
+
+from pymongo import UpdateOne
+
+from utils.cache import TTLCache
+
+logger = logging.getLogger("app.services.sessions")
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class SessionStore:
+    """Per-phone conversation state (persona, flow step, last document) with write-behind.
+
+    Sessions are served from a bounded LRU; a miss costs one read of the
+    ``sessions`` collection. ``update()`` only touches memory and marks the
+    session dirty; a flusher thread upserts dirty sessions every
+    ``flush_interval`` seconds in one bulk write (and on ``stop()``). Each
+    write pushes ``expires_at`` forward by ``ttl`` and a TTL index drops idle
+    sessions. Dirty sessions are kept until flushed even if the LRU evicts
+    them. Several processes may cache the same phone; ``cache_ttl`` bounds
+    how stale another worker's copy can get.
+    """
+
+    def __init__(self, collection_getter: Optional[Callable[[], Any]] = None, max_size: int = 10000,
+                 ttl: float = 24 * 3600, cache_ttl: Optional[float] = 600, flush_interval: float = 2.0):
+        self.collection_getter = collection_getter
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._cache = TTLCache(max_size=max_size, ttl=cache_ttl)
+        self._dirty: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._indexed = False
+        self.metrics = {"hits": 0, "loads": 0, "created": 0, "flushes": 0, "flushed": 0, "flush_errors": 0}
+
+    def _collection(self):
+        if self.collection_getter is None:
+            return None
+        collection = self.collection_getter()
+        if collection is not None and not self._indexed:
+            try:
+                collection.create_index('expires_at', expireAfterSeconds=0)
+                self._indexed = True
+            except Exception as e:
+                logger.warning("could not create sessions TTL index: %s", e)
+        return collection
+
+    # ------------------------------------------------------------------- reads
+    def get(self, phone: str) -> Dict[str, Any]:
+        """Return a copy of the session for ``phone`` (a fresh one if none exists)."""
+        with self._lock:
+            session = self._dirty.get(phone) or self._cache.get(phone)
+            if session is not None:
+                self.metrics["hits"] += 1
+                return copy.deepcopy(session)
+
+        session = None
+        collection = None
+        try:
+            collection = self._collection()
+        except Exception as e:
+            logger.warning("sessions collection unavailable: %s", e)
+        if collection is not None:
+            try:
+                session = collection.find_one({'_id': phone})
+                self.metrics["loads"] += 1
+            except Exception as e:
+                logger.warning("could not load session %s: %s", phone, e)
+        if session is None:
+            session = {'_id': phone, 'persona': None, 'step': None, 'last_document': None}
+            self.metrics["created"] += 1
+
+        with self._lock:
+            # A concurrent update() may have created it meanwhile; that one wins
+            current = self._dirty.get(phone) or self._cache.get(phone)
+            if current is None:
+                self._cache.set(phone, session)
+                current = session
+            return copy.deepcopy(current)
+
+    # ------------------------------------------------------------------ writes
+    def update(self, phone: str, **fields: Any) -> Dict[str, Any]:
+        """Merge ``fields`` into the session in memory; persisted by the next flush."""
+        if not phone:
+            return {}
+        base = self.get(phone)
+        with self._lock:
+            session = self._dirty.get(phone) or self._cache.get(phone) or base
+            session.update(copy.deepcopy(fields))
+            session['updated_at'] = _now()
+            self._cache.set(phone, session)
+            if self.collection_getter is not None:
+                self._dirty[phone] = session
+        self._ensure_flusher()
+        return copy.deepcopy(session)
+
+    def _ensure_flusher(self) -> None:
+        if self.collection_getter is None or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._flush_loop, name='session-flush', daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self) -> int:
+        """Upsert every dirty session now. Returns how many were written."""
+        with self._lock:
+            if not self._dirty:
+                return 0
+            dirty, self._dirty = self._dirty, {}
+            snapshot = {phone: copy.deepcopy(session) for phone, session in dirty.items()}
+        try:
+            collection = self._collection()
+            if collection is None:
+                raise RuntimeError('sessions collection unavailable')
+            expires_at = _now() + timedelta(seconds=self.ttl)
+            ops = [
+                UpdateOne({'_id': phone},
+                          {'$set': dict({k: v for k, v in session.items() if k != '_id'}, expires_at=expires_at)},
+                          upsert=True)
+                for phone, session in snapshot.items()
+            ]
+            collection.bulk_write(ops, ordered=False)
+        except Exception as e:
+            logger.warning("session flush failed, will retry: %s", e)
+            with self._lock:
+                self.metrics["flush_errors"] += 1
+                for phone, session in dirty.items():
+                    # Keep anything written since the snapshot
+                    self._dirty.setdefault(phone, session)
+            return 0
+        with self._lock:
+            self.metrics["flushes"] += 1
+            self.metrics["flushed"] += len(snapshot)
+        return len(snapshot)
+
+    def invalidate(self, phone: Optional[str] = None) -> None:
+        """Drop cached (already flushed) sessions so the next get() reloads them."""
+        if phone is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(phone)
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval + 1)
+        self.flush()
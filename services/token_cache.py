@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Optional, Tuple
+
+logger = logging.getLogger("app.services.token_cache")
+
+TokenFetcher = Callable[[], Tuple[Optional[str], Optional[float]]]
+
+
+class FileTokenStore:
+    """Share a token between gunicorn workers on the same host through a JSON file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Tuple[Optional[str], float]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
+            return data.get('access_token'), float(data.get('expires_at') or 0)
+        except (OSError, ValueError):
+            return None, 0.0
+
+    def save(self, token: str, expires_at: float) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.token-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+                json.dump({'access_token': token, 'expires_at': expires_at}, fh)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def clear(self) -> None:
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class MongoTokenStore:
+    """Share a token between workers on any host through a Mongo document."""
+
+    def __init__(self, collection_getter: Callable[[], Any], key: str):
+        self.collection_getter = collection_getter
+        self.key = key
+
+    def load(self) -> Tuple[Optional[str], float]:
+        collection = self.collection_getter()
+        if collection is None:
+            return None, 0.0
+        doc = collection.find_one({'_id': self.key}) or {}
+        return doc.get('access_token'), float(doc.get('expires_at') or 0)
+
+    def save(self, token: str, expires_at: float) -> None:
+        collection = self.collection_getter()
+        if collection is None:
+            return
+        collection.update_one(
+            {'_id': self.key},
+            {'$set': {'access_token': token, 'expires_at': expires_at}},
+            upsert=True
+        )
+
+    def clear(self) -> None:
+        collection = self.collection_getter()
+        if collection is not None:
+            collection.delete_one({'_id': self.key})
+
+
+class TokenCache:
+    """Cache an OAuth access token until shortly before it expires.
+
+    ``fetcher`` returns ``(access_token, expires_in_seconds)``. Refreshes are
+    single-flight: concurrent callers wait on the same refresh instead of each
+    hitting the token endpoint. An optional ``store`` (file or Mongo) lets
+    several processes reuse a token another one obtained.
+    """
+
+    def __init__(self, fetcher: TokenFetcher, refresh_margin: float = 300, store: Any = None,
+                 clock: Callable[[], float] = time.time):
+        self.fetcher = fetcher
+        self.refresh_margin = refresh_margin
+        self.store = store
+        self._clock = clock
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self.metrics = {"hits": 0, "store_hits": 0, "refreshes": 0, "refresh_errors": 0,
+                        "last_refresh_seconds": 0.0, "total_refresh_seconds": 0.0}
+
+    def _fresh(self, expires_at: float) -> bool:
+        return expires_at - self.refresh_margin > self._clock()
+
+    def peek(self) -> Optional[str]:
+        """Return the cached token if still fresh, without refreshing or blocking."""
+        token = self._token
+        if token and self._fresh(self._expires_at):
+            self.metrics["hits"] += 1
+            return token
+        return None
+
+    def get(self) -> Optional[str]:
+        token = self.peek()
+        if token:
+            return token
+        with self._lock:
+            # Otro hilo pudo haber refrescado mientras esperábamos el lock
+            if self._token and self._fresh(self._expires_at):
+                self.metrics["hits"] += 1
+                return self._token
+            if self.store is not None:
+                try:
+                    stored, expires_at = self.store.load()
+                    if stored and self._fresh(expires_at):
+                        self._token, self._expires_at = stored, expires_at
+                        self.metrics["store_hits"] += 1
+                        return stored
+                except Exception as e:
+                    logger.warning("token store unavailable: %s", e)
+            return self._refresh()
+
+    def _refresh(self) -> Optional[str]:
+        started = time.perf_counter()
+        try:
+            token, expires_in = self.fetcher()
+        except Exception as e:
+            logger.warning("token refresh failed: %s", e)
+            token, expires_in = None, None
+        elapsed = time.perf_counter() - started
+        self.metrics["last_refresh_seconds"] = elapsed
+        self.metrics["total_refresh_seconds"] += elapsed
+        if not token:
+            self.metrics["refresh_errors"] += 1
+            return None
+        self.metrics["refreshes"] += 1
+        self._token = token
+        self._expires_at = self._clock() + float(expires_in or 0)
+        if self.store is not None:
+            try:
+                self.store.save(token, self._expires_at)
+            except Exception as e:
+                logger.warning("token store unavailable: %s", e)
+        return token
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+            if self.store is not None:
+                try:
+                    self.store.clear()
+                except Exception as e:
+                    logger.warning("token store unavailable: %s", e)
@@ -1,49 +1,315 @@
-import requests
+import asyncio
 import json
+import logging
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Iterable, List, Optional
+
+import httpx
+import requests
+
+from config import Config
+from services.dispatcher import KeyedDispatcher
+from utils.async_transport import async_transport
+from utils.metrics import tracer
+from utils.rate_limit import TokenBucket
+from utils.transport import transport
+
+logger = logging.getLogger("app.services.whatsapp")
 
 WSP_API_TOKEN = os.getenv('WSP_API_TOKEN')
 WSP_API_URL = os.getenv('WSP_API_URL')
 WSP_API_VERSION = os.getenv('WSP_API_VERSION')
 WSP_API_PHONE_ID = os.getenv('WSP_API_PHONE_ID')
 
+def _send_message_request(data):
+    # Las plantillas de utils.helpers ya llegan serializadas (bytes)
+    return dict(
+        url = f'{WSP_API_URL}/{WSP_API_VERSION}/{WSP_API_PHONE_ID}/messages',
+        data = data if isinstance(data, bytes) else json.dumps(data),
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {WSP_API_TOKEN}'
+        }
+    )
+
+def _send_message_result(response):
+    if response.status_code == 200:
+        logger.info('send_message %s', response.status_code, extra={'event': 'send_message'})
+        return True
+
+    logger.warning('send_message %s: %s', response.status_code, response.text[:500], extra={'event': 'send_message'})
+    return False
+
+def _recipient(data) -> str:
+    return (getattr(data, 'to', None) if isinstance(data, bytes) else data.get('to')) or ''
+
 def send_message(data: dict):
     try:
-        response = requests.post(
-            url = f'{WSP_API_URL}/{WSP_API_VERSION}/{WSP_API_PHONE_ID}/messages',
-            data = json.dumps(data),
-            headers = {
-                'Content-Type': 'application/json', 
-                'Authorization': f'Bearer {WSP_API_TOKEN}'
-            }
-        )
-
-        print('send_message', response)
-        if response.status_code == 200:
-            return True
-        
-        return False
+        response = transport.post(**_send_message_request(data))
+        return _send_message_result(response)
     except Exception as exception:
-        print(exception)
+        logger.warning('send_message error: %s', exception)
         return False
-    
+
+def _get_file_request(fileId: int):
+    return dict(
+        url=f'{WSP_API_URL}/{WSP_API_VERSION}/{fileId}',
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {WSP_API_TOKEN}'
+        },
+        timeout=30
+    )
+
+def _get_file_result(response):
+    if response.status_code == 200:
+        try:
+            return True, response.json()
+        except Exception:
+            # Fallback por si no es JSON parseable
+            return True, {}
+    return False, {}
+
 def get_file(fileId: int):
     try:
-        response = requests.get(
-            url=f'{WSP_API_URL}/{WSP_API_VERSION}/{fileId}',
-            headers={
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {WSP_API_TOKEN}'
-            },
-            timeout=30
-        )
-        if response.status_code == 200:
+        response = transport.get(**_get_file_request(fileId))
+        return _get_file_result(response)
+    except Exception as exception:
+        logger.warning('get_file error: %s', exception)
+        return False, {}
+
+# Códigos de error de la Cloud API que indican throttling aunque el status sea 400
+_RATE_LIMIT_ERROR_CODES = {4, 80007, 130429, 131048, 131056}
+
+# Errores de red que se reintentan como un 5xx: el mensaje no llegó o no hubo respuesta
+_TRANSPORT_ERRORS = (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+
+def _retry_delay(response, attempt: int, backoff: float) -> Optional[float]:
+    """Segundos a esperar antes de reintentar, o None si la respuesta no es reintentable."""
+    status = response.status_code
+    throttled = status == 429
+    if status == 400:
+        try:
+            throttled = response.json().get('error', {}).get('code') in _RATE_LIMIT_ERROR_CODES
+        except Exception:
+            throttled = False
+    if not throttled and status < 500:
+        return None
+    retry_after = response.headers.get('Retry-After')
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        return backoff * (2 ** (attempt - 1))
+
+
+class _BaseSendQueue:
+    """Bucket, política de reintentos y métricas comunes a SendQueue y AsyncSendQueue."""
+
+    def __init__(self, bucket: TokenBucket, max_retries: int = 3, backoff: float = 1.0, latency_window: int = 1024):
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+        self._sent_at = deque(maxlen=latency_window)
+        self.metrics = {"queued": 0, "sent": 0, "failed": 0, "retries": 0, "throttled": 0}
+
+    def _queued(self) -> float:
+        with self._lock:
+            self.metrics["queued"] += 1
+        return time.monotonic()
+
+    def _next_delay(self, response, attempt: int) -> Optional[float]:
+        """Espera antes del próximo intento, o None si hay que quedarse con esta respuesta."""
+        delay = _retry_delay(response, attempt, self.backoff) if response.status_code != 200 else None
+        if delay is None or attempt > self.max_retries:
+            return None
+        with self._lock:
+            self.metrics["retries"] += 1
+            if response.status_code < 500:
+                self.metrics["throttled"] += 1
+        if response.status_code < 500:
+            # Throttling: frenar el bucket para todos los envíos, no solo este
+            self.bucket.penalize(delay)
+        return delay
+
+    def _error_delay(self, exception: Exception, attempt: int) -> Optional[float]:
+        """Espera antes de reintentar tras un error de red, o None si se agotaron los intentos."""
+        if attempt > self.max_retries:
+            return None
+        with self._lock:
+            self.metrics["retries"] += 1
+        logger.warning('send_message error (intento %d): %s', attempt, exception)
+        return self.backoff * (2 ** (attempt - 1))
+
+    def _finished(self, ok: bool, queued_at: float) -> None:
+        finished = time.monotonic()
+        with self._lock:
+            self.metrics["sent" if ok else "failed"] += 1
+            self._latencies.append(finished - queued_at)
+            if ok:
+                self._sent_at.append(finished)
+
+    def stats(self) -> dict:
+        """Contadores, latencia encolado->entrega (p50/p95/p99, en ms) y throughput de los últimos 60 s."""
+        with self._lock:
+            stats = dict(self.metrics)
+            latencies = sorted(self._latencies)
+            now = time.monotonic()
+            recent = sum(1 for t in self._sent_at if now - t <= 60)
+        for name, q in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+            stats[f'latency_{name}_ms'] = latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000 if latencies else None
+        stats['sent_per_second'] = recent / 60.0
+        stats['pending'] = stats['queued'] - stats['sent'] - stats['failed']
+        return stats
+
+
+class SendQueue(_BaseSendQueue):
+    """Cola de envío saliente a la Cloud API.
+
+    Los mensajes a un mismo destinatario salen en orden estricto (FIFO) y
+    los de distintos destinatarios en paralelo en ``workers`` hilos. Cada
+    intento consume un token del bucket global (``rate`` mensajes/seg). Los
+    429/5xx (y los 400 de throttling) se reintentan respetando Retry-After;
+    un 429 además frena el bucket para todos los envíos. Los errores de red
+    (conexión, timeout) se reintentan con el mismo backoff y límite de intentos.
+    """
+
+    def __init__(self, workers: int = 8, rate: float = 80.0, burst: Optional[float] = None,
+                 max_retries: int = 3, backoff: float = 1.0, latency_window: int = 1024):
+        super().__init__(TokenBucket(rate, burst), max_retries, backoff, latency_window)
+        self._dispatcher = KeyedDispatcher(workers=workers, name='wsp-send')
+
+    def send(self, data) -> Future:
+        """Encola un mensaje; el Future resuelve a True/False cuando se entrega o se agota."""
+        future = Future()
+        self._dispatcher.submit(_recipient(data), self._deliver, data, future, self._queued())
+        return future
+
+    def send_many(self, items: Iterable, wait: bool = True, timeout: Optional[float] = None):
+        """Encola varios mensajes (en orden por destinatario). Con wait=True devuelve la lista de resultados."""
+        futures = [self.send(item) for item in items]
+        if not wait:
+            return futures
+        deadline = None if timeout is None else time.monotonic() + timeout
+        results: List[bool] = []
+        for future in futures:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
             try:
-                return True, response.json()
+                results.append(future.result(remaining))
             except Exception:
-                # Fallback por si no es JSON parseable
-                return True, {}
-        return False, {}
-    except Exception as exception:
-        print('get_file error:', exception)
-        return False, {}
\ No newline at end of file
+                results.append(False)
+        return results
+
+    def _deliver(self, data, future: Future, queued_at: float) -> None:
+        ok = False
+        try:
+            attempt = 0
+            while True:
+                attempt += 1
+                self.bucket.acquire()
+                try:
+                    with tracer.span('reply_send'):
+                        response = transport.post(**_send_message_request(data))
+                except _TRANSPORT_ERRORS as exception:
+                    delay = self._error_delay(exception, attempt)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    continue
+                delay = self._next_delay(response, attempt)
+                if delay is None:
+                    ok = _send_message_result(response)
+                    break
+                time.sleep(delay)
+        except Exception as exception:
+            logger.warning('send_message error: %s', exception)
+        finally:
+            self._finished(ok, queued_at)
+            future.set_result(ok)
+
+
+class AsyncSendQueue(_BaseSendQueue):
+    """Envío awaitable a la Cloud API para el modo ASGI.
+
+    Usa el cliente httpx compartido (``utils.async_transport``): esperar una
+    respuesta no ocupa un hilo. Comparte el bucket de ``SendQueue``, así el
+    proceso entero (respuestas y difusiones) respeta un único límite de
+    mensajes/seg, y aplica la misma política de reintentos. El orden por
+    destinatario lo da quien llama: el despachador ASGI serializa por
+    remitente y ``send_many`` espera cada envío antes del siguiente.
+    """
+
+    async def send(self, data) -> bool:
+        queued_at = self._queued()
+        ok = False
+        try:
+            attempt = 0
+            while True:
+                attempt += 1
+                wait = self.bucket.try_acquire()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self.bucket.try_acquire()
+                try:
+                    with tracer.span('reply_send'):
+                        response = await async_transport.post(**_send_message_request(data))
+                except _TRANSPORT_ERRORS as exception:
+                    delay = self._error_delay(exception, attempt)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                delay = self._next_delay(response, attempt)
+                if delay is None:
+                    ok = _send_message_result(response)
+                    break
+                await asyncio.sleep(delay)
+        except Exception as exception:
+            logger.warning('send_message error: %s', exception)
+        finally:
+            self._finished(ok, queued_at)
+        return ok
+
+    async def send_many(self, items: Iterable) -> List[bool]:
+        """Envía en orden, uno tras otro; devuelve el resultado de cada mensaje."""
+        return [await self.send(item) for item in items]
+
+
+_send_queue = None
+_async_send_queue = None
+_send_queue_lock = threading.Lock()
+
+def get_send_queue() -> SendQueue:
+    global _send_queue
+    if _send_queue is None:
+        with _send_queue_lock:
+            if _send_queue is None:
+                _send_queue = SendQueue(
+                    workers=Config.WSP_SEND_WORKERS,
+                    rate=Config.WSP_SEND_RATE,
+                    burst=Config.WSP_SEND_BURST,
+                    max_retries=Config.WSP_SEND_MAX_RETRIES,
+                    backoff=Config.WSP_SEND_BACKOFF,
+                )
+    return _send_queue
+
+def get_async_send_queue() -> AsyncSendQueue:
+    global _async_send_queue
+    if _async_send_queue is None:
+        bucket = get_send_queue().bucket
+        with _send_queue_lock:
+            if _async_send_queue is None:
+                _async_send_queue = AsyncSendQueue(
+                    bucket,
+                    max_retries=Config.WSP_SEND_MAX_RETRIES,
+                    backoff=Config.WSP_SEND_BACKOFF,
+                )
+    return _async_send_queue
+
+def send_many(items: Iterable, wait: bool = True, timeout: Optional[float] = None):
+    return get_send_queue().send_many(items, wait=wait, timeout=timeout)
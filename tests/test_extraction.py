@@ -0,0 +1,207 @@
+import json
+import random
+
+import pytest
+
+from utils.extraction import assistant_text, first_string, parse_json_text, strip_fences
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('', ''),
+    ('   \n', ''),
+    ('plain answer', 'plain answer'),
+    ('  {"a": 1}  ', '{"a": 1}'),
+    ('```json\n{"a": 1}\n```', '{"a": 1}'),
+    ('```JSON\n{"a": 1}\n```', '{"a": 1}'),
+    ('```\n[1, 2]\n```', '[1, 2]'),
+    ('```json {"a": 1}```', '{"a": 1}'),
+    ('Here it is:\n```json\n{"a": 1}\n```\nthanks', '{"a": 1}'),
+    ('```json\n{"a": 1}', '{"a": 1}'),
+    ('```json\n{"a": 1}\n```\n```json\n{"b": 2}\n```', '{"a": 1}'),
+    ('```', ''),
+])
+def test_strip_fences(text, expected):
+    assert strip_fences(text) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"a": 1}', (True, {'a': 1})),
+    ('```json\n{"a": [1, 2]}\n```', (True, {'a': [1, 2]})),
+    ('[1, "x"]', (True, [1, 'x'])),
+    ('"just a string"', (True, 'just a string')),
+    ('```json\n"fenced string"\n```', (True, 'fenced string')),
+    ('-3.5', (True, -3.5)),
+    ('42', (True, 42)),
+    ('true', (True, True)),
+    ('null', (True, None)),
+    ('', (False, '')),
+    ('   ', (False, '')),
+    ('Lo siento, no puedo leer el documento.', (False, 'Lo siento, no puedo leer el documento.')),
+    ('{"a": 1', (False, '{"a": 1')),
+    ('```json\n{not json}\n```', (False, '{not json}')),
+    ('trueish', (False, 'trueish')),
+    ('{"nombre": "José Muñoz", "ciudad": "Ñuñoa"}', (True, {'nombre': 'José Muñoz', 'ciudad': 'Ñuñoa'})),
+    ('```json\n{"emoji": "📄✅"}\n```', (True, {'emoji': '📄✅'})),
+    ('Área: «sin datos»', (False, 'Área: «sin datos»')),
+])
+def test_parse_json_text(text, expected):
+    assert parse_json_text(text) == expected
+
+
+@pytest.mark.parametrize('data, expected', [
+    ({'choices': [{'message': {'content': 'hola'}}]}, 'hola'),
+    ({'choices': [{'message': {'content': ''}}]}, ''),
+    ({'choices': [{'delta': {'content': 'parcial'}}]}, 'parcial'),
+    ({'choices': [{'text': 'legacy'}]}, 'legacy'),
+    ({'choices': [{'message': {'payload': 'p'}}]}, 'p'),
+    ({'choices': ['bare']}, 'bare'),
+    ({'choices': [{'message': 'as string'}]}, 'as string'),
+    ({'result': {'choices': [{'message': {'content': 'wrapped'}}]}}, 'wrapped'),
+    ({'data': {'output': ['', {'text': 'deep'}]}}, 'deep'),
+    ({'choices': []}, None),
+    ({'choices': [{'message': {'content': None}}]}, None),
+    ({}, None),
+    ([], None),
+    (None, None),
+    (42, None),
+    ('raw text', 'raw text'),
+    ({'choices': [{'message': {'content': 'Señor Ñandú 🚀'}}]}, 'Señor Ñandú 🚀'),
+])
+def test_assistant_text(data, expected):
+    assert assistant_text(data) == expected
+
+
+def test_first_string_document_order():
+    assert first_string({'a': [None, 1, {'b': ''}], 'c': {'d': 'first'}, 'e': 'second'}) == 'first'
+
+
+def test_first_string_node_budget():
+    data = [0] * 50 + ['late']
+    assert first_string(data, max_nodes=10) is None
+    assert first_string(data, max_nodes=100) == 'late'
+
+
+def test_first_string_depth_limit():
+    data = 'bottom'
+    for _ in range(50):
+        data = [data]
+    assert first_string(data, max_depth=10) is None
+    assert first_string(data, max_depth=64) == 'bottom'
+    assert first_string([[[]], 'sibling'], max_depth=2) == 'sibling'
+
+
+def test_first_string_deep_nesting_does_not_recurse():
+    data = 'bottom'
+    for _ in range(5000):
+        data = {'k': data}
+    assert first_string(data, max_depth=10000) == 'bottom'
+
+
+# ---------------------------------------------------------------------------
+# Property tests: seeded random inputs, so failures are reproducible by seed.
+
+SEEDS = range(200)
+ALPHABET = 'abcxyz019 -_:.,{}[]"\\\'\n\tñÑáéü€漢字😀'
+
+
+def random_text(rng, max_len=12, backticks=False):
+    alphabet = ALPHABET + ('`' if backticks else '')
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, max_len)))
+
+
+def random_json(rng, depth=0, backticks=False):
+    kind = rng.choice(['str', 'int', 'float', 'bool', 'null'] + (['dict', 'list'] * 2 if depth < 4 else []))
+    if kind == 'str':
+        return random_text(rng, backticks=backticks)
+    if kind == 'int':
+        return rng.randint(-10 ** 12, 10 ** 12)
+    if kind == 'float':
+        return rng.uniform(-1e6, 1e6)
+    if kind == 'bool':
+        return rng.random() < 0.5
+    if kind == 'null':
+        return None
+    if kind == 'dict':
+        return {random_text(rng, 6, backticks): random_json(rng, depth + 1, backticks) for _ in range(rng.randint(0, 4))}
+    return [random_json(rng, depth + 1, backticks) for _ in range(rng.randint(0, 4))]
+
+
+def reference_first_string(node, max_depth, depth=1):
+    """Recursive twin of first_string (no node budget)."""
+    for child in (node.values() if isinstance(node, dict) else node):
+        if isinstance(child, str):
+            if child:
+                return child
+        elif isinstance(child, (dict, list)) and depth < max_depth:
+            found = reference_first_string(child, max_depth, depth + 1)
+            if found is not None:
+                return found
+    return None
+
+
+def fence(rng, body):
+    opener = rng.choice(['```json\n', '```JSON\n', '```\n', '```json '])
+    closer = rng.choice(['\n```', '```', ''])
+    prose = [rng.choice(['', 'Aquí está el resultado:\n', 'Result →\n']), rng.choice(['', '\nSaludos.', '\n¿Algo más?'])]
+    return f'{prose[0]}{opener}{body}{closer}{prose[1] if closer else ""}'
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_property_json_round_trip(seed):
+    rng = random.Random(seed)
+    value = random_json(rng, backticks=True)
+    text = json.dumps(value, ensure_ascii=rng.random() < 0.5, indent=rng.choice([None, 2]))
+    assert parse_json_text(text) == (True, value)
+    assert parse_json_text(f'  \n{text}\n ') == (True, value)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_property_fenced_json_round_trip(seed):
+    rng = random.Random(seed)
+    value = random_json(rng)
+    body = json.dumps(value, ensure_ascii=False, indent=rng.choice([None, 2]))
+    assert parse_json_text(fence(rng, body)) == (True, value)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_property_non_json_text_comes_back_unfenced(seed):
+    rng = random.Random(seed)
+    prose = 'Respuesta: ' + random_text(rng, 40)
+    ok, value = parse_json_text(prose)
+    assert not ok and value == prose.strip()
+    ok, value = parse_json_text(fence(rng, prose))
+    assert not ok and value == prose.strip()
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_property_first_string_matches_recursive_reference(seed):
+    rng = random.Random(seed)
+    value = random_json(rng)
+    container = value if isinstance(value, (dict, list)) else [value]
+    for max_depth in (1, 2, 3, 32):
+        assert first_string(container, max_depth=max_depth) == reference_first_string(container, max_depth)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_property_first_string_depth_bound(seed):
+    rng = random.Random(seed)
+    depth = rng.randint(1, 60)
+    max_depth = rng.randint(1, 60)
+    leaf = rng.choice(['hit', 'ñandú', '漢字'])
+    node = leaf
+    for _ in range(depth):
+        node = [0, node] if rng.random() < 0.5 else {random_text(rng, 3): None, '~': node}
+    # The string sits inside ``depth`` containers: found only when max_depth reaches it
+    assert first_string(node, max_depth=max_depth) == (leaf if depth <= max_depth else None)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_property_assistant_text_unwraps_any_envelope(seed):
+    rng = random.Random(seed)
+    text = random_text(rng, 30) or 'x'
+    message = rng.choice([{'content': text}, {'text': text}, {'payload': text}, text])
+    choice = rng.choice([{'message': message}, {'delta': message}, message if isinstance(message, dict) else text])
+    data = {'id': rng.randint(0, 99), 'choices': [choice]}
+    for _ in range(rng.randint(0, 3)):
+        data = {rng.choice(['result', 'data', 'response']): data, 'status': rng.randint(200, 299)}
+    assert assistant_text(data) == text
@@ -0,0 +1,140 @@
+import io
+
+import pytest
+
+from bench.stubs import StubServer, media_bytes
+from config import Config
+from services import graph
+from services.graph import UPLOAD_FRAGMENT_UNIT, graph_create_upload_session, graph_upload_large_file
+from utils.streams import QuickXorHash
+from utils.transport import transport
+
+SIZE = 3 * UPLOAD_FRAGMENT_UNIT + 12345
+
+
+@pytest.fixture(scope='module')
+def stub():
+    server = StubServer(latency=0).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def drive(stub, monkeypatch):
+    monkeypatch.setattr(Config, 'GRAPH_API_URL', stub.url)
+    monkeypatch.setattr(Config, 'GRAPH_UPLOAD_MAX_RETRIES', 2)
+    sleeps = []
+    real_sleep = graph.time.sleep
+    # time is shared with the stub, which sleeps its (zero) latency on every request
+    monkeypatch.setattr(graph.time, 'sleep', lambda s: sleeps.append(s) if s else real_sleep(s))
+    stub.reset()
+    stub.sleeps = sleeps
+    return stub
+
+
+def quickxor(data):
+    h = QuickXorHash()
+    h.update(data)
+    return h.b64digest()
+
+
+def upload(data, **kwargs):
+    kwargs.setdefault('chunk_size', UPLOAD_FRAGMENT_UNIT)
+    return graph_upload_large_file('token', 'user@example.com', 'uploads', 'doc.pdf',
+                                   lambda: io.BytesIO(data), len(data), **kwargs)
+
+
+def uploaded(stub, item):
+    return bytes(stub.uploads[item['id']])
+
+
+def ranged_puts(stub):
+    return sum(n for key, n in stub.paths.items() if key.startswith('PUT /upload/'))
+
+
+def test_multi_chunk_upload_sends_fragments_in_order(drive):
+    data = media_bytes('multi', SIZE)
+    sessions = []
+
+    item = upload(data, expected_quickxor=quickxor(data), on_session=sessions.append)
+
+    assert item is not None
+    assert item['size'] == SIZE
+    assert uploaded(drive, item) == data
+    # The stub answers 416 to any out-of-order Content-Range
+    assert ranged_puts(drive) == 4
+    assert drive.sleeps == []
+    assert sessions and sessions[0]['uploadUrl'].endswith(item['id'])
+
+
+def test_chunk_size_is_rounded_to_fragment_unit(drive):
+    data = media_bytes('rounded', SIZE)
+
+    item = upload(data, chunk_size=UPLOAD_FRAGMENT_UNIT + 1000)
+
+    assert uploaded(drive, item) == data
+    assert ranged_puts(drive) == 4
+
+
+def test_416_resumes_from_next_expected_ranges(drive):
+    data = media_bytes('resume', SIZE)
+    session = graph_create_upload_session('token', 'user@example.com', 'uploads', 'doc.pdf')
+    # Graph already has the first fragment but its reply was lost: the session still says 0-
+    r = transport.put(session['uploadUrl'], data=data[:UPLOAD_FRAGMENT_UNIT], headers={
+        'Content-Range': f'bytes 0-{UPLOAD_FRAGMENT_UNIT - 1}/{SIZE}',
+    })
+    assert r.status_code == 202
+    drive.reset()
+
+    item = upload(data, session=session, expected_quickxor=quickxor(data))
+
+    assert item is not None
+    assert uploaded(drive, item) == data
+    assert drive.sleeps == [2]
+    assert drive.paths[f"GET {session['uploadUrl'][len(drive.url):]}"] == 1
+    # The first PUT gets 416, then the three remaining fragments go through
+    assert ranged_puts(drive) == 4
+
+
+def test_hash_mismatch_returns_none(drive):
+    data = media_bytes('mismatch', SIZE)
+
+    assert upload(data, expected_quickxor=quickxor(data[::-1])) is None
+    assert ranged_puts(drive) == 4
+
+
+def test_size_mismatch_returns_none(drive, monkeypatch):
+    data = media_bytes('short', SIZE)
+    graph_upload = drive.graph_upload
+
+    def truncated(method, path, headers, body):
+        status, payload = graph_upload(method, path, headers, body)
+        if status == 201:
+            payload['size'] -= 1
+        return status, payload
+
+    monkeypatch.setattr(drive, 'graph_upload', truncated)
+    assert upload(data) is None
+
+
+def test_expired_session_returns_none(drive):
+    data = media_bytes('expired', SIZE)
+    session = {'uploadUrl': f'{drive.url}/upload/missing', 'nextExpectedRanges': ['0-']}
+
+    assert upload(data, session=session) is None
+    assert ranged_puts(drive) == 1
+
+
+def test_gives_up_after_max_retries(drive, monkeypatch):
+    data = media_bytes('stuck', SIZE)
+    graph_upload = drive.graph_upload
+
+    def rejecting(method, path, headers, body):
+        if method == 'PUT':
+            return 416, {'nextExpectedRanges': ['0-']}
+        return graph_upload(method, path, headers, body)
+
+    monkeypatch.setattr(drive, 'graph_upload', rejecting)
+    assert upload(data) is None
+    assert ranged_puts(drive) == 3
+    assert drive.sleeps == [2, 4]
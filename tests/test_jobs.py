@@ -0,0 +1,173 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from services.jobs import InProcessBackend, JobHalt, JobPipeline, Stage
+
+
+def make_pipeline(stages, **kwargs):
+    return JobPipeline('test', stages, backend=InProcessBackend(), workers=0, **kwargs)
+
+
+def run(pipeline, payload=None):
+    job_id = pipeline.submit(payload or {})
+    assert pipeline.run_pending() == 1
+    return pipeline.get_job(job_id)
+
+
+def test_stages_run_in_order_and_share_context():
+    seen = []
+
+    def first(job):
+        job['ctx']['value'] = job['payload']['n'] * 2
+        seen.append('first')
+
+    def second(job):
+        seen.append(('second', job['ctx']['value']))
+
+    pipeline = make_pipeline([Stage('first', first), Stage('second', second)])
+    job = run(pipeline, {'n': 21})
+
+    assert job['status'] == 'completed'
+    assert seen == ['first', ('second', 42)]
+    assert {s['status'] for s in job['stages'].values()} == {'done'}
+    assert 'ctx' not in job
+    assert pipeline.metrics['completed'] == 1
+
+
+def test_failed_attempts_are_retried_until_success():
+    calls = []
+
+    def flaky(job):
+        calls.append(1)
+        if len(calls) < 3:
+            raise RuntimeError('temporary')
+
+    pipeline = make_pipeline([Stage('flaky', flaky, retries=2, backoff=0)])
+    job = run(pipeline)
+
+    assert job['status'] == 'completed'
+    assert job['stages']['flaky']['attempts'] == 3
+    assert 'error' not in job['stages']['flaky']
+    assert pipeline.metrics['stage_retries'] == 2
+
+
+def test_exhausted_retries_fail_the_job_unless_optional():
+    def broken(job):
+        raise RuntimeError('boom')
+
+    pipeline = make_pipeline([Stage('broken', broken, retries=1, backoff=0), Stage('next', lambda job: None)])
+    job = run(pipeline)
+    assert job['status'] == 'failed'
+    assert job['stages']['broken']['status'] == 'failed'
+    assert job['stages']['broken']['attempts'] == 2
+    assert job['stages']['broken']['error'] == 'boom'
+    assert job['stages']['next']['status'] == 'pending'
+
+    pipeline = make_pipeline([Stage('broken', broken, retries=0, optional=True), Stage('next', lambda job: None)])
+    job = run(pipeline)
+    assert job['status'] == 'completed'
+    assert job['stages']['next']['status'] == 'done'
+
+
+def test_halt_ends_the_job_and_skips_the_rest():
+    def gate(job):
+        raise JobHalt('nothing to do')
+
+    later = []
+    pipeline = make_pipeline([Stage('gate', gate), Stage('later', lambda job: later.append(1))])
+    job = run(pipeline)
+
+    assert job['status'] == 'halted'
+    assert job['stages']['gate']['status'] == 'halted'
+    assert job['stages']['gate']['reason'] == 'nothing to do'
+    assert job['stages']['later']['status'] == 'skipped'
+    assert later == []
+    assert pipeline.metrics['halted'] == 1
+
+
+@pytest.mark.parametrize('optional, expected', [(False, 'failed'), (True, 'completed')])
+def test_stage_timeout(optional, expected):
+    release = threading.Event()
+    finalized = threading.Event()
+    state = {}
+
+    def stuck(job):
+        release.wait(5)
+        state['ctx_alive'] = 'buffer' in job['ctx']
+
+    def finalizer(job):
+        job['ctx'].pop('buffer', None)
+        finalized.set()
+
+    pipeline = make_pipeline([
+        Stage('setup', lambda job: job['ctx'].update(buffer=object())),
+        Stage('stuck', stuck, retries=0, timeout=0.05, optional=optional),
+    ], finalizer=finalizer)
+    job = run(pipeline)
+
+    assert job['status'] == expected
+    assert job['stages']['stuck']['status'] == 'timeout'
+    assert pipeline.metrics['stage_timeouts'] == 1
+    # The abandoned thread still owns the context: the finalizer waits for it
+    assert not finalized.is_set()
+    release.set()
+    assert finalized.wait(5)
+    assert state['ctx_alive'] is True
+
+
+def test_recover_requeues_stale_unfinished_jobs():
+    mongomock = pytest.importorskip('mongomock')
+    jobs = mongomock.MongoClient().db.jobs
+    ran = []
+    stages = [Stage('first', lambda job: ran.append(job['payload']['n'])), Stage('second', lambda job: None)]
+
+    crashed = JobPipeline('test', stages, collection_getter=lambda: jobs, backend=InProcessBackend(), workers=0)
+    stale_id = crashed.submit({'n': 1})
+    fresh_id = crashed.submit({'n': 2})
+    done_id = crashed.submit({'n': 3})
+    jobs.update_one({'_id': stale_id}, {'$set': {'status': 'running', 'stages.first.status': 'done'}})
+    jobs.update_one({'_id': done_id}, {'$set': {'status': 'completed'}})
+    for job_id in (stale_id, done_id):
+        jobs.update_one({'_id': job_id}, {'$set': {'updated_at': datetime.now(timezone.utc) - timedelta(hours=1)}})
+
+    pipeline = JobPipeline('test', stages, collection_getter=lambda: jobs, backend=InProcessBackend(), workers=0)
+    other = JobPipeline('test', stages, collection_getter=lambda: jobs, backend=InProcessBackend(), workers=0)
+    assert pipeline.recover(stale_after=60) == 1
+    # Already claimed: a second worker does not take it again
+    assert other.recover(stale_after=60) == 0
+    assert pipeline.run_pending() == 1
+
+    # Every stage runs again, from the payload alone
+    assert ran == [1]
+    assert pipeline.get_job(stale_id)['status'] == 'completed'
+    assert jobs.find_one({'_id': stale_id})['status'] == 'completed'
+    assert jobs.find_one({'_id': stale_id})['recoveries'] == 1
+    assert jobs.find_one({'_id': fresh_id})['status'] == 'queued'
+    assert pipeline.metrics['recovered'] == 1
+
+
+def test_orphaned_stage_threads_hold_back_new_jobs():
+    release = threading.Event()
+    pipeline = make_pipeline([
+        Stage('stuck', lambda job: release.wait(5) if job['payload'].get('stuck') else None,
+              retries=0, timeout=0.05),
+    ], saturated_delay=0.01)
+
+    assert run(pipeline, {'stuck': True})['stages']['stuck']['status'] == 'timeout'
+    assert pipeline.metrics['orphaned_stages'] == 1
+
+    # The only branch slot is still taken: the next job is parked, not queued behind it
+    job = run(pipeline, {'stuck': False})
+    assert job['status'] == 'deferred'
+    assert pipeline.metrics['deferred'] == 1
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while (pipeline.metrics['orphaned_stages'] or pipeline.metrics['parked']) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pipeline.metrics['orphaned_stages'] == 0
+    assert pipeline.run_pending() == 1
+    assert job['status'] == 'completed'
@@ -0,0 +1,29 @@
+import glob
+import json
+import os
+
+import pytest
+
+from services.media import extract_ia_text
+from utils.extraction import parse_json_text
+from utils.schemas import DEFAULT_REGISTRY
+
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'example', 'saia-*.json')))
+
+
+def test_saia_examples_exist():
+    assert EXAMPLES
+
+
+@pytest.mark.parametrize('path', EXAMPLES, ids=os.path.basename)
+def test_saia_example_validates_against_default_registry(path):
+    with open(path, encoding='utf-8') as fh:
+        response = json.load(fh)
+
+    ok, answer = parse_json_text(extract_ia_text(response))
+    assert ok, answer
+    schema, result, errors = DEFAULT_REGISTRY.validate(answer)
+
+    assert schema.name == answer['tipo_documento']
+    assert errors == []
+    assert result['message']
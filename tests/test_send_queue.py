@@ -0,0 +1,142 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import types
+
+import httpx
+import pytest
+import requests
+
+from services import whatsapp
+from services.whatsapp import AsyncSendQueue, SendQueue
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body or {}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+class FakeApi:
+    """Answers each POST with the next scripted reply (a FakeResponse or an exception)."""
+
+    def __init__(self, script=(), jitter=0.0):
+        self.script = list(script)
+        self.jitter = jitter
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def reply(self, kwargs):
+        message = json.loads(kwargs['data'])
+        with self._lock:
+            self.calls.append((message['to'], message['n']))
+            outcome = self.script.pop(0) if self.script else FakeResponse()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def post(self, **kwargs):
+        if self.jitter:
+            time.sleep(random.uniform(0, self.jitter))
+        return self.reply(kwargs)
+
+    async def apost(self, **kwargs):
+        return self.reply(kwargs)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(whatsapp, 'time', types.SimpleNamespace(monotonic=time.monotonic, sleep=slept.append))
+    return slept
+
+
+@pytest.fixture
+def api(monkeypatch):
+    fake = FakeApi()
+    monkeypatch.setattr(whatsapp.transport, 'post', fake.post)
+    return fake
+
+
+def message(to, n):
+    return {'messaging_product': 'whatsapp', 'to': to, 'n': n}
+
+
+def test_429_waits_retry_after_and_penalizes_the_bucket(api, sleeps, monkeypatch):
+    api.script = [FakeResponse(429, {'Retry-After': '0.01'}), FakeResponse(429, {'Retry-After': '0.02'})]
+    queue = SendQueue(workers=1, rate=1000, backoff=5)
+    penalties = []
+    monkeypatch.setattr(queue.bucket, 'penalize', penalties.append)
+
+    assert queue.send(message('56911111111', 1)).result(5) is True
+    assert len(api.calls) == 3
+    # Retry-After wins over the exponential backoff
+    assert sleeps == [0.01, 0.02]
+    assert penalties == [0.01, 0.02]
+    stats = queue.stats()
+    assert (stats['sent'], stats['retries'], stats['throttled'], stats['failed']) == (1, 2, 2, 0)
+
+
+def test_429_without_retry_after_backs_off_until_the_budget_runs_out(api, sleeps):
+    api.script = [FakeResponse(429) for _ in range(10)]
+    queue = SendQueue(workers=1, rate=1000, max_retries=2, backoff=1.0)
+
+    assert queue.send(message('56911111111', 1)).result(5) is False
+    assert len(api.calls) == 3
+    assert sleeps == [1.0, 2.0]
+    assert queue.stats()['failed'] == 1
+
+
+def test_transport_errors_are_retried_with_backoff(api, sleeps):
+    api.script = [requests.ConnectionError('reset'), requests.Timeout('slow')]
+    queue = SendQueue(workers=1, rate=1000, backoff=0.5)
+
+    assert queue.send(message('56911111111', 1)).result(5) is True
+    assert len(api.calls) == 3
+    assert sleeps == [0.5, 1.0]
+    stats = queue.stats()
+    assert (stats['sent'], stats['retries'], stats['throttled']) == (1, 2, 0)
+
+
+def test_transport_errors_share_the_attempt_budget(api, sleeps):
+    api.script = [FakeResponse(503), requests.ConnectionError('reset'), requests.ConnectionError('reset')]
+    queue = SendQueue(workers=1, rate=1000, max_retries=2, backoff=0.5)
+
+    assert queue.send(message('56911111111', 1)).result(5) is False
+    assert len(api.calls) == 3
+    assert sleeps == [0.5, 1.0]
+
+
+def test_messages_to_one_recipient_keep_their_order(api, sleeps):
+    api.jitter = 0.002
+    # The first delivery is throttled once: later messages to that recipient wait for its retry
+    api.script = [FakeResponse(429, {'Retry-After': '0'})]
+    queue = SendQueue(workers=4, rate=10000)
+    recipients = [f'5691111111{i}' for i in range(5)]
+    items = [message(recipients[n % len(recipients)], n) for n in range(100)]
+
+    assert queue.send_many(items, timeout=10) == [True] * 100
+
+    for to in recipients:
+        sent = [n for recipient, n in api.calls if recipient == to]
+        delivered = sorted(set(sent), key=sent.index)
+        assert delivered == [n for n in range(100) if recipients[n % len(recipients)] == to]
+
+
+def test_async_queue_retries_429_and_transport_errors(monkeypatch):
+    fake = FakeApi([FakeResponse(429, {'Retry-After': '0'}), httpx.ConnectError('refused')])
+    monkeypatch.setattr(whatsapp.async_transport, 'post', fake.apost)
+    queue = AsyncSendQueue(SendQueue(workers=1, rate=1000).bucket, backoff=0)
+
+    results = asyncio.run(queue.send_many([message('56911111111', 1), message('56911111111', 2)]))
+
+    assert results == [True, True]
+    assert fake.calls == [('56911111111', 1), ('56911111111', 1), ('56911111111', 1), ('56911111111', 2)]
+    assert queue.stats()['retries'] == 2
@@ -1,24 +1,101 @@
+import contextlib
 import json
 import logging
-import re
 import time
-import uuid
-from typing import Any, Dict, Optional, Union
+from typing import Any, Callable, Dict, Optional
 
 import requests
 from dotenv import load_dotenv
 
+from utils import extraction
+from utils.bulkhead import Guard, Unavailable
+from utils.log import get_correlation_id, new_correlation_id
+from utils.metrics import tracer
+from utils.transport import transport
+
 # Configure a proper hierarchical logger
 logger = logging.getLogger("app.services.ai.processor")
 
 # Load environment variables
 load_dotenv()
 
+DeltaCallback = Callable[[str, str], None]
+
+
+class _DeltaStream:
+    """Incremental assembler for the SAIA/OpenAI-style SSE stream.
+
+    ``feed(chunk)`` takes raw bytes as they arrive, decodes every complete
+    ``data:`` line and appends its ``choices[].delta.content`` to ``text``,
+    calling ``on_delta(delta, text)`` for each piece. Only the current partial
+    line is buffered and a line longer than ``max_line`` bytes is an error, so
+    a misbehaving server cannot grow memory without bound. Each ``data:`` line
+    is one JSON event, as SAIA sends them; ``data: [DONE]`` ends the stream.
+    """
+
+    def __init__(self, started: float, on_delta: Optional[DeltaCallback] = None, max_line: int = 1024 * 1024):
+        self.started = started
+        self.on_delta = on_delta
+        self.max_line = max_line
+        self.text = ""
+        self.done = False
+        self._buffer = b""
+
+    def feed(self, chunk: bytes) -> None:
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        if len(self._buffer) > self.max_line:
+            raise ValueError(f"SSE line exceeds {self.max_line} bytes")
+        for line in lines:
+            self._line(line)
+
+    def close(self) -> str:
+        if self._buffer:
+            self._line(self._buffer)
+            self._buffer = b""
+        return self.text
+
+    def _line(self, line: bytes) -> None:
+        line = line.rstrip(b"\r")
+        if self.done or not line.startswith(b"data:"):
+            return  # blank separators, comments (":"), event/id fields
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            self.done = True
+            return
+        try:
+            event = extraction.loads(data)
+        except ValueError:
+            logger.debug("Evento SSE no es JSON: %r", data[:200])
+            return
+        choices = event.get("choices") if isinstance(event, dict) else None
+        for choice in choices or []:
+            delta = choice.get("delta") if isinstance(choice, dict) else None
+            content = delta.get("content") if isinstance(delta, dict) else None
+            if isinstance(content, str) and content:
+                self._append(content)
+
+    def _append(self, delta: str) -> None:
+        if not self.text:
+            tracer.observe("saia_first_token", time.perf_counter() - self.started)
+        self.text += delta
+        if self.on_delta is not None:
+            try:
+                self.on_delta(delta, self.text)
+            except Exception as e:
+                logger.warning("on_delta callback failed: %s", e)
+
 
 class AIProcessor:
     """
-    Synchronous AI processor for SAIA chat endpoint.
+    AI processor for SAIA chat endpoint.
     Only essential behavior preserved: prepare payload, POST, extract text or JSON.
+    With stream=True the completion is read as SSE while it is generated:
+    on_delta(delta, text_so_far) is called for every piece and the assembled
+    text goes through the same extraction as a regular response.
+    With a guard (see utils.bulkhead) each request holds one of its permits;
+    when the breaker is open or no permit frees up in time the request is not
+    sent and {"error": "unavailable", "retry_after": seconds} comes back.
     """
 
     def __init__(
@@ -28,12 +105,16 @@ class AIProcessor:
         project_id: str,
         base_url: str = "https://api.saia.ai/chat",
         request_timeout: int = 60,
+        max_sse_line: int = 1024 * 1024,
+        guard: Optional[Guard] = None,
     ):
         self.api_token = api_token
         self.organization_id = organization_id
         self.project_id = project_id
         self.url = base_url
         self.request_timeout = request_timeout
+        self.max_sse_line = max_sse_line
+        self.guard = guard
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_token}",
@@ -57,18 +138,13 @@ class AIProcessor:
         }
 
     def _parse_ai_response(self, response_text: str) -> Dict[str, Any]:
-        clean = re.sub(r"```json\\s*|\\s*```", "", response_text, flags=re.DOTALL).strip()
-        try:
-            return json.loads(clean)
-        except json.JSONDecodeError:
-            logger.debug("Respuesta no es JSON válido, devolviendo como mensaje de texto")
-            return {"message": response_text}
+        ok, value = extraction.parse_json_text(response_text)
+        if ok:
+            return value
+        logger.debug("Respuesta no es JSON válido, devolviendo como mensaje de texto")
+        return {"message": response_text}
 
-    def process(self, assistant_id: str, content: Any, extra_headers: Optional[Dict[str, str]] = None, stream: bool = False) -> Dict[str, Any]:
-        start_time = time.time()
-        request_id = uuid.uuid4().hex[:8]
-        logger.debug(f"[{request_id}] Procesando solicitud para assistant_id={assistant_id}")
-        payload = self._prepare_payload(assistant_id, content, stream=stream)
+    def _prepare_headers(self, extra_headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
         headers = dict(self.headers)
         if extra_headers:
             for hk, hv in (extra_headers or {}).items():
@@ -76,67 +152,84 @@ class AIProcessor:
                     headers[str(hk)] = str(hv)
                 except Exception:
                     headers[str(hk)] = repr(hv)
+        return headers
+
+    def _extract_result(self, data: Any) -> Any:
+        # extract a textual payload if possible
+        raw = extraction.assistant_text(data)
+
+        if raw is None:
+            return data
+        if isinstance(raw, str) and raw.strip() == "":
+            return {"error": "no_text_found", "user_message": "No se detectó texto en el archivo o imagen."}
+        result = self._parse_ai_response(raw)
+        if isinstance(result, dict):
+            m = result.get("message")
+            if isinstance(m, str) and m.strip() == "":
+                return {"error": "no_text_found", "user_message": "No se detectó texto en el archivo o imagen."}
+        return result
+
+    @staticmethod
+    def _http_error(request_id: str, r: Any, e: Exception) -> Dict[str, Any]:
+        try:
+            text = r.text
+        except Exception:
+            text = str(e)
+        logger.error("Error HTTP: %s", text, extra={'correlation_id': request_id})
+        return {"error": "http_error", "detail": text}
+
+    def _slot(self):
+        return self.guard.slot() if self.guard is not None else contextlib.nullcontext()
+
+    @staticmethod
+    def _unavailable(request_id: str, e: Unavailable) -> Dict[str, Any]:
+        logger.warning("SAIA no disponible: %s", e, extra={'correlation_id': request_id})
+        return e.as_error()
+
+    @staticmethod
+    def _is_event_stream(r: Any) -> bool:
+        # Si el servidor ignora stream=True responde JSON normal
+        return "text/event-stream" in (r.headers.get("Content-Type") or "")
+
+    def _streamed_result(self, assembler: _DeltaStream) -> Any:
+        return self._extract_result({"choices": [{"message": {"content": assembler.close()}}]})
+
+    def process(self, assistant_id: str, content: Any, extra_headers: Optional[Dict[str, str]] = None,
+                stream: bool = False, on_delta: Optional[DeltaCallback] = None) -> Dict[str, Any]:
+        start_time = time.time()
+        started = time.perf_counter()
+        # Reusa el id del webhook/job en curso para poder seguir la solicitud en los logs
+        request_id = get_correlation_id() or new_correlation_id()
+        logger.debug("Procesando solicitud para assistant_id=%s", assistant_id, extra={'correlation_id': request_id})
+        payload = self._prepare_payload(assistant_id, content, stream=stream)
+        headers = self._prepare_headers(extra_headers)
 
+        r = None
         try:
-            r = requests.post(self.url, headers=headers, json=payload, timeout=self.request_timeout)
-            r.raise_for_status()
-            data = r.json()
-
-            # extract a textual payload if possible
-            raw = None
-            if isinstance(data, dict) and "choices" in data and data.get("choices"):
-                choice0 = data["choices"][0]
-                if isinstance(choice0, dict):
-                    msg = choice0.get("message") or choice0.get("delta") or choice0
-                    if isinstance(msg, dict):
-                        raw = msg.get("content") or msg.get("text") or msg.get("payload")
-                    elif isinstance(msg, str):
-                        raw = msg
-                elif isinstance(choice0, str):
-                    raw = choice0
-
-            if raw is None:
-                # try to find first string in response
-                def find_string(o):
-                    if isinstance(o, str):
-                        return o
-                    if isinstance(o, list):
-                        for v in o:
-                            s = find_string(v)
-                            if s:
-                                return s
-                        return None
-                    if isinstance(o, dict):
-                        for v in o.values():
-                            s = find_string(v)
-                            if s:
-                                return s
-                        return None
-                    return None
-
-                raw = find_string(data)
-
-            if raw is None:
-                result = data
-            else:
-                if isinstance(raw, str) and raw.strip() == "":
-                    return {"error": "no_text_found", "user_message": "No se detectó texto en el archivo o imagen."}
-                result = self._parse_ai_response(raw)
-                if isinstance(result, dict):
-                    m = result.get("message")
-                    if isinstance(m, str) and m.strip() == "":
-                        return {"error": "no_text_found", "user_message": "No se detectó texto en el archivo o imagen."}
+            with self._slot():
+                r = transport.post(self.url, headers=headers, json=payload, timeout=self.request_timeout, stream=stream)
+                tracer.observe("saia_ttfb", time.perf_counter() - started)
+                r.raise_for_status()
+                if stream and self._is_event_stream(r):
+                    assembler = _DeltaStream(started, on_delta, self.max_sse_line)
+                    for chunk in r.iter_content(chunk_size=None):
+                        assembler.feed(chunk)
+                        if assembler.done:
+                            break
+                    result = self._streamed_result(assembler)
+                else:
+                    result = self._extract_result(extraction.loads(r.content))
 
             elapsed = time.time() - start_time
-            logger.debug(f"[{request_id}] Procesamiento completado en {elapsed:.2f}s")
+            logger.debug("Procesamiento completado en %.2fs", elapsed, extra={'correlation_id': request_id})
             return result
+        except Unavailable as e:
+            return self._unavailable(request_id, e)
         except requests.HTTPError as e:
-            try:
-                text = r.text
-            except Exception:
-                text = str(e)
-            logger.error(f"[{request_id}] Error HTTP: {text}")
-            return {"error": "http_error", "detail": text}
+            return self._http_error(request_id, r, e)
         except Exception as e:
-            logger.exception("Error en process: %s", e)
+            logger.exception("Error en process: %s", e, extra={'correlation_id': request_id})
             return {"error": "internal_error", "detail": str(e)}
+        finally:
+            if stream and r is not None:
+                r.close()
@@ -0,0 +1,81 @@
+import asyncio
+from typing import Any, Dict, Optional
+
+import httpx
+
+from config import Config
+from utils.transport import TimeoutType
+
+
+class AsyncTransport:
+    """Awaitable counterpart of ``utils.transport.Transport`` built on httpx.
+
+    One ``httpx.AsyncClient`` (and therefore one keep-alive pool) is created
+    per running event loop. Keyword arguments follow the ``requests`` style
+    used by the sync clients: raw ``data`` bytes/str are sent as the body and
+    ``timeout`` may be a ``(connect, read)`` tuple.
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive: int = 20, retries: int = 2,
+                 timeout: TimeoutType = (5.0, 60.0)):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.retries = retries
+        self.timeout = timeout
+        self._clients: Dict[int, httpx.AsyncClient] = {}
+        self._requests = 0
+
+    @classmethod
+    def from_config(cls) -> "AsyncTransport":
+        return cls(
+            max_connections=Config.ASYNC_HTTP_MAX_CONNECTIONS,
+            max_keepalive=Config.HTTP_POOL_MAXSIZE,
+            retries=Config.HTTP_MAX_RETRIES,
+            timeout=(Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_READ_TIMEOUT),
+        )
+
+    @staticmethod
+    def _timeout(timeout: TimeoutType) -> httpx.Timeout:
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return httpx.Timeout(read, connect=connect)
+        return httpx.Timeout(timeout)
+
+    def client(self) -> httpx.AsyncClient:
+        loop_id = id(asyncio.get_running_loop())
+        client = self._clients.get(loop_id)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_keepalive),
+                transport=httpx.AsyncHTTPTransport(retries=self.retries),
+                timeout=self._timeout(self.timeout),
+            )
+            self._clients[loop_id] = client
+        return client
+
+    async def request(self, method: str, url: str, timeout: Optional[TimeoutType] = None,
+                      data: Any = None, **kwargs: Any) -> httpx.Response:
+        if isinstance(data, (bytes, bytearray, str)):
+            kwargs['content'] = data
+        elif data is not None:
+            kwargs['data'] = data
+        self._requests += 1
+        return await self.client().request(method, url, timeout=self._timeout(timeout or self.timeout), **kwargs)
+
+    async def get(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request('POST', url, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        return {'requests': self._requests, 'clients': len(self._clients)}
+
+    async def aclose(self) -> None:
+        client = self._clients.pop(id(asyncio.get_running_loop()), None)
+        if client is not None:
+            await client.aclose()
+
+
+async_transport = AsyncTransport.from_config()
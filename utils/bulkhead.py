@@ -0,0 +1,244 @@
+import asyncio
+import contextlib
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Union
+
+import httpx
+import requests
+
+from config import Config
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+# Numeric breaker state for the metrics endpoint
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Errors raised before or while talking to the dependency, as opposed to a bad
+# request or an unparseable answer (ValueError, JSONDecodeError, KeyError...)
+_TRANSPORT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    httpx.TransportError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+
+class Unavailable(Exception):
+    """A guarded dependency refused the call: its breaker is open or its bulkhead stayed full.
+
+    ``reason`` is ``'open'`` or ``'busy'``; ``retry_after`` is a hint in
+    seconds for callers that queue the work for later.
+    """
+
+    def __init__(self, name: str, reason: str, retry_after: float):
+        super().__init__(f"{name} unavailable ({reason}), retry in {retry_after:.0f}s")
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def as_error(self) -> Dict[str, Any]:
+        """The ``{"error": ...}`` dict the API clients return instead of raising."""
+        return {"error": "unavailable", "reason": self.reason, "detail": str(self), "retry_after": self.retry_after}
+
+
+def is_outage(exc: BaseException) -> bool:
+    """Whether ``exc`` says the dependency is unhealthy, not that the request was wrong.
+
+    HTTP errors count when the response is a 5xx or 429; other 4xx are the
+    caller's problem. Without a response only transport, timeout and
+    connection errors count: a payload that fails to parse is a bad answer,
+    not a down service.
+    """
+    status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    return isinstance(exc, _TRANSPORT_ERRORS)
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with half-open probing.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    ``allow()`` refuses calls for ``reset_timeout`` seconds. It then goes
+    half-open and lets up to ``half_open_max`` probe calls through: a
+    successful probe closes it, a failed one opens it again for another
+    ``reset_timeout``. ``allow()`` returns the state the call was admitted in
+    (falsy when refused); pass it back to ``record``/``cancel`` so a slow
+    call admitted before the breaker opened cannot close it.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_max: int = 1,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.half_open_max = max(1, half_open_max)
+        self._clock = clock
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.metrics = {"opens": 0, "failures": 0, "successes": 0, "rejected": 0}
+
+    def _refresh(self) -> None:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh()
+            return self._state
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (self._clock() - self._opened_at))
+
+    def allow(self) -> Union[str, bool]:
+        with self._lock:
+            self._refresh()
+            if self._state == CLOSED:
+                return CLOSED
+            if self._state == HALF_OPEN and self._probes < self.half_open_max:
+                self._probes += 1
+                return HALF_OPEN
+            self.metrics["rejected"] += 1
+            return False
+
+    def cancel(self, admitted: str = HALF_OPEN) -> None:
+        """Give back a probe admitted by ``allow()`` whose call never ran or never finished."""
+        with self._lock:
+            if admitted == HALF_OPEN and self._state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def _open(self) -> None:
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self.metrics["opens"] += 1
+
+    def record(self, ok: bool, admitted: str = CLOSED) -> None:
+        with self._lock:
+            if ok:
+                self.metrics["successes"] += 1
+                if self._state == CLOSED:
+                    self._failures = 0
+                elif self._state == HALF_OPEN and admitted == HALF_OPEN:
+                    self._failures = 0
+                    self._state = CLOSED
+                # Otherwise a call admitted before the breaker opened: it proves nothing now
+                return
+            self.metrics["failures"] += 1
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._open()
+
+
+class _Slot:
+    __slots__ = ('failed', 'admitted')
+
+    def __init__(self, admitted: str):
+        self.failed = False
+        self.admitted = admitted
+
+
+class Guard:
+    """Bulkhead plus circuit breaker for one downstream dependency.
+
+    ``with guard.slot(): ...`` runs the call only if the breaker allows it and
+    one of ``max_concurrent`` permits frees up within ``queue_timeout``
+    seconds; otherwise it raises ``Unavailable`` at once instead of tying up
+    the worker behind a slow dependency. An exception leaving the block is
+    recorded as a failure when ``is_outage`` says so; a call that fails
+    without raising can set ``slot.failed = True``. ``max_concurrent <= 0``
+    disables the bulkhead (the breaker still applies).
+    """
+
+    def __init__(self, name: str, max_concurrent: int = 8, queue_timeout: float = 5.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0, half_open_max: int = 1,
+                 is_failure: Callable[[BaseException], bool] = is_outage):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.is_failure = is_failure
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, half_open_max)
+        self._permits = threading.BoundedSemaphore(max_concurrent) if max_concurrent > 0 else None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.metrics = {"calls": 0, "rejected_open": 0, "rejected_busy": 0}
+
+    def _admit(self) -> str:
+        admitted = self.breaker.allow()
+        if not admitted:
+            with self._lock:
+                self.metrics["rejected_open"] += 1
+            raise Unavailable(self.name, 'open', self.breaker.retry_after() or self.breaker.reset_timeout)
+        return admitted
+
+    def _busy(self, admitted: str) -> Unavailable:
+        self.breaker.cancel(admitted)
+        with self._lock:
+            self.metrics["rejected_busy"] += 1
+        return Unavailable(self.name, 'busy', self.queue_timeout)
+
+    def _enter(self) -> None:
+        with self._lock:
+            self.metrics["calls"] += 1
+            self.in_flight += 1
+
+    def _exit(self, slot: _Slot, exc: Optional[BaseException]) -> None:
+        with self._lock:
+            self.in_flight -= 1
+        if exc is not None and not isinstance(exc, Exception):
+            # GeneratorExit/KeyboardInterrupt/CancelledError say nothing about the dependency
+            self.breaker.cancel(slot.admitted)
+            return
+        self.breaker.record(not (slot.failed or (exc is not None and self.is_failure(exc))), slot.admitted)
+
+    @contextlib.contextmanager
+    def slot(self) -> Iterator[_Slot]:
+        admitted = self._admit()
+        if self._permits is not None and not self._permits.acquire(timeout=self.queue_timeout):
+            raise self._busy(admitted)
+        self._enter()
+        slot = _Slot(admitted)
+        try:
+            yield slot
+        except BaseException as e:
+            self._exit(slot, e)
+            raise
+        else:
+            self._exit(slot, None)
+        finally:
+            if self._permits is not None:
+                self._permits.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self.metrics, in_flight=self.in_flight)
+        state = self.breaker.state
+        stats.update({f"breaker_{k}": v for k, v in self.breaker.metrics.items()})
+        stats["breaker_state"] = STATE_CODES[state]
+        stats["breaker_open"] = state == OPEN
+        return stats
+
+
+saia_guard = Guard(
+    'saia',
+    max_concurrent=Config.SAIA_MAX_CONCURRENT,
+    queue_timeout=Config.SAIA_QUEUE_TIMEOUT,
+    failure_threshold=Config.SAIA_BREAKER_THRESHOLD,
+    reset_timeout=Config.SAIA_BREAKER_RESET_SECONDS,
+)
+graph_guard = Guard(
+    'graph',
+    max_concurrent=Config.GRAPH_MAX_CONCURRENT,
+    queue_timeout=Config.GRAPH_QUEUE_TIMEOUT,
+    failure_threshold=Config.GRAPH_BREAKER_THRESHOLD,
+    reset_timeout=Config.GRAPH_BREAKER_RESET_SECONDS,
+)
@@ -0,0 +1,130 @@
+import json
+from typing import Any, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional: faster decoding when installed
+    orjson = None
+
+_FENCE = '```'
+# First characters a JSON document can start with (object, array, string, number,
+# true/false/null); anything else skips the decode attempt
+_JSON_START = frozenset('{[' '"' '-0123456789' 'tfn')
+
+
+def loads(data: Any) -> Any:
+    """``json.loads`` backed by orjson when it is installed."""
+    if orjson is not None:
+        # orjson.JSONDecodeError subclasses ValueError, like json's
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _message_text(choice: Any) -> Optional[str]:
+    if isinstance(choice, str):
+        return choice
+    if not isinstance(choice, dict):
+        return None
+    msg = choice.get('message') or choice.get('delta') or choice
+    if isinstance(msg, str):
+        return msg
+    if isinstance(msg, dict):
+        for key in ('content', 'text', 'payload'):
+            value = msg.get(key)
+            if isinstance(value, str):
+                return value
+    return None
+
+
+def first_string(data: Any, max_nodes: int = 10000, max_depth: int = 32) -> Optional[str]:
+    """First non-empty string in ``data``, depth-first in document order.
+
+    Iterative, and stops after ``max_nodes`` containers/values or below
+    ``max_depth`` levels, so a huge or deeply nested response cannot blow the
+    stack or stall a worker.
+    """
+    if isinstance(data, str):
+        return data or None
+    if not isinstance(data, (dict, list)):
+        return None
+    # One iterator per open container: descending keeps the parent's position
+    stack = [iter(data.values() if isinstance(data, dict) else data)]
+    push, pop = stack.append, stack.pop
+    budget = max_nodes
+    while stack:
+        for node in stack[-1]:
+            budget -= 1
+            if budget < 0:
+                return None
+            kind = type(node)
+            if kind is str:
+                if node:
+                    return node
+            elif kind is dict or kind is list or isinstance(node, (dict, list)):
+                if len(stack) < max_depth:
+                    push(iter(node.values() if isinstance(node, dict) else node))
+                    break
+        else:
+            pop()
+    return None
+
+
+def assistant_text(data: Any) -> Optional[str]:
+    """Assistant text of a chat completion.
+
+    Fast path for the standard ``choices[0].message.content`` shape (also
+    ``delta``, ``text`` and ``payload``); anything else falls back to
+    ``first_string``. An empty ``content`` is returned as is, so callers can
+    tell "no text" from "unknown shape".
+    """
+    if isinstance(data, str):
+        return data
+    if isinstance(data, dict):
+        choices = data.get('choices')
+        if isinstance(choices, list) and choices:
+            text = _message_text(choices[0])
+            if text is not None:
+                return text
+    return first_string(data)
+
+
+def strip_fences(text: str) -> str:
+    """Body of the first fenced code block (```json ... ```), or the whole text stripped.
+
+    A single left-to-right scan with ``str.find``: the optional language tag
+    after the opening fence is skipped up to the end of its line, and an
+    unterminated block runs to the end of the text.
+    """
+    start = text.find(_FENCE)
+    if start < 0:
+        return text.strip()
+    body = start + len(_FENCE)
+    newline = text.find('\n', body)
+    tag_end = newline if newline >= 0 else len(text)
+    tag = text[body:tag_end].strip()
+    if tag.isalnum() or not tag:
+        # '```json\n{...}' or '```\n{...}': drop the info string
+        body = tag_end
+    elif tag[:4].lower() == 'json':
+        # '```json {...}' on a single line
+        body += 4
+    end = text.find(_FENCE, body)
+    return text[body:end if end >= 0 else len(text)].strip()
+
+
+def parse_json_text(text: str) -> Tuple[bool, Any]:
+    """``(True, value)`` if the (unfenced) text is JSON, else ``(False, unfenced text)``."""
+    whole = text.strip()
+    if _FENCE in whole and whole[:1] in _JSON_START:
+        # Bare JSON whose strings happen to contain ``` is not a fenced block
+        try:
+            return True, loads(whole)
+        except ValueError:
+            pass
+    candidate = strip_fences(text)
+    if not candidate or candidate[0] not in _JSON_START:
+        return False, candidate
+    try:
+        return True, loads(candidate)
+    except ValueError:
+        return False, candidate
@@ -1,3 +1,8 @@
+import glob
+import json
+import os
+from typing import Any, Dict, List, Optional
+
 def get_text_user(message: dict) -> str:
     message_type = message.get('type')
     
@@ -184,3 +189,112 @@ def list_message(phone: str):
             }
         }
     }
+
+
+# ---------------------------------------------------------------------------
+# Plantillas pre-serializadas: la parte estática del JSON se codifica una sola
+# vez a bytes y al enviar solo se insertan 'to' y los textos variables.
+
+class Slot:
+    """Hueco de una plantilla; se reemplaza por un valor JSON al renderizar."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self):
+        return f'Slot({self.name!r})'
+
+
+class RenderedMessage(bytes):
+    """Payload ya serializado; conserva 'to' para el orden por destinatario de la cola de envío."""
+
+    to: Optional[str] = None
+
+
+_SLOT_MARK = '\x00slot:'
+
+def _slot_marker(obj):
+    if isinstance(obj, Slot):
+        return f'{_SLOT_MARK}{obj.name}\x00'
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+_encode_string = json.encoder.encode_basestring
+
+def _encode(value: Any) -> str:
+    return _encode_string(value) if type(value) is str else _json_encoder.encode(value)
+
+
+class PayloadTemplate:
+    """Payload cuyo JSON se pre-serializa a segmentos fijos alrededor de sus Slot.
+
+    render() solo codifica los valores de los huecos y une los segmentos, sin
+    reconstruir ni volver a serializar el diccionario completo.
+    """
+
+    def __init__(self, payload: Dict[str, Any]):
+        encoded = json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=_slot_marker)
+        marker = json.dumps(_SLOT_MARK)[1:-1]
+        parts = encoded.split(f'"{marker}')
+        self._segments: List[str] = [parts[0]]
+        self.slots: List[str] = []
+        for part in parts[1:]:
+            name, rest = part.split('\\u0000"', 1)
+            self.slots.append(name)
+            self._segments.append(rest)
+        self._pairs = list(zip(self.slots, self._segments[1:]))
+
+    def render(self, to: str, **values: Any) -> RenderedMessage:
+        values['to'] = to
+        out = [self._segments[0]]
+        for name, segment in self._pairs:
+            out.append(_encode(values[name]))
+            out.append(segment)
+        message = RenderedMessage(''.join(out).encode('utf-8'))
+        message.to = to
+        return message
+
+
+def _slots_from_placeholders(node: Any) -> Any:
+    """Convierte los strings "{{nombre}}" de una plantilla JSON en Slot('nombre')."""
+    if isinstance(node, dict):
+        return {k: _slots_from_placeholders(v) for k, v in node.items()}
+    if isinstance(node, list):
+        return [_slots_from_placeholders(v) for v in node]
+    if isinstance(node, str) and node.startswith('{{') and node.endswith('}}'):
+        return Slot(node[2:-2].strip())
+    return node
+
+def load_templates(directory: str = 'example') -> Dict[str, PayloadTemplate]:
+    """
+    Carga como plantilla cada JSON de ``directory`` que sea un mensaje saliente
+    (tiene 'messaging_product' y 'type'); los webhooks de ejemplo se ignoran.
+    El nombre es el del archivo sin extensión.
+    """
+    loaded = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        try:
+            with open(path, encoding='utf-8') as fh:
+                payload = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        if isinstance(payload, dict) and 'messaging_product' in payload and 'type' in payload:
+            name = os.path.splitext(os.path.basename(path))[0]
+            loaded[name] = PayloadTemplate(_slots_from_placeholders(payload))
+    return loaded
+
+
+TEMPLATES: Dict[str, PayloadTemplate] = {
+    'text': PayloadTemplate(text_message(Slot('body'), Slot('to'))),
+    'location': PayloadTemplate(location_message(Slot('to'))),
+    'buttons': PayloadTemplate(buttons_message(Slot('to'))),
+    'list': PayloadTemplate(list_message(Slot('to'))),
+}
+TEMPLATES.update(load_templates(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example')))
+
+def render(name: str, phone: str, **values: Any) -> RenderedMessage:
+    return TEMPLATES[name].render(phone, **values)
+
+def text_payload(message: str, phone: str) -> RenderedMessage:
+    """Equivalente a text_message(...) ya serializado."""
+    return TEMPLATES['text'].render(phone, body=message)
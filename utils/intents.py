@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger("app.utils.intents")
+
+# Same intents and precedence as the original if/elif chain in wsp_build_replies
+DEFAULT_RULES: List[Dict[str, Any]] = [
+    {'intent': 'greeting', 'keywords': ['hi', 'hello', 'hola', 'buenas']},
+    {'intent': 'thanks', 'keywords': ['thanks', 'thank', 'thank you', 'gracias']},
+    {'intent': 'media', 'keywords': ['image', 'document']},
+    {'intent': 'agency', 'keywords': ['agency']},
+    {'intent': 'contact', 'keywords': ['contact']},
+    {'intent': 'buy', 'keywords': ['buy']},
+    {'intent': 'sell', 'keywords': ['sell']},
+    {'intent': 'register', 'keywords': ['register']},
+    {'intent': 'login', 'keywords': ['login', 'log in']},
+]
+
+_SPACES = re.compile(r'\s+')
+
+
+def fold(text: str) -> str:
+    """Lowercase and strip accents: 'Olá Buenás' -> 'ola buenas'."""
+    if text.isascii():
+        return text.lower()
+    # Combining marks (and anything else outside ASCII, e.g. emoji) are dropped in C
+    return unicodedata.normalize('NFKD', text.casefold()).encode('ascii', 'ignore').decode('ascii')
+
+
+def _trie_regex(words: Iterable[str]) -> str:
+    """Alternation factored by common prefix ('hi|hello|hola' -> 'h(?:ello|i|ola)').
+
+    ``re`` tries alternatives one by one, so sharing prefixes keeps the work
+    per text position proportional to the keyword length, not the keyword count.
+    """
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        terminal = '' in node
+        branches = [
+            (r'\s+' if char == ' ' else re.escape(char)) + build(child)
+            for char, child in sorted(node.items()) if char
+        ]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if terminal:
+            # Greedy optional: the longer keyword wins at the same position
+            body = (body if len(branches) == 1 and len(body) == 1 else '(?:' + body + ')') + '?'
+        return body
+
+    return build(trie)
+
+
+class IntentRouter:
+    """Match a message against every keyword of every rule in one regex pass.
+
+    All keywords are folded (see ``fold``) and compiled into a single
+    prefix-factored alternation anchored on word boundaries, so 'hi' no
+    longer fires inside 'archivo'. When several intents match, the one whose
+    rule comes first wins, exactly like the if/elif chain it replaces; rules
+    may also carry an explicit ``priority`` (lower wins).
+    """
+
+    def __init__(self, rules: Iterable[Dict[str, Any]]):
+        self.rules = [dict(r) for r in rules]
+        self._lookup: Dict[str, tuple] = {}
+        for index, rule in enumerate(self.rules):
+            priority = rule.get('priority', index)
+            for keyword in rule.get('keywords') or []:
+                key = _SPACES.sub(' ', fold(str(keyword))).strip()
+                if key and (key not in self._lookup or priority < self._lookup[key][0]):
+                    self._lookup[key] = (priority, rule['intent'])
+        self._pattern = re.compile(
+            r'(?<!\w)(?:' + _trie_regex(self._lookup) + r')(?!\w)'
+        ) if self._lookup else None
+        self._best = min((p for p, _ in self._lookup.values()), default=0)
+
+    def route(self, text: Optional[str]) -> Optional[str]:
+        if not text or self._pattern is None:
+            return None
+        best = None
+        for match in self._pattern.finditer(fold(text)):
+            keyword = match.group()
+            hit = self._lookup.get(keyword) or self._lookup[_SPACES.sub(' ', keyword)]
+            if best is None or hit[0] < best[0]:
+                best = hit
+                if hit[0] == self._best:
+                    break
+        return best[1] if best else None
+
+
+def load_rules_file(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding='utf-8') as fh:
+        data = json.load(fh)
+    return data.get('rules', []) if isinstance(data, dict) else data
+
+
+class ReloadingIntentRouter:
+    """``IntentRouter`` whose rules come from a loader and are re-read every ``interval`` seconds.
+
+    ``loader`` returns ``(fingerprint, rules)``; the router is recompiled only
+    when the fingerprint changes. Reloads happen on the calling thread, at most
+    one at a time, and a failing loader keeps the last good rules.
+    """
+
+    def __init__(self, loader: Callable[[], tuple], interval: float = 30.0,
+                 fallback: Optional[List[Dict[str, Any]]] = None):
+        self.loader = loader
+        self.interval = interval
+        self._router = IntentRouter(fallback if fallback is not None else DEFAULT_RULES)
+        self._fingerprint: Any = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.metrics = {"reloads": 0, "reload_errors": 0}
+        self.reload()
+
+    def reload(self) -> bool:
+        """Re-read the rules now; returns True if they changed."""
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                fingerprint, rules = self.loader()
+            except Exception as e:
+                logger.warning("could not load intent rules: %s", e)
+                self.metrics["reload_errors"] += 1
+                return False
+            if fingerprint == self._fingerprint or not rules:
+                return False
+            self._router = IntentRouter(rules)
+            self._fingerprint = fingerprint
+            self.metrics["reloads"] += 1
+            return True
+
+    def route(self, text: Optional[str]) -> Optional[str]:
+        if time.monotonic() - self._checked >= self.interval and not self._lock.locked():
+            self.reload()
+        return self._router.route(text)
+
+
+def file_rules_loader(path: str) -> Callable[[], tuple]:
+    """Loader for a JSON file (``[{"intent", "keywords"}]`` or ``{"rules": [...]}``); keyed on mtime."""
+    def load():
+        mtime = os.stat(path).st_mtime_ns
+        return mtime, load_rules_file(path)
+    return load
+
+
+def mongo_rules_loader(collection_getter: Callable[[], Any]) -> Callable[[], tuple]:
+    """Loader for an ``intents`` collection (one document per rule, ordered by ``priority``)."""
+    def load():
+        collection = collection_getter()
+        if collection is None:
+            raise RuntimeError('intents collection unavailable')
+        rules = [
+            {'intent': doc['intent'], 'keywords': doc.get('keywords') or [], 'priority': doc.get('priority', i)}
+            for i, doc in enumerate(collection.find({'enabled': {'$ne': False}}).sort('priority', 1))
+        ]
+        fingerprint = tuple((r['intent'], tuple(r['keywords']), r['priority']) for r in rules)
+        return fingerprint, rules
+    return load
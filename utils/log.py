@@ -0,0 +1,212 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional
+
+_correlation_id: contextvars.ContextVar = contextvars.ContextVar('correlation_id', default=None)
+
+# Attributes every LogRecord has; anything else came in through ``extra=`` and is emitted as a field
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def new_correlation_id() -> str:
+    return uuid.uuid4().hex[:8]
+
+
+def get_correlation_id() -> Optional[str]:
+    return _correlation_id.get()
+
+
+@contextlib.contextmanager
+def correlation(correlation_id: Optional[str] = None) -> Iterator[str]:
+    """Bind ``correlation_id`` (a fresh one if None) to every record logged inside the block.
+
+    The id lives in a ``contextvars`` variable, so it follows asyncio tasks;
+    thread pools that should inherit it must run the work under
+    ``contextvars.copy_context()`` (the dispatchers and job pipeline do).
+    """
+    correlation_id = correlation_id or new_correlation_id()
+    token = _correlation_id.set(correlation_id)
+    try:
+        yield correlation_id
+    finally:
+        _correlation_id.reset(token)
+
+
+class CorrelationFilter(logging.Filter):
+    """Stamp records with the caller's correlation id before they cross the queue."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'correlation_id'):
+            record.correlation_id = _correlation_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of high-volume records below WARNING.
+
+    ``rates`` maps an ``event`` name (passed as ``extra={'event': ...}``) or a
+    logger name prefix to the fraction kept, e.g. ``{'message_received': 0.1}``.
+    Warnings and errors are never sampled out.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = dict(rates)
+        self._prefixes = sorted(self.rates, key=len, reverse=True)
+
+    def _rate(self, record: logging.LogRecord) -> Optional[float]:
+        event = getattr(record, 'event', None)
+        if event in self.rates:
+            return self.rates[event]
+        for prefix in self._prefixes:
+            if record.name == prefix or record.name.startswith(prefix + '.'):
+                return self.rates[prefix]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self._rate(record)
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, correlation_id, thread and any ``extra`` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'correlation_id', None):
+            entry['correlation_id'] = record.correlation_id
+        entry['thread'] = record.threadName
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and key != 'correlation_id':
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller: when the queue is full the record is dropped and counted."""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only merge args and render the traceback here; JSON encoding happens on the listener thread
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _State:
+    handler: Optional[_DroppingQueueHandler] = None
+    listener: Optional[logging.handlers.QueueListener] = None
+    output: Optional[logging.Handler] = None
+    lock = threading.Lock()
+
+
+def parse_levels(spec: Optional[str]) -> Dict[str, str]:
+    """'app.services.graph=DEBUG,urllib3=WARNING' -> {'app.services.graph': 'DEBUG', 'urllib3': 'WARNING'}."""
+    levels = {}
+    for item in (spec or '').split(','):
+        name, sep, level = item.partition('=')
+        if sep and name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def parse_rates(spec: Optional[str]) -> Dict[str, float]:
+    """'message_received=0.1,app.services.whatsapp=0.5' -> {'message_received': 0.1, ...}."""
+    rates = {}
+    for item in (spec or '').split(','):
+        name, sep, rate = item.partition('=')
+        if sep and name.strip():
+            try:
+                rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+            except ValueError:
+                continue
+    return rates
+
+
+def _start_listener() -> None:
+    _State.listener = logging.handlers.QueueListener(_State.handler.queue, _State.output, respect_handler_level=True)
+    _State.listener.start()
+
+
+def configure_logging(level: str = 'INFO', levels: Optional[Dict[str, str]] = None,
+                      sample: Optional[Dict[str, float]] = None, fmt: str = 'json',
+                      queue_size: int = 10000, stream=None) -> None:
+    """Route every log record through a bounded queue to a background writer thread.
+
+    The root logger gets a single non-blocking ``QueueHandler`` (request
+    threads only enqueue) and a ``QueueListener`` writes JSON lines (or plain
+    text with ``fmt='text'``) to ``stream`` (stdout by default). ``levels``
+    sets per-logger levels and ``sample`` thins out high-volume records (see
+    ``SamplingFilter``). Calling it again reconfigures in place. A forked
+    child (gunicorn ``--preload``) restarts its own listener thread.
+    """
+    with _State.lock:
+        root = logging.getLogger()
+        if _State.handler is None:
+            _State.handler = _DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+            _State.handler.addFilter(CorrelationFilter())
+            root.addHandler(_State.handler)
+            _State.output = logging.StreamHandler(stream or sys.stdout)
+            _start_listener()
+            atexit.register(shutdown_logging)
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_child=_start_listener)
+        for existing in list(_State.handler.filters):
+            if isinstance(existing, SamplingFilter):
+                _State.handler.removeFilter(existing)
+        if sample:
+            _State.handler.addFilter(SamplingFilter(sample))
+        _State.output.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(
+            '%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s'))
+        root.setLevel(level.upper())
+        for name, logger_level in (levels or {}).items():
+            logging.getLogger(name).setLevel(logger_level)
+
+
+def shutdown_logging() -> None:
+    """Flush whatever is still queued; the listener thread stops after the last record."""
+    listener = _State.listener
+    if listener is not None and listener._thread is not None:
+        listener.stop()
+
+
+def logging_stats() -> Dict[str, int]:
+    handler = _State.handler
+    if handler is None:
+        return {'queued': 0, 'dropped': 0}
+    return {'queued': handler.queue.qsize(), 'dropped': handler.dropped}
@@ -0,0 +1,112 @@
+import base64
+import binascii
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+from utils.cache import TTLCache
+
+logger = logging.getLogger("app.services.media_store")
+
+
+def whatsapp_sha256_hex(value: Optional[str]) -> Optional[str]:
+    """WhatsApp sends the media SHA-256 base64-encoded; return it as hex."""
+    if not value:
+        return None
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return raw.hex() if len(raw) == 32 else None
+
+
+class MemoryBackend:
+    """Process-local backend; entries live as long as the process."""
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._data.get(key)
+            return dict(entry) if entry is not None else None
+
+    def update(self, key: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            self._data.setdefault(key, {'_id': key}).update(fields)
+
+
+class MongoBackend:
+    """Shared backend: one document per SHA-256 in ``collection``."""
+
+    def __init__(self, collection_getter: Callable[[], Any]):
+        self.collection_getter = collection_getter
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        collection = self.collection_getter()
+        if collection is None:
+            return None
+        return collection.find_one({'_id': key})
+
+    def update(self, key: str, fields: Dict[str, Any]) -> None:
+        collection = self.collection_getter()
+        if collection is None:
+            return
+        collection.update_one(
+            {'_id': key},
+            {'$set': dict(fields, updated_at=datetime.now(timezone.utc))},
+            upsert=True
+        )
+
+
+class ContentStore:
+    """Content-addressed record of what was already done with some bytes.
+
+    Entries are keyed by the file's SHA-256 alone and accumulate the SAIA
+    upload reference (``saia_upload``), the parsed ``ia_text`` and the
+    OneDrive ``download_url``, so identical files skip every downstream call.
+    A TTL'd LRU sits in front of the pluggable backend.
+    """
+
+    def __init__(self, backend: Any = None, max_size: int = 1024, ttl: Optional[float] = 3600):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._lru = TTLCache(max_size=max_size, ttl=ttl)
+        self.metrics = {"hits": 0, "store_hits": 0, "misses": 0, "store_errors": 0}
+
+    def get(self, sha256: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not sha256:
+            return None
+        entry = self._lru.get(sha256)
+        if entry is not None:
+            self.metrics["hits"] += 1
+            return dict(entry)
+        try:
+            entry = self.backend.get(sha256)
+        except Exception as e:
+            logger.warning("media store unavailable: %s", e)
+            self.metrics["store_errors"] += 1
+            entry = None
+        if entry:
+            self.metrics["store_hits"] += 1
+            self._lru.set(sha256, dict(entry))
+            return dict(entry)
+        self.metrics["misses"] += 1
+        return None
+
+    def update(self, sha256: Optional[str], fields: Dict[str, Any]) -> None:
+        if not sha256 or not fields:
+            return
+        cached = self._lru.get(sha256)
+        if cached is not None:
+            cached = dict(cached)
+            cached.update(fields)
+            self._lru.set(sha256, cached)
+        # On a miss only the backend has the full entry: caching ``fields`` alone would
+        # hide the rest of it, so the next get() reads it back from the backend
+        try:
+            self.backend.update(sha256, fields)
+        except Exception as e:
+            logger.warning("media store unavailable: %s", e)
+            self.metrics["store_errors"] += 1
@@ -0,0 +1,190 @@
+import bisect
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import Config
+
+# Seconds; covers a cached lookup (~1 ms) up to a slow SAIA chat or OneDrive upload
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram plus a window of recent samples for quantiles."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, window: int = 1024):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._recent: deque = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, error: bool = False) -> None:
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self._recent.append(seconds)
+            self.count += 1
+            self.sum += seconds
+            if error:
+                self.errors += 1
+
+    def quantiles(self, qs: Iterable[float] = QUANTILES) -> Dict[float, Optional[float]]:
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return {q: None for q in qs}
+        return {q: recent[min(len(recent) - 1, int(len(recent) * q))] for q in qs}
+
+    def snapshot(self) -> Tuple[List[int], int, float, int]:
+        with self._lock:
+            return list(self._counts), self.count, self.sum, self.errors
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'started')
+
+    def __init__(self, tracer: "Tracer", name: str):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.observe(self.name, time.perf_counter() - self.started, error=exc_type is not None)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Tracer:
+    """Per-stage latency spans: ``with tracer.span('saia_chat'): ...``.
+
+    Each stage name gets a ``Histogram``; spans that raise are counted as
+    errors. When disabled, ``span()`` hands back a shared no-op context
+    manager, so instrumented code costs one attribute check. Counters kept by
+    other components (``metrics`` dicts) are exported by registering a
+    collector. Values are per process: with several gunicorn workers each
+    one serves its own numbers.
+    """
+
+    def __init__(self, enabled: bool = True, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._histograms: Dict[str, Histogram] = {}
+        self._collectors: List[Tuple[str, Callable[[], Dict[str, Any]], str, Optional[str]]] = []
+        self._lock = threading.Lock()
+
+    def span(self, name: str):
+        if not self.enabled:
+            return _NOOP
+        return _Span(self, name)
+
+    def observe(self, name: str, seconds: float, error: bool = False) -> None:
+        if not self.enabled:
+            return
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram(self.buckets))
+        histogram.observe(seconds, error=error)
+
+    def histograms(self) -> Dict[str, Histogram]:
+        with self._lock:
+            return dict(self._histograms)
+
+    def reset(self) -> None:
+        """Drop every histogram (collectors stay registered), e.g. between benchmark scenarios."""
+        with self._lock:
+            self._histograms = {}
+
+    def register(self, prefix: str, collector: Callable[[], Dict[str, Any]], help_text: str = '',
+                 label: Optional[str] = None) -> None:
+        """Export ``collector()``'s numeric values as ``wsp_<prefix>_<key>`` gauges.
+
+        With ``label`` the collector returns ``{label_value: {key: value}}``
+        (e.g. per host) and each key becomes one gauge with a series per
+        label value: ``wsp_<prefix>_<key>{<label>="<label_value>"}``.
+        """
+        with self._lock:
+            self._collectors.append((prefix, collector, help_text, label))
+
+    def render_prometheus(self) -> str:
+        lines = [
+            '# HELP wsp_stage_seconds Latency of each webhook/media pipeline stage.',
+            '# TYPE wsp_stage_seconds histogram',
+        ]
+        summary = [
+            '# HELP wsp_stage_recent_seconds Quantiles over the most recent samples of each stage.',
+            '# TYPE wsp_stage_recent_seconds summary',
+        ]
+        errors = [
+            '# HELP wsp_stage_errors_total Spans of each stage that ended with an exception.',
+            '# TYPE wsp_stage_errors_total counter',
+        ]
+        for name, histogram in sorted(self.histograms().items()):
+            counts, count, total, failed = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'wsp_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'wsp_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {count}')
+            lines.append(f'wsp_stage_seconds_sum{{stage="{name}"}} {total}')
+            lines.append(f'wsp_stage_seconds_count{{stage="{name}"}} {count}')
+            for q, value in histogram.quantiles().items():
+                if value is not None:
+                    summary.append(f'wsp_stage_recent_seconds{{stage="{name}",quantile="{q}"}} {value}')
+            errors.append(f'wsp_stage_errors_total{{stage="{name}"}} {failed}')
+        lines.extend(summary)
+        lines.extend(errors)
+
+        with self._lock:
+            collectors = list(self._collectors)
+        for prefix, collector, help_text, label in collectors:
+            try:
+                values = collector() or {}
+            except Exception:
+                continue
+            # key -> [(series labels, value)]
+            series: Dict[str, List[Tuple[str, Any]]] = {}
+            if label is None:
+                for key, value in values.items():
+                    series.setdefault(key, []).append(('', value))
+            else:
+                for label_value, group in sorted(values.items()):
+                    escaped = str(label_value).replace('\\', '\\\\').replace('"', '\\"')
+                    for key, value in (group or {}).items():
+                        series.setdefault(key, []).append((f'{{{label}="{escaped}"}}', value))
+            for key, points in sorted(series.items()):
+                points = [(labels, int(value) if isinstance(value, bool) else value) for labels, value in points]
+                points = [(labels, value) for labels, value in points if isinstance(value, (int, float))]
+                if not points:
+                    continue
+                metric = f'wsp_{prefix}_{key}'
+                if help_text:
+                    lines.append(f'# HELP {metric} {help_text}')
+                lines.append(f'# TYPE {metric} gauge')
+                lines.extend(f'{metric}{labels} {value}' for labels, value in points)
+        return '\n'.join(lines) + '\n'
+
+
+tracer = Tracer(enabled=Config.METRICS_ENABLED)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
@@ -0,0 +1,35 @@
+import re
+from typing import Optional
+
+_NON_DIGITS = re.compile(r'\D+')
+
+# E.164: up to 15 digits including the country code
+_MIN_DIGITS = 8
+_MAX_DIGITS = 15
+
+
+def normalize_e164(raw: Optional[str], default_country_code: str = '56', national_length: int = 9) -> Optional[str]:
+    """Return ``raw`` as a canonical ``+<digits>`` E.164 key, or None if it can't be one.
+
+    WhatsApp sends ``from`` as bare international digits (``56912345678``)
+    while the directory holds whatever was typed (``+56 9 1234 5678``,
+    ``9-1234-5678``, ``0056912345678``). Numbers with an explicit ``+`` or
+    ``00`` prefix, or longer than ``national_length`` digits, are taken as
+    international; shorter ones get ``default_country_code`` prepended.
+    """
+    if raw is None:
+        return None
+    text = str(raw).strip()
+    if not text:
+        return None
+    international = text.startswith('+')
+    digits = _NON_DIGITS.sub('', text)
+    if not international and digits.startswith('00'):
+        digits = digits[2:]
+        international = True
+    digits = digits.lstrip('0') if international else digits
+    if not international and len(digits) <= national_length:
+        digits = default_country_code + digits.lstrip('0')
+    if not _MIN_DIGITS <= len(digits) <= _MAX_DIGITS:
+        return None
+    return f'+{digits}'
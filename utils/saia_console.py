@@ -1,22 +1,31 @@
+import contextlib
 import hashlib
 import logging
 import mimetypes
 import os
 import unicodedata
-from typing import Any, Dict, Optional
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
 
 import requests
 
-from utils.ai_processor import AIProcessor
+from utils.ai_processor import AIProcessor, DeltaCallback
+from utils.bulkhead import Guard, Unavailable, saia_guard
+from utils.media_store import ContentStore
+from utils.schemas import SchemaRegistry
+from utils.streams import MultipartStream
+from utils.transport import transport
 
 logger = logging.getLogger("app.services.ai.saia_console_client")
 
 
 class SAIAConsoleClient:
-    """Synchronous client for SAIA: upload bytes and chat with a file.
+    """Client for SAIA: upload bytes and chat with a file.
 
-    Exposes upload_bytes(...) and chat_with_file(...). Uses requests and a
-    small in-process cache to avoid re-uploading identical bytes.
+    Exposes upload_bytes(...), upload_file(...) and chat_with_file(...). Uses
+    the shared transport and a content-addressed media
+    store (keyed by SHA-256 alone) to avoid re-uploading identical bytes.
+    Uploads and chats share one bulkhead/breaker ``guard`` (the process-wide
+    SAIA guard by default); a refused call returns {"error": "unavailable"}.
     """
 
     def __init__(
@@ -27,6 +36,10 @@ class SAIAConsoleClient:
         assistant_id: str,
         base_url: str = "https://api.saia.ai",
         timeout: int = 60,
+        media_store: Optional[ContentStore] = None,
+        stream: bool = False,
+        max_sse_line: int = 1024 * 1024,
+        guard: Optional[Guard] = saia_guard,
     ):
         self.api_token = api_token
         self.organization_id = organization_id
@@ -34,6 +47,8 @@ class SAIAConsoleClient:
         self.assistant_id = assistant_id
         self.base_url = base_url.rstrip("/")
         self.timeout = timeout
+        self.stream = stream
+        self.guard = guard
         self.default_headers = {
             "Authorization": f"Bearer {self.api_token}",
             "organizationId": self.organization_id,
@@ -45,9 +60,19 @@ class SAIAConsoleClient:
             project_id,
             base_url=f"{self.base_url}/chat",
             request_timeout=timeout,
+            max_sse_line=max_sse_line,
+            guard=guard,
         )
-        self._upload_cache: Dict[str, Dict] = {}
-        self.metrics = {"upload_cache_hits": 0, "upload_cache_misses": 0}
+        self.media_store = media_store if media_store is not None else ContentStore()
+        self._metrics = {"upload_cache_hits": 0, "upload_cache_misses": 0, "extraction_cache_hits": 0,
+                         "validation_retries": 0, "validation_failures": 0}
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        merged = dict(self._metrics)
+        for k, v in self.media_store.metrics.items():
+            merged[f"media_store_{k}"] = v
+        return merged
 
     @staticmethod
     def _sanitize_header_value(v: Optional[str]) -> Optional[str]:
@@ -70,92 +95,178 @@ class SAIAConsoleClient:
     def _sha256(data: bytes) -> str:
         return hashlib.sha256(data).hexdigest()
 
-    def upload_bytes(self, data: bytes, file_name: str, folder: Optional[str] = None, alias: Optional[str] = None) -> Dict[str, Any]:
-        url = f"{self.base_url}/v1/files"
-        file_size = len(data)
-        file_hash = self._sha256(data)
-        content_type = self._guess_content_type(file_name or "file")
-
+    def _prepare_upload(self, file_name: str, folder: Optional[str], alias: Optional[str], file_hash: str, file_size: int) -> Dict[str, Any]:
         headers = dict(self.default_headers)
         headers["Accept"] = "application/json"
         alias_used = alias or os.path.splitext(os.path.basename(file_name))[0]
         headers["fileName"] = self._sanitize_header_value(alias_used)
         headers["folder"] = self._sanitize_header_value(folder or "test1")
 
-        cache_key = f"{alias_used}:{file_hash}"
-        cached = self._upload_cache.get(cache_key)
+        return {
+            "url": f"{self.base_url}/v1/files",
+            "headers": headers,
+            "content_type": self._guess_content_type(file_name or "file"),
+            "cache_key": file_hash,
+            "meta": {
+                "file_name_used": file_name,
+                "file_alias_used": alias_used,
+                "file_size": file_size,
+                "file_sha256": file_hash,
+            },
+        }
+
+    def _cached_upload(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        # Same bytes already uploaded (by any worker): reuse the SAIA file, whatever alias it got
+        cached = (self.media_store.get(cache_key) or {}).get("saia_upload")
         if cached:
-            try:
-                self.metrics["upload_cache_hits"] += 1
-            except Exception:
-                pass
+            self._metrics["upload_cache_hits"] += 1
             return dict(cached)
+        self._metrics["upload_cache_misses"] += 1
+        return None
+
+    def _upload_result(self, r: Any, prepared: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            j = r.json()
+        except Exception:
+            j = {"text": r.text}
+
+        result = {"status_code": r.status_code, "headers": dict(r.headers)}
+        result.update(prepared["meta"])
+        if isinstance(j, dict):
+            result.update(j)
         else:
-            try:
-                self.metrics["upload_cache_misses"] += 1
-            except Exception:
-                pass
+            result["json"] = j
+
+        # Cache successful uploads (without the bulky response headers)
+        if r.status_code < 400:
+            cached = {k: v for k, v in result.items() if k != "headers"}
+            self.media_store.update(prepared["cache_key"], {"saia_upload": cached})
+        return result
+
+    def _slot(self):
+        return self.guard.slot() if self.guard is not None else contextlib.nullcontext()
 
-        files = {"file": (file_name, data, content_type)}
+    def upload_bytes(self, data: bytes, file_name: str, folder: Optional[str] = None, alias: Optional[str] = None) -> Dict[str, Any]:
+        prepared = self._prepare_upload(file_name, folder, alias, self._sha256(data), len(data))
+        cached = self._cached_upload(prepared["cache_key"])
+        if cached:
+            return cached
+        files = {"file": (file_name, data, prepared["content_type"])}
         try:
-            r = requests.post(url, headers=headers, files=files, timeout=self.timeout)
-            r.raise_for_status()
-            try:
-                j = r.json()
-            except Exception:
-                j = {"text": r.text}
-
-            result = {
-                "status_code": r.status_code,
-                "headers": dict(r.headers),
-                "file_name_used": file_name,
-                "file_alias_used": alias_used,
-                "file_size": file_size,
-                "file_sha256": file_hash,
-            }
-            if isinstance(j, dict):
-                result.update(j)
-            else:
-                result["json"] = j
-
-            # Cache successful uploads
-            if r.status_code < 400:
-                try:
-                    self._upload_cache[cache_key] = dict(result)
-                    if len(self._upload_cache) > 256:
-                        self._upload_cache.pop(next(iter(self._upload_cache)))
-                except Exception:
-                    pass
-            return result
+            with self._slot():
+                r = transport.post(prepared["url"], headers=prepared["headers"], files=files, timeout=self.timeout)
+                r.raise_for_status()
+            return self._upload_result(r, prepared)
+        except Unavailable as e:
+            logger.warning("SAIA upload skipped: %s", e)
+            return e.as_error()
         except requests.RequestException as e:
             logger.exception("Error uploading bytes: %s", e)
             return {"error": "request_error", "detail": str(e)}
 
-    def chat_with_file(self, prompt: str, file_id: str, assistant_id: Optional[str] = None, file_name_used: Optional[str] = None) -> Dict[str, Any]:
+    def upload_file(self, fileobj: BinaryIO, file_name: str, size: int, sha256: str, folder: Optional[str] = None, alias: Optional[str] = None) -> Dict[str, Any]:
+        """Like upload_bytes, but streams the multipart body from ``fileobj``.
+
+        ``size`` and ``sha256`` must describe the content (see utils.streams.MediaBuffer),
+        so a cache hit costs no read at all.
+        """
+        prepared = self._prepare_upload(file_name, folder, alias, sha256, size)
+        cached = self._cached_upload(prepared["cache_key"])
+        if cached:
+            return cached
+        body = MultipartStream("file", file_name, fileobj, size, prepared["content_type"])
+        headers = dict(prepared["headers"])
+        headers["Content-Type"] = body.content_type
+        try:
+            with self._slot():
+                r = transport.post(prepared["url"], headers=headers, data=body, timeout=self.timeout)
+                r.raise_for_status()
+            return self._upload_result(r, prepared)
+        except Unavailable as e:
+            logger.warning("SAIA upload skipped: %s", e)
+            return e.as_error()
+        except requests.RequestException as e:
+            logger.exception("Error uploading file: %s", e)
+            return {"error": "request_error", "detail": str(e)}
+
+    def _annotate_chat(self, resp: Any, aid: str, prompt: str, extra_headers: Optional[Dict[str, str]], stream: bool = False) -> Any:
+        # Add some sent headers/payload info for debugging
+        try:
+            sent_payload = self.processor._prepare_payload(aid, prompt, stream=stream)
+            sent_headers = dict(self.processor.headers)
+            if extra_headers:
+                sent_headers.update(extra_headers)
+            if "Authorization" in sent_headers:
+                sent_headers["Authorization"] = "Bearer *****"
+            if isinstance(resp, dict):
+                resp.setdefault("sent_payload", sent_payload)
+                resp.setdefault("sent_headers", sent_headers)
+        except Exception:
+            pass
+        return resp
+
+    def cached_extraction(self, sha256: Optional[str], schemas: SchemaRegistry) -> Optional[Dict[str, Any]]:
+        """Validated result already stored for these bytes under a current schema version, if any."""
+        hit = schemas.cached(self.media_store.get(sha256)) if sha256 else None
+        if hit is None:
+            return None
+        self._metrics["extraction_cache_hits"] += 1
+        schema, data = hit
+        return {"data": data, "schema": schema.key, "valid": True, "cached": True}
+
+    def _structured(self, resp: Any, schemas: SchemaRegistry, sha256: Optional[str]) -> Tuple[Dict[str, Any], List[str]]:
+        """Validate a parsed answer; valid results are cached under (sha256, schema version)."""
+        schema, data, errors = schemas.validate(resp)
+        outcome: Dict[str, Any] = {"data": data, "schema": schema.key, "valid": not errors}
+        if errors:
+            outcome["errors"] = errors
+            outcome["raw"] = resp
+        else:
+            self.media_store.update(sha256, {schema.cache_key: data})
+        return outcome, errors
+
+    @staticmethod
+    def _correction(prompt: str, errors: List[str]) -> str:
+        return (f"{prompt}\n\nTu respuesta anterior no cumplió el formato pedido: {'; '.join(errors[:10])}. "
+                "Responde de nuevo solo con el objeto JSON corregido.")
+
+    @staticmethod
+    def _answered(resp: Any) -> bool:
+        return not (isinstance(resp, dict) and "error" in resp)
+
+    def chat_with_file(self, prompt: str, file_id: str, assistant_id: Optional[str] = None, file_name_used: Optional[str] = None,
+                       on_delta: Optional[DeltaCallback] = None, schemas: Optional[SchemaRegistry] = None,
+                       sha256: Optional[str] = None) -> Dict[str, Any]:
+        """Chat about an uploaded file. With ``stream`` enabled, ``on_delta(delta, text)`` sees the reply as it is generated.
+
+        With ``schemas`` the prompt asks for one JSON object of a registered
+        document type and the answer is validated: the result is
+        ``{"data", "schema", "valid"}``. An invalid answer is retried once
+        with the validation errors; valid ones are cached per ``sha256`` and
+        schema version, and a cached one is returned without calling SAIA.
+        """
         aid = assistant_id or self.assistant_id
         extra_headers = {"fileName": file_name_used} if file_name_used else None
+        if schemas is not None:
+            cached = self.cached_extraction(sha256, schemas)
+            if cached is not None:
+                return cached
+            prompt = f"{prompt}\n\n{schemas.instructions()}"
         try:
             # Use AIProcessor synchronous process
-            resp = self.processor.process(aid, prompt, extra_headers=extra_headers, stream=False)
-            # Add some sent headers/payload info for debugging
-            try:
-                sent_payload = self.processor._prepare_payload(aid, prompt, stream=False)
-                sent_headers = dict(self.processor.headers)
-                if extra_headers:
-                    sent_headers.update(extra_headers)
-                if "Authorization" in sent_headers:
-                    sent_headers["Authorization"] = "Bearer *****"
-                if isinstance(resp, dict):
-                    resp.setdefault("sent_payload", sent_payload)
-                    resp.setdefault("sent_headers", sent_headers)
-            except Exception:
-                pass
-            return resp
+            resp = self.processor.process(aid, prompt, extra_headers=extra_headers, stream=self.stream, on_delta=on_delta)
+            if schemas is not None and self._answered(resp):
+                outcome, errors = self._structured(resp, schemas, sha256)
+                if errors:
+                    # Un solo reintento, devolviendo los errores al modelo
+                    self._metrics["validation_retries"] += 1
+                    retry = self.processor.process(aid, self._correction(prompt, errors), extra_headers=extra_headers, stream=self.stream)
+                    if self._answered(retry):
+                        outcome, errors = self._structured(retry, schemas, sha256)
+                    if errors:
+                        self._metrics["validation_failures"] += 1
+                resp = outcome
+            return self._annotate_chat(resp, aid, prompt, extra_headers, self.stream)
         except Exception as e:
             logger.exception("Chat exception: %s", e)
             return {"error": "chat_failed", "detail": str(e)}
-
-    def aclose(self) -> None:
-        # no-op for sync client
-        return None
-    
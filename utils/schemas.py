@@ -0,0 +1,209 @@
+import re
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Field types understood by DocumentSchema.validate
+STRING, NUMBER, DATE, RUT = 'string', 'number', 'date', 'rut'
+
+_TYPE_HINTS = {
+    STRING: 'texto',
+    NUMBER: 'número sin separadores de miles',
+    DATE: 'fecha AAAA-MM-DD',
+    RUT: 'RUT con dígito verificador, ej. 12345678-5',
+}
+_DATE_FORMATS = (
+    re.compile(r'^(?P<y>\d{4})-(?P<m>\d{1,2})-(?P<d>\d{1,2})$'),
+    re.compile(r'^(?P<d>\d{1,2})[-/.](?P<m>\d{1,2})[-/.](?P<y>\d{4})$'),
+)
+_AMOUNT = re.compile(r'^\$?\s*-?[\d.]+(,\d+)?$')
+
+
+def normalize_rut(value: Any) -> Optional[str]:
+    """'12.345.678-5' -> '12345678-5'; None unless the check digit (módulo 11) is right."""
+    if not isinstance(value, str):
+        return None
+    clean = re.sub(r'[^0-9kK]', '', value).upper()
+    if len(clean) < 2 or not clean[:-1].isdigit():
+        return None
+    body, dv = clean[:-1], clean[-1]
+    total, factor = 0, 2
+    for digit in reversed(body):
+        total += int(digit) * factor
+        factor = 2 if factor == 7 else factor + 1
+    expected = 11 - total % 11
+    expected = '0' if expected == 11 else 'K' if expected == 10 else str(expected)
+    return f'{int(body)}-{dv}' if dv == expected else None
+
+
+def _date(value: Any) -> Optional[str]:
+    if not isinstance(value, str):
+        return None
+    for pattern in _DATE_FORMATS:
+        m = pattern.match(value.strip())
+        if m:
+            try:
+                return date(int(m['y']), int(m['m']), int(m['d'])).isoformat()
+            except ValueError:
+                return None
+    return None
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str) and _AMOUNT.match(value.strip()):
+        # Formato chileno: '.' separa miles y ',' decimales
+        text = value.strip().lstrip('$').strip().replace('.', '').replace(',', '.')
+        try:
+            number = float(text)
+        except ValueError:
+            return None
+        return int(number) if number.is_integer() else number
+    return None
+
+
+def _string(value: Any) -> Optional[str]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    return value.strip() if isinstance(value, str) and value.strip() else None
+
+
+_COERCE = {STRING: _string, NUMBER: _number, DATE: _date, RUT: normalize_rut}
+
+
+class DocumentSchema:
+    """Fields expected from one document type, versioned for caching.
+
+    ``fields`` maps a field name to ``(type, required)`` with type one of
+    ``string``, ``number``, ``date`` or ``rut``. ``validate`` coerces values
+    to canonical form (ISO dates, RUT without dots, numbers from Chilean
+    formatted amounts), drops unknown keys and reports what is missing or
+    malformed. Bump ``version`` whenever the fields change: cached
+    extractions are keyed by it.
+    """
+
+    def __init__(self, name: str, version: int, description: str, fields: Dict[str, Tuple[str, bool]]):
+        self.name = name
+        self.version = version
+        self.description = description
+        self.fields = dict(fields)
+
+    @property
+    def key(self) -> str:
+        return f'{self.name}@{self.version}'
+
+    @property
+    def cache_key(self) -> str:
+        """Field of the media store entry holding the validated result."""
+        return f'extraction_{self.name}_v{self.version}'
+
+    def describe(self) -> str:
+        parts = [
+            f"{name} ({_TYPE_HINTS[kind]}{', obligatorio' if required else ''})"
+            for name, (kind, required) in self.fields.items()
+        ]
+        return f"- {self.name} ({self.description}): " + ', '.join(parts)
+
+    def validate(self, data: Any) -> Tuple[Dict[str, Any], List[str]]:
+        if not isinstance(data, dict):
+            return {}, ['la respuesta no es un objeto JSON']
+        result: Dict[str, Any] = {'tipo_documento': self.name}
+        errors: List[str] = []
+        for name, (kind, required) in self.fields.items():
+            raw = data.get(name)
+            value = _COERCE[kind](raw) if raw not in (None, '') else None
+            if value is None and raw not in (None, ''):
+                errors.append(f'{name}: valor inválido {raw!r} (se espera {_TYPE_HINTS[kind]})')
+            elif value is None and required:
+                errors.append(f'{name}: obligatorio')
+            result[name] = value
+        if isinstance(data.get('message'), str):
+            result['message'] = data['message']
+        return result, errors
+
+
+class SchemaRegistry:
+    """The document types SAIA may classify a file as, plus the prompt that asks for them.
+
+    The model is told to answer with a single JSON object whose
+    ``tipo_documento`` names one of the registered schemas; ``validate`` then
+    checks it against that schema. ``cached(entry)`` finds a still-valid
+    result (same schema version) in a media store entry.
+    """
+
+    def __init__(self, schemas: Iterable[DocumentSchema], fallback: str = 'otro'):
+        self.schemas = {schema.name: schema for schema in schemas}
+        self.fallback = fallback
+        self._instructions = (
+            "Responde únicamente con un objeto JSON, sin texto adicional ni bloques de código. "
+            f"Incluye \"tipo_documento\" con uno de: {', '.join(self.schemas)}; "
+            "y los campos de ese tipo (null si no aparecen en el documento):\n"
+            + '\n'.join(schema.describe() for schema in self.schemas.values())
+            + "\nAgrega \"message\" con un resumen breve para el usuario."
+        )
+
+    @property
+    def version(self) -> str:
+        return ','.join(schema.key for schema in self.schemas.values())
+
+    def get(self, name: Optional[str]) -> Optional[DocumentSchema]:
+        return self.schemas.get(name) if name else None
+
+    def instructions(self) -> str:
+        return self._instructions
+
+    def validate(self, data: Any) -> Tuple[DocumentSchema, Dict[str, Any], List[str]]:
+        tipo = data.get('tipo_documento') if isinstance(data, dict) else None
+        schema = self.get(str(tipo).strip().lower() if tipo else None)
+        if schema is None:
+            schema = self.schemas[self.fallback]
+            result, errors = schema.validate(data)
+            return schema, result, [f'tipo_documento desconocido: {tipo!r}'] + errors
+        result, errors = schema.validate(data)
+        return schema, result, errors
+
+    def cached(self, entry: Optional[Dict[str, Any]]) -> Optional[Tuple[DocumentSchema, Dict[str, Any]]]:
+        for schema in self.schemas.values():
+            if entry and entry.get(schema.cache_key) is not None:
+                return schema, entry[schema.cache_key]
+        return None
+
+
+DEFAULT_SCHEMAS = [
+    DocumentSchema('cedula', 1, 'cédula de identidad chilena', {
+        'rut': (RUT, True),
+        'nombres': (STRING, True),
+        'apellidos': (STRING, True),
+        'fecha_nacimiento': (DATE, False),
+        'fecha_vencimiento': (DATE, False),
+        'numero_documento': (STRING, False),
+        'nacionalidad': (STRING, False),
+        'sexo': (STRING, False),
+    }),
+    DocumentSchema('contrato', 1, 'contrato de trabajo o de servicios', {
+        'tipo_contrato': (STRING, True),
+        'empleador': (STRING, True),
+        'rut_empleador': (RUT, False),
+        'trabajador': (STRING, True),
+        'rut_trabajador': (RUT, False),
+        'fecha_inicio': (DATE, True),
+        'fecha_termino': (DATE, False),
+        'remuneracion': (NUMBER, False),
+    }),
+    DocumentSchema('factura', 1, 'factura o boleta', {
+        'emisor': (STRING, True),
+        'rut_emisor': (RUT, False),
+        'numero': (STRING, True),
+        'fecha': (DATE, True),
+        'monto_neto': (NUMBER, False),
+        'iva': (NUMBER, False),
+        'total': (NUMBER, True),
+    }),
+    DocumentSchema('otro', 1, 'cualquier otro documento', {
+        'resumen': (STRING, True),
+    }),
+]
+
+DEFAULT_REGISTRY = SchemaRegistry(DEFAULT_SCHEMAS)
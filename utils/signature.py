@@ -0,0 +1,53 @@
+import hashlib
+import hmac
+import threading
+from typing import Optional
+
+_PREFIX = 'sha256='
+
+
+class WebhookVerifier:
+    """Cheap gatekeeping for Meta webhooks, done on the raw body before any parsing.
+
+    ``precheck(content_length)`` rejects oversize requests from the header
+    alone, before the body is read. ``verify(raw, header)`` checks
+    ``X-Hub-Signature-256`` (HMAC-SHA256 of the raw body with the app secret)
+    with a constant-time compare. Without an ``app_secret`` signatures are
+    not checked, only the size limit. Both return None when the request may
+    proceed, or the rejection reason, which is also counted in ``rejected``.
+    """
+
+    def __init__(self, app_secret: Optional[str], max_body: int = 1024 * 1024):
+        self._key = app_secret.encode('utf-8') if app_secret else None
+        self.max_body = max_body
+        self._lock = threading.Lock()
+        self.metrics = {"accepted": 0, "rejected": 0}
+        self.rejected = {"too_large": 0, "missing_signature": 0, "bad_signature": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self._key is not None
+
+    def _reject(self, reason: str) -> str:
+        with self._lock:
+            self.metrics["rejected"] += 1
+            self.rejected[reason] += 1
+        return reason
+
+    def precheck(self, content_length: Optional[int]) -> Optional[str]:
+        if content_length is not None and content_length > self.max_body:
+            return self._reject('too_large')
+        return None
+
+    def verify(self, raw: bytes, signature_header: Optional[str]) -> Optional[str]:
+        if len(raw) > self.max_body:
+            return self._reject('too_large')
+        if self._key is not None:
+            if not signature_header or not signature_header.startswith(_PREFIX):
+                return self._reject('missing_signature')
+            expected = hmac.new(self._key, raw, hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(expected, signature_header[len(_PREFIX):].strip().lower()):
+                return self._reject('bad_signature')
+        with self._lock:
+            self.metrics["accepted"] += 1
+        return None
@@ -0,0 +1,202 @@
+import base64
+import hashlib
+import io
+import os
+import tempfile
+import uuid
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional
+
+
+class QuickXorHash:
+    """OneDrive's quickXorHash, used to verify uploaded content.
+
+    Byte ``n`` of the stream is XORed into a 160-bit register at bit offset
+    ``(n * 11) % 160``. Because the offsets repeat every 160 bytes, input is
+    first folded into a 160-byte block (XOR of phase-aligned blocks) and only
+    spread into the register when the digest is requested.
+    """
+
+    WIDTH = 160
+    SHIFT = 11
+    _MASK = (1 << WIDTH) - 1
+
+    def __init__(self):
+        self._fold = 0
+        self._length = 0
+
+    def update(self, data: bytes) -> None:
+        mv = memoryview(data)
+        block = self.WIDTH
+        pos = self._length % block
+        fold = self._fold
+        i = 0
+        if pos:
+            i = min(block - pos, len(mv))
+            fold ^= int.from_bytes(mv[:i], 'little') << (pos * 8)
+        end = len(mv)
+        while i + block <= end:
+            fold ^= int.from_bytes(mv[i:i + block], 'little')
+            i += block
+        if i < end:
+            fold ^= int.from_bytes(mv[i:], 'little')
+        self._fold = fold
+        self._length += len(mv)
+
+    def digest(self) -> bytes:
+        register = 0
+        fold = self._fold
+        for k in range(self.WIDTH):
+            byte = (fold >> (8 * k)) & 0xFF
+            if byte:
+                v = byte << ((k * self.SHIFT) % self.WIDTH)
+                register ^= (v & self._MASK) ^ (v >> self.WIDTH)
+        out = bytearray(register.to_bytes(20, 'little'))
+        for i, b in enumerate(self._length.to_bytes(8, 'little')):
+            out[12 + i] ^= b
+        return bytes(out)
+
+    def b64digest(self) -> str:
+        return base64.b64encode(self.digest()).decode('ascii')
+
+
+class MediaBuffer:
+    """Write-once byte buffer that spills to a temp file past ``max_memory``.
+
+    Bytes are hashed (SHA-256, plus any extra ``hashers`` such as
+    QuickXorHash) while they are written, so no second pass over the data is
+    needed. Once sealed, every consumer calls ``open()`` to get its
+    own independent reader, which lets the SAIA and OneDrive uploads stream the
+    same content (even concurrently) without keeping a full copy per consumer.
+    """
+
+    def __init__(self, max_memory: int = 1024 * 1024, spool_dir: Optional[str] = None,
+                 hashers: Optional[Dict[str, Any]] = None):
+        self.max_memory = max_memory
+        self.spool_dir = spool_dir
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self.hashers = dict(hashers or {})
+        self._memory: Optional[bytearray] = bytearray()
+        self._file: Optional[BinaryIO] = None
+        self.path: Optional[str] = None
+        self._sealed: Optional[bytes] = None
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[bytes], max_memory: int = 1024 * 1024,
+                    spool_dir: Optional[str] = None, hashers: Optional[Dict[str, Any]] = None) -> "MediaBuffer":
+        buffer = cls(max_memory=max_memory, spool_dir=spool_dir, hashers=hashers)
+        try:
+            for chunk in chunks:
+                if chunk:
+                    buffer.write(chunk)
+            buffer.seal()
+        except Exception:
+            buffer.close()
+            raise
+        return buffer
+
+    def write(self, chunk: bytes) -> None:
+        self._hash.update(chunk)
+        for hasher in self.hashers.values():
+            hasher.update(chunk)
+        self.size += len(chunk)
+        if self._file is None and self.size > self.max_memory:
+            fd, self.path = tempfile.mkstemp(prefix='wsp-media-', dir=self.spool_dir)
+            self._file = os.fdopen(fd, 'wb')
+            self._file.write(self._memory)
+            self._memory = None
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._memory.extend(chunk)
+
+    def seal(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        elif self._memory is not None:
+            self._sealed = bytes(self._memory)
+            self._memory = None
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    @property
+    def in_memory(self) -> bool:
+        return self.path is None
+
+    def open(self) -> BinaryIO:
+        """Return a fresh reader positioned at the start of the content."""
+        if self.path is not None:
+            return open(self.path, 'rb')
+        return io.BytesIO(self._sealed or b'')
+
+    def getvalue(self) -> bytes:
+        with self.open() as fh:
+            return fh.read()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+        self._memory = None
+        self._sealed = None
+
+    def __enter__(self) -> "MediaBuffer":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class MultipartStream:
+    """Single-file ``multipart/form-data`` body that is read lazily.
+
+    ``requests`` streams any iterable body with a known ``len()`` using a
+    fixed Content-Length, so the file part is read from ``fileobj`` in chunks
+    instead of being copied into one in-memory body.
+    """
+
+    def __init__(self, field: str, filename: str, fileobj: BinaryIO, size: int,
+                 content_type: str = 'application/octet-stream', chunk_size: int = 64 * 1024):
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        safe_name = filename.replace('"', '%22').replace('\r', '').replace('\n', '')
+        head = (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{safe_name}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        ).encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        self._parts: List[BinaryIO] = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+        self._length = len(head) + size + len(tail)
+        self.chunk_size = chunk_size
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b''.join(part.read() for part in self._parts)
+        out = bytearray()
+        while self._parts and len(out) < size:
+            data = self._parts[0].read(size - len(out))
+            if not data:
+                self._parts.pop(0)
+                continue
+            out.extend(data)
+        return bytes(out)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
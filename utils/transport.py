@@ -0,0 +1,150 @@
+import threading
+from typing import Any, Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import Config
+
+TimeoutType = Union[float, Tuple[float, float]]
+# Read/status retries only for safe methods: PUT/POST/DELETE (uploads, sends) are
+# retried by the layer that owns them, which knows whether a replay is safe
+RETRY_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+
+
+class Transport:
+    """Shared keep-alive HTTP sessions, one connection pool per host.
+
+    Every outbound client (WhatsApp Cloud API, Azure AD, Graph, SAIA) goes
+    through here so TCP/TLS connections are reused across requests. GET, HEAD
+    and OPTIONS are retried with exponential backoff on 429/5xx; PUT, POST and
+    DELETE are never retried here. Calls without an explicit ``timeout`` get the
+    transport default.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 10,
+        pool_maxsize: int = 20,
+        max_retries: int = 2,
+        backoff_factor: float = 0.5,
+        timeout: TimeoutType = (5.0, 60.0),
+    ):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+        self._requests: Dict[str, int] = {}
+        self._retries: Dict[str, int] = {}
+
+    @classmethod
+    def from_config(cls) -> "Transport":
+        return cls(
+            pool_connections=Config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=Config.HTTP_POOL_MAXSIZE,
+            max_retries=Config.HTTP_MAX_RETRIES,
+            backoff_factor=Config.HTTP_BACKOFF_FACTOR,
+            timeout=(Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_READ_TIMEOUT),
+        )
+
+    def _new_session(self) -> requests.Session:
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=RETRY_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @staticmethod
+    def _host(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session(self, url: str) -> requests.Session:
+        host = self._host(url)
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = self._new_session()
+                    self._sessions[host] = session
+        return session
+
+    def request(self, method: str, url: str, timeout: Optional[TimeoutType] = None, **kwargs: Any) -> requests.Response:
+        host = self._host(url)
+        with self._lock:
+            self._requests[host] = self._requests.get(host, 0) + 1
+        response = self.session(url).request(method, url, timeout=timeout or self.timeout, **kwargs)
+        # urllib3 leaves the attempts it retried on the final response
+        retried = len(getattr(getattr(response.raw, 'retries', None), 'history', None) or ())
+        if retried:
+            with self._lock:
+                self._retries[host] = self._retries.get(host, 0) + retried
+        return response
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request('PUT', url, **kwargs)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Per-host request and retry counts and connection pool utilisation."""
+        result: Dict[str, Dict[str, int]] = {}
+        with self._lock:
+            sessions = dict(self._sessions)
+            counts = dict(self._requests)
+            retries = dict(self._retries)
+        for host, session in sessions.items():
+            adapter = session.get_adapter(host)
+            in_use = idle = opened = 0
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                free = pool.pool.qsize() if pool.pool is not None else 0
+                idle += sum(1 for c in list(pool.pool.queue) if c is not None) if pool.pool is not None else 0
+                in_use += pool.pool.maxsize - free if pool.pool is not None else 0
+                opened += pool.num_connections
+            result[host] = {
+                'requests': counts.get(host, 0),
+                'retries': retries.get(host, 0),
+                'pool_maxsize': self.pool_maxsize,
+                'connections_opened': opened,
+                'connections_in_use': in_use,
+                'connections_idle': idle,
+            }
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+transport = Transport.from_config()